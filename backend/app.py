@@ -1,17 +1,33 @@
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
-from database import db
+from fastapi.responses import FileResponse, JSONResponse
+from database import (
+    db, adb, DatabaseUnavailable, LETTERS_PAGE_LIMIT, LETTERS_PAGE_MAX_LIMIT, SEARCH_LIMIT, SEARCH_MAX_LIMIT,
+    CONNECTIONS_LIMIT, CONNECTIONS_MAX_LIMIT, TOP_CITIES_MAX_LIMIT, CITY_LETTER_FIELDS, CITY_LETTER_DEFAULT_FIELDS,
+    CITY_LETTERS_LIMIT, CITY_LETTERS_MAX_LIMIT, parse_city_letter_fields, parse_city_cursor,
+    TIMELINE_CITIES_LIMIT, TIMELINE_CITIES_MAX_LIMIT, TIMELINE_YEARS,
+)
+from facets import facet_index, FACET_CITIES_LIMIT, FACET_CITIES_MAX_LIMIT
+from cache import response_cache
+from http_cache import GenerationETagMiddleware, CompressionMiddleware
+from fast_json import JSONBytesResponse
+import fast_json
+import geo
 from typing import List, Optional
 import os
-import sqlite3
 
 # Импортируем инициализатор базы данных ПЕРВЫМ
 import db_init
 
 app = FastAPI(title="Postcard Analytics", version="1.0.0")
 
+# Middleware добавляются изнутри наружу: ETag ближе всего к эндпоинтам, CORS — снаружи,
+# чтобы заголовки CORS получали и ответы 304
+# /api/debug показывает живые счетчики пула и кеша, поэтому без ETag
+app.add_middleware(GenerationETagMiddleware, generation=adb.generation, exclude=("/api/debug",), salt=app.version)
+app.add_middleware(CompressionMiddleware, minimum_size=1024)
+
 # CORS
 app.add_middleware(
     CORSMiddleware,
@@ -26,97 +42,246 @@ app.mount("/static", StaticFiles(directory="../frontend"), name="static")
 app.mount("/css", StaticFiles(directory="../frontend/css"), name="css")
 app.mount("/js", StaticFiles(directory="../frontend/js"), name="js")
 
+@app.exception_handler(DatabaseUnavailable)
+async def database_unavailable(request, exc):
+    # Ответ без ETag и не из кеша: клиент повторит запрос, когда база освободится
+    return JSONResponse(status_code=503, content={"detail": "Database unavailable"}, headers={"Retry-After": "1"})
+
 # Главная страница
 @app.get("/")
 async def read_index():
     return FileResponse("../frontend/index.html")
 
+@app.on_event("startup")
+async def build_facet_index():
+    # Колоночный индекс строим сразу, а не на первом запросе /api/facets
+    await adb.run(facet_index.current, db)
+
 # API endpoints
+# Эндпоинты асинхронные: запросы к SQLite уходят в пул читателей adb, а ответы
+# из кеша отдаются прямо в цикле событий, без потоков
 @app.get("/api/")
 async def read_root():
     return {"message": "Postcard Analytics API"}
 
+def parse_bbox_param(bbox):
+    """bbox из запроса или None; неверный — 400"""
+    if bbox is None:
+        return None
+    try:
+        return geo.parse_bbox(bbox)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def top_cities_param(min_letters, top):
+    """(min_letters, top) для фильтра крупнейших городов карты или None, если фильтра нет"""
+    if min_letters is None and top is None:
+        return None
+    return (min_letters or 1, top or TOP_CITIES_MAX_LIMIT)
+
+BBOX_DESCRIPTION = "Только видимая область: запад,юг,восток,север"
+
 @app.get("/api/cities")
-def get_cities():
-    cities = db.get_cities()
-    return cities
+async def get_cities(bbox: Optional[str] = Query(None, description=BBOX_DESCRIPTION)):
+    # В кеше лежит готовый JSON — ответ отдается без сериализации
+    bbox = parse_bbox_param(bbox)
+    params = () if bbox is None else (bbox,)
+    cities = await response_cache.get_async(
+        'cities', params, lambda: adb.get_cities_json(*params), await adb.generation()
+    )
+    return JSONBytesResponse(cities)
+
+@app.get("/api/cities/clusters")
+async def get_city_clusters(
+    bbox: Optional[str] = Query(None, description="Видимая область: запад,юг,восток,север"),
+    zoom: int = Query(4, ge=0, le=22, description="Зум карты Leaflet"),
+    min_letters: Optional[int] = Query(None, ge=1, description="Только города с не меньшим числом писем"),
+    top: Optional[int] = Query(None, ge=1, le=TOP_CITIES_MAX_LIMIT, description="Только top крупнейших городов")
+):
+    # Кластеры посчитаны при загрузке для каждого зума; bbox переводим в клетки сетки,
+    # поэтому близкие bbox одного зума попадают в одну запись кеша
+    bbox = parse_bbox_param(bbox) or (-180.0, -geo.MAX_LATITUDE, 180.0, geo.MAX_LATITUDE)
+    zoom = geo.cluster_zoom(zoom)
+    cells = geo.bbox_cells(bbox, zoom)
+    top_cities = top_cities_param(min_letters, top)
+    clusters = await response_cache.get_async(
+        'clusters', (zoom, cells, top_cities), lambda: adb.get_clusters_json(zoom, cells, top_cities),
+        await adb.generation()
+    )
+    return JSONBytesResponse(clusters)
 
 @app.get("/api/cities/{city_id}")
-def get_city_detail(city_id: int):
-    city = db.get_city_detail(city_id)
-    if not city:
+async def get_city_detail(
+    city_id: int,
+    fields: Optional[str] = Query(None, description="Поля писем через запятую, например id,year,theme,excerpt"),
+    sort: str = Query("id", pattern="^(id|year|-year)$", description="id, year или -year (новые первыми)"),
+    cursor: Optional[str] = Query(None, description="next_cursor предыдущей страницы"),
+    limit: int = Query(CITY_LETTERS_LIMIT, ge=1, le=CITY_LETTERS_MAX_LIMIT),
+    all: bool = Query(False, description="Все письма города одним ответом (по умолчанию со всеми полями)")
+):
+    # Письма города отдаются страницами и без полного текста; весь город — только по all=true
+    try:
+        if fields:
+            fields = parse_city_letter_fields(fields)
+        else:
+            fields = CITY_LETTER_FIELDS if all else CITY_LETTER_DEFAULT_FIELDS
+        if cursor is not None:
+            parse_city_cursor(sort, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    params = (city_id, fields, sort, None if all else cursor, None if all else limit)
+    city = await response_cache.get_async(
+        'city', params, lambda: adb.get_city_detail_json(*params), await adb.generation()
+    )
+    # None — такого города нет; ошибка базы сюда не доходит (DatabaseUnavailable -> 503)
+    if city is None:
         raise HTTPException(status_code=404, detail="City not found")
-    return city
+    return JSONBytesResponse(city)
 
 @app.get("/api/statistics")
-def get_statistics():
-    return db.get_statistics()
+async def get_statistics():
+    statistics = await response_cache.get_async('statistics', (), adb.get_statistics_json, await adb.generation())
+    return JSONBytesResponse(statistics)
+
+@app.get("/api/timeline")
+async def get_timeline(
+    theme: Optional[str] = Query(None),
+    sentiment: Optional[str] = Query(None),
+    city_id: Optional[int] = Query(None),
+    year_from: Optional[int] = Query(None, ge=TIMELINE_YEARS[0], le=TIMELINE_YEARS[1]),
+    year_to: Optional[int] = Query(None, ge=TIMELINE_YEARS[0], le=TIMELINE_YEARS[1]),
+    group: Optional[str] = Query(None, pattern="^(theme|sentiment|city)$",
+                                 description="Разложить ряд по темам, тональностям или городам"),
+    granularity: str = Query("year", pattern="^(year|decade)$", description="year или decade"),
+    limit: int = Query(TIMELINE_CITIES_LIMIT, ge=1, le=TIMELINE_CITIES_MAX_LIMIT,
+                       description="Сколько крупнейших городов при group=city")
+):
+    # Ряды читаются из куба letter_cube, посчитанного при загрузке: фильтр сужает
+    # срез (roll-up по остальным измерениям), group раскладывает его (drill-down)
+    theme, sentiment = theme or None, sentiment or None
+    filters = {'theme': theme, 'sentiment': sentiment, 'city': city_id}
+    if group and filters[group] is not None:
+        raise HTTPException(status_code=400, detail=f"Нельзя раскладывать по {group}: это измерение задано фильтром")
+    params = (group, theme, sentiment, city_id, year_from, year_to, granularity, limit if group == 'city' else None)
+    series = await response_cache.get_async(
+        'timeline', params, lambda: adb.get_timeline_json(*params), await adb.generation()
+    )
+    return JSONBytesResponse(series)
+
+@app.get("/api/facets")
+async def get_facets(
+    theme: Optional[List[str]] = Query(None),
+    sentiment: Optional[List[str]] = Query(None),
+    decade: Optional[List[int]] = Query(None, description="Начало десятилетия: 1900, 1910, ..."),
+    city_id: Optional[List[int]] = Query(None, description="Письма из этих городов или в них"),
+    year_from: Optional[int] = Query(None, ge=1, le=9999),
+    year_to: Optional[int] = Query(None, ge=1, le=9999),
+    city_limit: int = Query(FACET_CITIES_LIMIT, ge=1, le=FACET_CITIES_MAX_LIMIT,
+                            description="Сколько крупнейших городов в фасете городов")
+):
+    # Несколько значений одного измерения — ИЛИ, разные измерения — И.
+    # Считает колоночный индекс в памяти процесса (facets.py), без него — SQLite
+    filters = {
+        'theme': sorted(set(theme)) if theme else None,
+        'sentiment': sorted(set(sentiment)) if sentiment else None,
+        'decade': sorted(set(decade)) if decade else None,
+        'city': sorted(set(city_id)) if city_id else None,
+        'year_from': year_from,
+        'year_to': year_to,
+    }
+    params = tuple((key, tuple(value) if isinstance(value, list) else value) for key, value in filters.items())
+    counts = await response_cache.get_async(
+        'facets', params + (city_limit,), lambda: adb.get_facets_json(filters, city_limit), await adb.generation()
+    )
+    return JSONBytesResponse(counts)
+
+@app.get("/api/connections")
+async def get_connections(
+    min_count: int = Query(1, ge=1, description="Минимум писем с упоминанием"),
+    city_ids: Optional[List[int]] = Query(None, description="Только связи между этими городами"),
+    limit: int = Query(CONNECTIONS_LIMIT, ge=1, le=CONNECTIONS_MAX_LIMIT),
+    directed: bool = Query(True, description="false — пары городов без направления"),
+    with_letters: bool = Query(False, description="Добавить id писем с упоминаниями"),
+    min_letters: Optional[int] = Query(None, ge=1, description="Только связи городов карты с не меньшим числом писем"),
+    top: Optional[int] = Query(None, ge=1, le=TOP_CITIES_MAX_LIMIT,
+                               description="Только связи между top крупнейшими городами карты"),
+    with_cities: bool = Query(False, description="Добавить названия и координаты городов")
+):
+    city_ids = tuple(sorted(set(city_ids))) if city_ids else ()
+    params = (min_count, city_ids, limit, directed, with_letters, top_cities_param(min_letters, top), with_cities)
+    connections = await response_cache.get_async(
+        'connections', params, lambda: adb.get_connections_json(*params), await adb.generation()
+    )
+    return JSONBytesResponse(connections)
 
 @app.get("/api/letters")
-def get_letters(
+async def get_letters(
+    response: Response,
     city_id: Optional[int] = Query(None),
-    theme: Optional[str] = Query(None)
+    theme: Optional[str] = Query(None),
+    sentiment: Optional[str] = Query(None),
+    year_from: Optional[int] = Query(None),
+    year_to: Optional[int] = Query(None),
+    cursor: Optional[int] = Query(None, description="id последнего письма предыдущей страницы"),
+    limit: int = Query(LETTERS_PAGE_LIMIT, ge=1, le=LETTERS_PAGE_MAX_LIMIT),
+    bbox: Optional[str] = Query(None, description=BBOX_DESCRIPTION)
 ):
-    all_letters = []
-    cities = db.get_cities()
-    
-    for city in cities:
-        city_detail = db.get_city_detail(city['id'])
-        if city_detail and 'letters' in city_detail:
-            for letter in city_detail['letters']:
-                if city_id and letter['city_id'] != city_id:
-                    continue
-                if theme and letter['theme'] != theme:
-                    continue
-                all_letters.append(letter)
-    
-    return all_letters[:50]
+    bbox = parse_bbox_param(bbox)
+    letters, next_cursor = await adb.get_letters(city_id, theme, sentiment, year_from, year_to, cursor, limit, bbox)
+    # Курсор следующей страницы отдаем заголовком, чтобы тело ответа осталось списком писем
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = str(next_cursor)
+    return letters
 
 @app.get("/api/search")
-def search_letters(
-    q: str = Query(..., description="Поисковый запрос")
+async def search_letters(
+    response: Response,
+    q: str = Query(..., description="Поисковый запрос"),
+    mode: str = Query("words", pattern="^(words|substring|fuzzy)$", description="words, substring или fuzzy"),
+    limit: int = Query(SEARCH_LIMIT, ge=1, le=SEARCH_MAX_LIMIT),
+    offset: int = Query(0, ge=0),
+    bbox: Optional[str] = Query(None, description=BBOX_DESCRIPTION)
 ):
-    results = []
-    cities = db.get_cities()
-    
-    for city in cities:
-        city_detail = db.get_city_detail(city['id'])
-        if city_detail and 'letters' in city_detail:
-            for letter in city_detail['letters']:
-                if q.lower() in letter['content'].lower() or q.lower() in letter['excerpt'].lower():
-                    results.append(letter)
-    
-    return results[:20]
+    bbox = parse_bbox_param(bbox)
+    results, next_offset = await adb.search_letters(q, limit, offset, mode, bbox)
+    if next_offset is not None:
+        response.headers["X-Next-Offset"] = str(next_offset)
+    return results
 
 @app.get("/api/debug")
-def debug_info():
+async def debug_info():
     """Endpoint для отладки - показывает что в базе"""
-    cities = db.get_cities()
-    stats = db.get_statistics()
+    generation = await adb.generation()
+    cities = fast_json.loads(await response_cache.get_async('cities', (), adb.get_cities_json, generation))
+    stats = fast_json.loads(await response_cache.get_async('statistics', (), adb.get_statistics_json, generation))
     
     return {
         "cities_count": len(cities),
         "cities": cities[:5],
         "statistics": stats,
-        "total_letters_in_db": stats["total_letters"]
+        "total_letters_in_db": stats["total_letters"],
+        "db_pool": db.pool_stats(),
+        "db_executor": adb.stats(),
+        "response_cache": await adb.run(response_cache.stats),
+        "facet_index": facet_index.stats(),
     }
 
 @app.get("/api/test-data")
-def test_data():
+async def test_data():
     """Тестовый endpoint для проверки данных"""
-    conn = sqlite3.connect("postcards.db")
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    
-    # Проверяем первые 5 городов
-    cursor.execute("SELECT * FROM cities LIMIT 5")
-    cities = [dict(row) for row in cursor.fetchall()]
-    
-    # Проверяем первые 5 писем
-    cursor.execute("SELECT * FROM letters LIMIT 5")
-    letters = [dict(row) for row in cursor.fetchall()]
-    
-    conn.close()
+    return await adb.run(_test_data)
+
+def _test_data():
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        
+        # Проверяем первые 5 городов
+        cursor.execute("SELECT * FROM cities LIMIT 5")
+        cities = [dict(row) for row in cursor.fetchall()]
+        
+        # Проверяем первые 5 писем
+        cursor.execute("SELECT * FROM letters LIMIT 5")
+        letters = [dict(row) for row in cursor.fetchall()]
     
     return {
         "cities_sample": cities,
@@ -0,0 +1,97 @@
+# bench_classifier.py
+"""Микробенчмарк классификатора на реальном корпусе.
+
+Сравнивает прежнюю реализацию (отдельный `word in text` на каждое слово)
+со скомпилированным классификатором и проверяет, что результаты совпадают:
+
+    python -m bench_classifier [путь к xlsx] [--repeat 5]
+"""
+import sys
+import time
+import argparse
+import classifier
+import ingest
+
+
+def legacy_detect_theme(content):
+    """Прежняя реализация detect_theme — эталон для сравнения"""
+    if not content:
+        return classifier.DEFAULT_THEME
+    content_lower = content.lower()
+    for theme, words in classifier.THEME_KEYWORDS:
+        if any(word in content_lower for word in words):
+            return theme
+    return classifier.DEFAULT_THEME
+
+
+def legacy_analyze_sentiment(content):
+    """Прежняя реализация analyze_sentiment — эталон для сравнения"""
+    if not content:
+        return 'neutral'
+    content_lower = content.lower()
+    pos_count = sum(1 for word in classifier.POSITIVE_WORDS if word in content_lower)
+    neg_count = sum(1 for word in classifier.NEGATIVE_WORDS if word in content_lower)
+    if pos_count > neg_count:
+        return 'positive'
+    elif neg_count > pos_count:
+        return 'negative'
+    return 'neutral'
+
+
+def load_texts(excel_path):
+    texts = []
+    for row in ingest.iter_excel_rows(excel_path):
+        content = row.get(ingest.COL_TEXT)
+        texts.append('' if content is None else str(content))
+    return texts
+
+
+def best_time(func, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк классификатора тем и тональности")
+    parser.add_argument('excel_path', nargs='?', default=ingest.DEFAULT_EXCEL_PATH, help="путь к xlsx-файлу корпуса")
+    parser.add_argument('--repeat', type=int, default=5, help="число повторов, берем лучшее время")
+    args = parser.parse_args(argv)
+
+    texts = load_texts(args.excel_path)
+    chars = sum(len(text) for text in texts)
+    print(f"📊 {len(texts)} писем, {chars} символов")
+
+    compiled = classifier.default_classifier
+    substring = classifier.KeywordClassifier(use_automaton=False)
+    print(f"⚙️ движок по умолчанию: {compiled.engine}")
+
+    runs = [
+        ('прежний (word in text)', lambda: [(legacy_detect_theme(t), legacy_analyze_sentiment(t)) for t in texts]),
+        ('substring, маски', lambda: [substring.classify(t) for t in texts]),
+        (f'{compiled.engine}, маски', lambda: [compiled.classify(t) for t in texts]),
+        ('classify_many', lambda: compiled.classify_many(texts)),
+    ]
+
+    baseline_time = None
+    reference = None
+    for name, func in runs:
+        elapsed, result = best_time(func, args.repeat)
+        if reference is None:
+            baseline_time, reference = elapsed, result
+        mismatches = sum(1 for a, b in zip(reference, result) if a != b)
+        print(f"  {name:<24} {elapsed * 1000:8.1f} мс  "
+              f"{len(texts) / elapsed:10.0f} писем/с  x{baseline_time / elapsed:4.1f}  "
+              f"расхождений: {mismatches}")
+        if mismatches:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
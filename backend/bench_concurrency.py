@@ -0,0 +1,180 @@
+# bench_concurrency.py
+"""Бенчмарк пропускной способности API при параллельных клиентах.
+
+Поднимает uvicorn в отдельном процессе и гоняет смесь запросов
+(/api/cities/{id}, /api/letters, /api/search) с заданным числом
+одновременных клиентов. Сравниваются два приложения:
+
+    sync  — прежние синхронные эндпоинты (sync_app ниже) в пуле потоков FastAPI;
+    async — текущее app:app с async-эндпоинтами и пулом читателей AsyncDatabase.
+
+Кеш ответов в обоих случаях выключен, чтобы мерить именно доступ к базе:
+
+    python -m bench_concurrency [--concurrency 10 100 1000] [--requests 2000]
+
+Нужна загруженная postcards.db в текущем каталоге.
+"""
+import os
+import sys
+import time
+import random
+import socket
+import sqlite3
+import asyncio
+import argparse
+import subprocess
+from typing import Optional
+import httpx
+from fastapi import FastAPI, HTTPException, Query, Response
+from database import db
+
+SEARCH_WORDS = ['привет', 'здоров', 'мама', 'Одесса', 'праздник', 'письмо', 'целую', 'Москва']
+
+# Прежние синхронные эндпоинты — точка отсчета для сравнения
+sync_app = FastAPI(title="Postcard Analytics (sync)")
+
+
+@sync_app.get("/api/")
+def sync_root():
+    return {"message": "Postcard Analytics API"}
+
+
+@sync_app.get("/api/cities/{city_id}")
+def sync_city_detail(city_id: int):
+    city = db.get_city_detail(city_id)
+    if not city:
+        raise HTTPException(status_code=404, detail="City not found")
+    return city
+
+
+@sync_app.get("/api/letters")
+def sync_letters(response: Response, city_id: Optional[int] = Query(None), limit: int = Query(50)):
+    letters, next_cursor = db.get_letters(city_id, None, None, None, None, None, limit)
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = str(next_cursor)
+    return letters
+
+
+@sync_app.get("/api/search")
+def sync_search(q: str = Query(...)):
+    results, _ = db.search_letters(q, 20, 0, 'words')
+    return results
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(target, port, env=None, timeout=120):
+    """uvicorn с выключенным кешем ответов; env дополняет окружение сервера"""
+    env = dict(os.environ, POSTCARDS_CACHE_MAX_BYTES='0', **(env or {}))
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', target, '--port', str(port), '--log-level', 'warning'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+    )
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and process.poll() is None:
+        try:
+            if httpx.get(f'http://127.0.0.1:{port}/api/', timeout=1).status_code == 200:
+                return process
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"Сервер {target} не запустился")
+
+
+def request_paths(db_path, count, seed=1):
+    """Смесь запросов: крупные города, страницы писем и поиск"""
+    conn = sqlite3.connect(db_path)
+    try:
+        city_ids = [row[0] for row in conn.execute(
+            'SELECT id FROM cities ORDER BY letter_count DESC LIMIT 200'
+        )]
+    finally:
+        conn.close()
+    rng = random.Random(seed)
+    paths = []
+    for i in range(count):
+        kind = i % 3
+        if kind == 0:
+            paths.append(f'/api/cities/{rng.choice(city_ids)}')
+        elif kind == 1:
+            paths.append(f'/api/letters?city_id={rng.choice(city_ids)}&limit=50')
+        else:
+            paths.append(f'/api/search?q={rng.choice(SEARCH_WORDS)}')
+    return paths
+
+
+async def run_load(port, paths, concurrency):
+    """Гоняем paths через concurrency одновременных клиентов; возвращаем сводку"""
+    queue = asyncio.Queue()
+    for path in paths:
+        queue.put_nowait(path)
+    latencies = []
+    errors = {}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    # Без сжатия: сравниваем доступ к базе, а не brotli
+    headers = {'Accept-Encoding': 'identity'}
+    async with httpx.AsyncClient(base_url=f'http://127.0.0.1:{port}', limits=limits, timeout=120,
+                                 headers=headers) as client:
+        async def worker():
+            while True:
+                try:
+                    path = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                started = time.perf_counter()
+                try:
+                    response = await client.get(path)
+                    if response.status_code >= 500:
+                        errors[response.status_code] = errors.get(response.status_code, 0) + 1
+                except httpx.HTTPError as e:
+                    errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(paths),
+        'errors': errors,
+        'seconds': elapsed,
+        'rps': len(paths) / elapsed,
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк параллельных запросов к API")
+    parser.add_argument('--db', default='postcards.db', help="путь к базе SQLite (та же, что у сервера)")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[10, 100, 1000], help="числа одновременных клиентов")
+    parser.add_argument('--requests', type=int, default=2000, help="запросов на каждый прогон")
+    args = parser.parse_args(argv)
+
+    paths = request_paths(args.db, args.requests)
+    print(f"📊 {len(paths)} запросов: города, страницы писем, поиск")
+    for name, target in [('sync', 'bench_concurrency:sync_app'), ('async', 'app:app')]:
+        port = free_port()
+        process = start_server(target, port)
+        try:
+            # Прогрев: соединения пула и кеш страниц SQLite
+            asyncio.run(run_load(port, paths[:100], 10))
+            for concurrency in args.concurrency:
+                result = asyncio.run(run_load(port, paths, concurrency))
+                print(f"  {name:<5} клиентов {concurrency:>5}: {result['rps']:8.1f} запр/с   "
+                      f"p50 {result['p50_ms']:8.1f} мс   p99 {result['p99_ms']:8.1f} мс   "
+                      f"ошибок {sum(result['errors'].values())} {result['errors'] or ''}")
+        finally:
+            process.terminate()
+            process.wait()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
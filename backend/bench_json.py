@@ -0,0 +1,79 @@
+# bench_json.py
+"""Бенчмарк сериализации ответов API на самом большом городе.
+
+Сравнивает прежний путь (dict(row) для каждой строки, затем jsonable_encoder
+и json.dumps, как это делает JSONResponse в FastAPI) с быстрым путем
+fast_json (кортежи курсора сразу в байты) и проверяет, что JSON совпадает:
+
+    python -m bench_json [--db postcards.db] [--repeat 10]
+"""
+import sys
+import json
+import time
+import sqlite3
+import argparse
+from fastapi.encoders import jsonable_encoder
+from database import Database, CITY_LETTER_FIELDS
+import fast_json
+
+
+def fastapi_render(value):
+    """То же, что JSONResponse.render в FastAPI"""
+    return json.dumps(
+        jsonable_encoder(value), ensure_ascii=False, allow_nan=False, indent=None, separators=(',', ':')
+    ).encode('utf-8')
+
+
+def largest_city(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute(
+            'SELECT id, letter_count FROM cities ORDER BY letter_count DESC LIMIT 1'
+        ).fetchone()
+    finally:
+        conn.close()
+
+
+def best_time(func, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк сериализации JSON")
+    parser.add_argument('--db', default='postcards.db', help="путь к базе SQLite")
+    parser.add_argument('--repeat', type=int, default=10, help="число повторов, берем лучшее время")
+    args = parser.parse_args(argv)
+
+    city_id, letters = largest_city(args.db)
+    db = Database(args.db, pool_size=1)
+    encoder = 'orjson' if fast_json.orjson is not None else 'json'
+    print(f"📊 Город {city_id}: {letters} писем, кодировщик: {encoder}")
+
+    cases = [
+        # Весь город (all=true) — тот же объем, что отдавал прежний эндпоинт
+        ('/api/cities/{id}', lambda: fastapi_render(dict(db.get_city_detail(city_id), next_cursor=None)),
+         lambda: db.get_city_detail_json(city_id, CITY_LETTER_FIELDS, 'id', None, None)),
+        ('/api/cities', lambda: fastapi_render(db.get_cities()), db.get_cities_json),
+    ]
+    failed = False
+    for name, current, fast in cases:
+        current_time, current_body = best_time(current, args.repeat)
+        fast_time, fast_body = best_time(fast, args.repeat)
+        same = json.loads(current_body) == json.loads(fast_body)
+        failed = failed or not same
+        print(f"  {name:<18} прежний {current_time * 1000:8.1f} мс   fast_json {fast_time * 1000:8.1f} мс   "
+              f"x{current_time / fast_time:4.1f}   {len(fast_body)} байт   "
+              f"{'совпадает' if same else 'РАСХОЖДЕНИЕ'}")
+    db.pool.close()
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
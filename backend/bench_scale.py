@@ -0,0 +1,292 @@
+# bench_scale.py
+"""Бенчмарк масштабирования: загрузка и API на синтетических корпусах.
+
+Для каждого размера (по умолчанию 10 тыс., 100 тыс., 1 млн и 10 млн
+открыток) бенчмарк:
+
+    1. пишет книгу synth_corpus (готовая книга того же размера и seed
+       берется из каталога --dir повторно);
+    2. полностью загружает ее `python -m ingest --full` в отдельном
+       процессе: время, процессорное время и пиковый RSS (os.wait4 —
+       максимум по процессу загрузки и его воркерам), размер базы и снимка;
+    3. поднимает uvicorn app:app на этой базе (POSTCARDS_DB, POSTCARDS_EXCEL)
+       с выключенным кешем ответов и меряет задержку каждого эндпоинта
+       /api/* (с вариантами параметров): прогревочный запрос, затем
+       --repeat последовательных; p50, p95, максимум, размер ответа и
+       пиковый RSS сервера (VmHWM).
+
+Результаты после каждого размера дописываются в JSON (--out) вместе с
+коммитом, версиями и настройками, чтобы сравнивать выпуски:
+
+    python -m bench_scale run [--sizes 10000 100000] [--dir bench-data] [--out bench_scale.json]
+    python -m bench_scale compare old.json new.json [--threshold 1.2]
+
+Книга на 10 млн строк пишется около часа и занимает около гигабайта,
+загрузка такого корпуса — несколько часов.
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import platform
+import subprocess
+import statistics
+import httpx
+import synth_corpus
+import snapshot
+import facets
+from bench_concurrency import free_port, start_server
+
+RESULTS_VERSION = 1
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+# Запас на запуск сервера: миграции и сверка хеша книги на 10 млн строк
+SERVER_START_TIMEOUT = 900
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'sqlite': sqlite3.sqlite_version,
+        'numpy': facets.np.__version__ if facets.np is not None else None,
+        'pyarrow': snapshot.pa.__version__ if snapshot.pa is not None else None,
+    }
+
+
+def remove_database(db_path):
+    for path in (db_path, db_path + '-wal', db_path + '-shm', snapshot.default_path(db_path)):
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
+def run_ingest(excel_path, db_path, workers, log_path):
+    """Полная загрузка в отдельном процессе: время и пиковый RSS"""
+    remove_database(db_path)
+    command = [sys.executable, '-m', 'ingest', excel_path, '--db', db_path, '--full', '--force',
+               '--workers', str(workers)]
+    with open(log_path, 'w') as log:
+        started = time.perf_counter()
+        process = subprocess.Popen(command, cwd=BACKEND_DIR, stdout=log, stderr=subprocess.STDOUT)
+        # wait4 отдает ресурсы именно этого процесса (и его дождавшихся воркеров)
+        _, status, usage = os.wait4(process.pid, 0)
+        seconds = time.perf_counter() - started
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError(f"Загрузка {excel_path} завершилась с кодом {process.returncode}, см. {log_path}")
+
+    conn = sqlite3.connect(db_path)
+    try:
+        letters = conn.execute('SELECT COUNT(*) FROM letters').fetchone()[0]
+        cities = conn.execute('SELECT COUNT(*) FROM cities').fetchone()[0]
+    finally:
+        conn.close()
+    snapshot_path = snapshot.default_path(db_path)
+    return {
+        'seconds': round(seconds, 3),
+        'cpu_seconds': round(usage.ru_utime + usage.ru_stime, 3),
+        # ru_maxrss в Linux — в килобайтах
+        'peak_rss_bytes': usage.ru_maxrss * 1024,
+        'letters': letters,
+        'cities': cities,
+        'db_bytes': os.path.getsize(db_path),
+        'snapshot_bytes': os.path.getsize(snapshot_path) if snapshot_path and os.path.exists(snapshot_path) else None,
+    }
+
+
+def endpoint_paths(db_path):
+    """(имя, путь) для каждого эндпоинта /api/* с типичными вариантами параметров"""
+    conn = sqlite3.connect(db_path)
+    try:
+        city_id, latitude, longitude = conn.execute(
+            'SELECT id, latitude, longitude FROM cities WHERE latitude IS NOT NULL ORDER BY letter_count DESC LIMIT 1'
+        ).fetchone()
+        # Город целиком (all=true) — средний, около тысячи писем: крупнейший при 10 млн — сотни МБ JSON
+        middle_city_id = conn.execute('SELECT id FROM cities ORDER BY ABS(letter_count - 1000) LIMIT 1').fetchone()[0]
+        theme = conn.execute(
+            "SELECT value FROM letter_stats WHERE dimension = 'theme' ORDER BY count DESC LIMIT 1"
+        ).fetchone()[0]
+    finally:
+        conn.close()
+    bbox = f'{longitude - 5:.2f},{latitude - 5:.2f},{longitude + 5:.2f},{latitude + 5:.2f}'
+    return [
+        ('root', '/api/'),
+        ('cities', '/api/cities'),
+        ('cities_bbox', f'/api/cities?bbox={bbox}'),
+        ('clusters', '/api/cities/clusters?zoom=4'),
+        ('clusters_bbox', f'/api/cities/clusters?zoom=9&bbox={bbox}'),
+        ('city', f'/api/cities/{city_id}'),
+        ('city_by_year', f'/api/cities/{city_id}?sort=-year&limit=200'),
+        ('city_all', f'/api/cities/{middle_city_id}?all=true'),
+        ('statistics', '/api/statistics'),
+        ('timeline', '/api/timeline'),
+        ('timeline_cities', '/api/timeline?group=city&granularity=decade'),
+        ('timeline_theme', f'/api/timeline?theme={theme}&group=sentiment'),
+        ('facets', '/api/facets'),
+        ('facets_filters', f'/api/facets?theme={theme}&decade=1910&city_id={city_id}'),
+        ('connections', '/api/connections?min_count=2'),
+        ('connections_pairs', '/api/connections?directed=false'),
+        ('letters', '/api/letters'),
+        ('letters_filters', f'/api/letters?city_id={city_id}&theme={theme}&year_from=1900&year_to=1920'),
+        ('letters_bbox', f'/api/letters?bbox={bbox}'),
+        ('search', '/api/search?q=праздник'),
+        ('search_substring', '/api/search?q=раздник&mode=substring'),
+        ('search_fuzzy', '/api/search?q=празднек&mode=fuzzy'),
+        ('debug', '/api/debug'),
+        ('test_data', '/api/test-data'),
+    ]
+
+
+def peak_rss(pid):
+    """Пиковый RSS процесса по /proc (None вне Linux)"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def measure_endpoints(port, paths, repeat):
+    results = {}
+    # Без сжатия: меряем сервер и базу, а не brotli
+    with httpx.Client(base_url=f'http://127.0.0.1:{port}', timeout=600,
+                      headers={'Accept-Encoding': 'identity'}) as client:
+        for name, path in paths:
+            response = client.get(path)
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                response = client.get(path)
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            results[name] = {
+                'path': path,
+                'status': response.status_code,
+                'bytes': len(response.content),
+                'p50_ms': round(statistics.median(timings), 3),
+                'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 3),
+                'max_ms': round(timings[-1], 3),
+            }
+            print(f"  {name:<18} {results[name]['status']}  p50 {results[name]['p50_ms']:9.2f} мс   "
+                  f"p95 {results[name]['p95_ms']:9.2f} мс   {results[name]['bytes'] / 1e3:9.1f} КБ")
+    return results
+
+
+def run_size(rows, args):
+    result = {'rows': rows}
+    excel_path = os.path.join(args.dir, f'synthetic-{rows}-seed{args.seed}.xlsx')
+    db_path = os.path.join(args.dir, f'synthetic-{rows}.db')
+    if not os.path.exists(excel_path):
+        started = time.perf_counter()
+        synth_corpus.generate_workbook(excel_path, rows, args.seed)
+        result['generate_seconds'] = round(time.perf_counter() - started, 3)
+    result['xlsx_bytes'] = os.path.getsize(excel_path)
+    print(f"📝 {rows} открыток: {excel_path}, {result['xlsx_bytes'] / 1e6:.1f} МБ")
+
+    result['ingest'] = run_ingest(excel_path, db_path, args.workers, os.path.join(args.dir, f'ingest-{rows}.log'))
+    ingest = result['ingest']
+    print(f"📥 Загрузка: {ingest['seconds']:.1f} с, пиковый RSS {ingest['peak_rss_bytes'] / 1e6:.0f} МБ, "
+          f"база {ingest['db_bytes'] / 1e6:.0f} МБ, {ingest['letters']} писем, {ingest['cities']} городов")
+
+    port = free_port()
+    env = {'POSTCARDS_DB': os.path.abspath(db_path), 'POSTCARDS_EXCEL': os.path.abspath(excel_path)}
+    started = time.perf_counter()
+    server = start_server('app:app', port, env=env, timeout=SERVER_START_TIMEOUT)
+    try:
+        result['server'] = {'start_seconds': round(time.perf_counter() - started, 3)}
+        result['endpoints'] = measure_endpoints(port, endpoint_paths(db_path), args.repeat)
+        result['server']['peak_rss_bytes'] = peak_rss(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+    if not args.keep:
+        remove_database(db_path)
+    return result
+
+
+def run(args):
+    os.makedirs(args.dir, exist_ok=True)
+    report = {
+        'version': RESULTS_VERSION,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'environment': environment(),
+        'settings': {'repeat': args.repeat, 'workers': args.workers, 'seed': args.seed},
+        'results': [],
+    }
+    for rows in args.sizes:
+        report['results'].append(run_size(rows, args))
+        # Пишем после каждого размера: долгий прогон оставляет частичный результат
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"💾 Результаты: {args.out}")
+    return 0
+
+
+def compare(args):
+    """Сравнение двух файлов результатов; замедление больше threshold — код возврата 1"""
+    with open(args.old, encoding='utf-8') as f:
+        old = {result['rows']: result for result in json.load(f)['results']}
+    with open(args.new, encoding='utf-8') as f:
+        new = {result['rows']: result for result in json.load(f)['results']}
+
+    regressions = 0
+
+    def line(name, before, after, unit):
+        nonlocal regressions
+        if before is None or after is None:
+            return
+        ratio = after / before if before else float('inf')
+        slower = ratio > args.threshold
+        regressions += slower
+        print(f"  {'❌' if slower else '  '} {name:<22} {before:12.2f} → {after:12.2f} {unit}  ×{ratio:.2f}")
+
+    for rows in sorted(old.keys() & new.keys()):
+        print(f"📊 {rows} открыток")
+        line('ingest', old[rows]['ingest']['seconds'], new[rows]['ingest']['seconds'], 'с')
+        line('ingest peak RSS', old[rows]['ingest']['peak_rss_bytes'] / 1e6,
+             new[rows]['ingest']['peak_rss_bytes'] / 1e6, 'МБ')
+        for name, endpoint in new[rows].get('endpoints', {}).items():
+            before = old[rows].get('endpoints', {}).get(name)
+            if before is not None:
+                line(name, before['p50_ms'], endpoint['p50_ms'], 'мс')
+    print(f"{'❌' if regressions else '✅'} Замедлений больше ×{args.threshold}: {regressions}")
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк загрузки и API на синтетических корпусах")
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help="прогнать бенчмарк")
+    run_parser.add_argument('--sizes', type=int, nargs='+', default=list(synth_corpus.SIZES),
+                            help="размеры корпусов, открыток")
+    run_parser.add_argument('--dir', default='bench-data', help="каталог для книг и баз")
+    run_parser.add_argument('--out', default='bench_scale.json', help="файл результатов (JSON)")
+    run_parser.add_argument('--repeat', type=int, default=20, help="запросов к каждому эндпоинту")
+    run_parser.add_argument('--workers', type=int, default=1, help="процессов классификации при загрузке")
+    run_parser.add_argument('--seed', type=int, default=1)
+    run_parser.add_argument('--keep', action='store_true', help="не удалять базы после прогона")
+    compare_parser = commands.add_parser('compare', help="сравнить два файла результатов")
+    compare_parser.add_argument('old')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=1.2, help="допустимое замедление, раз")
+    args = parser.parse_args(argv)
+    return run(args) if args.command == 'run' else compare(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,133 @@
+# cache.py
+"""Кеш ответов API в памяти процесса.
+
+Данные меняются только при загрузке корпуса, поэтому ответы эндпоинтов
+чтения кешируются по ключу (эндпоинт, параметры, поколение данных).
+Загрузка увеличивает поколение (manifest.bump_generation), и старые записи
+просто перестают находиться, а затем вытесняются как самые давно
+использованные. В кеше лежит уже закодированный JSON (байты), который
+эндпоинт отдает клиенту, поэтому размер кеша ограничен суммарной длиной
+ответов без повторной сериализации; можно задать и время жизни записи.
+
+Настройки через переменные окружения:
+    POSTCARDS_CACHE_MAX_BYTES — предел объема, по умолчанию 64 МБ (0 — кеш выключен);
+    POSTCARDS_CACHE_TTL       — время жизни записи в секундах (по умолчанию без ограничения).
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+from database import db
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+class ResponseCache:
+    """Потокобезопасный LRU-кеш с вытеснением по объему и необязательным TTL"""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, ttl=None, generation=lambda: 0, sizeof=len):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.generation = generation
+        self.sizeof = sizeof
+        self._entries = OrderedDict()  # ключ -> (значение, размер, когда истекает)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'uncacheable': 0,
+        }
+
+    def get(self, endpoint, params, producer):
+        """Значение из кеша или producer(); None не кешируется (например, «не найдено»)"""
+        key = (endpoint, params, self.generation())
+        found, value = self._lookup(key)
+        if found:
+            return value
+        # Запрос к базе выполняем без блокировки: параллельные промахи по одному
+        # ключу посчитают значение дважды, но не задержат остальные запросы
+        value = producer()
+        self._store(key, value)
+        return value
+
+    async def get_async(self, endpoint, params, producer, generation):
+        """То же для асинхронных эндпоинтов: producer — корутинная функция,
+        generation — уже известное поколение (AsyncDatabase.generation)"""
+        key = (endpoint, params, generation)
+        found, value = self._lookup(key)
+        if found:
+            return value
+        value = await producer()
+        self._store(key, value)
+        return value
+
+    def _lookup(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, size, expires = entry
+                if expires is None or expires > now:
+                    self._entries.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return True, value
+                self._remove(key)
+                self._stats['expirations'] += 1
+            self._stats['misses'] += 1
+        return False, None
+
+    def _store(self, key, value):
+        if value is None or self.max_bytes <= 0:
+            return
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            with self._lock:
+                self._stats['uncacheable'] += 1
+            return
+
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, expires)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._stats['evictions'] += 1
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Счетчики попаданий, промахов и вытеснений, текущий объем"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            })
+        lookups = stats['hits'] + stats['misses']
+        stats.update({
+            'max_bytes': self.max_bytes,
+            'ttl': self.ttl,
+            'generation': self.generation(),
+            'hit_ratio': round(stats['hits'] / lookups, 3) if lookups else 0.0,
+        })
+        return stats
+
+
+_ttl = os.environ.get('POSTCARDS_CACHE_TTL')
+response_cache = ResponseCache(
+    max_bytes=int(os.environ.get('POSTCARDS_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES)),
+    ttl=float(_ttl) if _ttl else None,
+    generation=db.generation,
+)
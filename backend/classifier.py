@@ -0,0 +1,185 @@
+# classifier.py
+"""Определение темы и тональности писем по ключевым словам.
+
+Словари компилируются один раз в автомат Ахо–Корасик (pyahocorasick), и все
+совпадения тем и тональности находятся за один проход по тексту, вместо
+отдельной проверки `word in text` для каждого слова. Если pyahocorasick не
+установлен, используется поиск подстрок с теми же заранее собранными масками.
+"""
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+# Меняем при любом изменении словарей или правил — база будет перезагружена
+CLASSIFIER_VERSION = 1
+
+# Порядок тем — это приоритет: побеждает первая тема, слово которой нашлось
+THEME_KEYWORDS = [
+    ('любовь', ['любов', 'мил', 'дорог', 'целую', 'обнимаю', 'любим']),
+    ('семья', ['семь', 'мама', 'папа', 'брат', 'сестра', 'родител', 'дети']),
+    ('дружба', ['друг', 'товарищ', 'приятель', 'знаком']),
+    ('поздравление', ['поздрав', 'с праздником', 'христос воскресе', 'с пасхой']),
+    ('работа', ['работа', 'служб', 'дело', 'бизнес', 'заработ']),
+    ('учеба', ['учен', 'школ', 'урок', 'экзамен', 'учиться']),
+]
+DEFAULT_THEME = 'личное'
+
+POSITIVE_WORDS = ['рад', 'хорош', 'прекрасн', 'счастлив', 'любов', 'спасибо', 'здоров', 'успех', 'весел', 'приятн']
+NEGATIVE_WORDS = ['скуч', 'груст', 'тяжел', 'больн', 'плох', 'несчаст', 'жаль', 'умер', 'трудн', 'проблем']
+
+# Разделитель текстов в classify_many: в ключевых словах его нет, поэтому
+# совпадение не может захватить соседние письма
+BATCH_SEPARATOR = '\x00'
+
+
+class KeywordClassifier:
+    """Скомпилированный классификатор по словарям тем и тональности"""
+
+    def __init__(self, theme_keywords=THEME_KEYWORDS, positive_words=POSITIVE_WORDS,
+                 negative_words=NEGATIVE_WORDS, default_theme=DEFAULT_THEME, use_automaton=True):
+        self.default_theme = default_theme
+
+        # Каждое ключевое слово получает свой бит; темы и тональность — маски из этих битов
+        keywords = []
+        for _, words in theme_keywords:
+            keywords.extend(words)
+        keywords.extend(positive_words)
+        keywords.extend(negative_words)
+        self.bits = {}
+        for word in keywords:
+            self.bits.setdefault(word, 1 << len(self.bits))
+
+        self.theme_masks = [
+            (theme, self._mask(words)) for theme, words in theme_keywords
+        ]
+        self.positive_mask = self._mask(positive_words)
+        self.negative_mask = self._mask(negative_words)
+        self.theme_words = theme_keywords
+        self.sentiment_words = list(dict.fromkeys(list(positive_words) + list(negative_words)))
+        self.labels = {}
+
+        self.automaton = None
+        if use_automaton and ahocorasick is not None:
+            # Автомат сообщает обо всех вхождениях, в том числе перекрывающихся
+            self.automaton = ahocorasick.Automaton()
+            for word, bit in self.bits.items():
+                self.automaton.add_word(word, bit)
+            self.automaton.make_automaton()
+
+    @property
+    def engine(self):
+        return 'aho-corasick' if self.automaton is not None else 'substring'
+
+    def _mask(self, words):
+        mask = 0
+        for word in words:
+            mask |= self.bits[word]
+        return mask
+
+    def find_hits(self, content_lower):
+        """Битовая маска всех ключевых слов, встречающихся в тексте"""
+        found = 0
+        if self.automaton is not None:
+            for _, bit in self.automaton.iter(content_lower):
+                found |= bit
+            return found
+
+        # Без автомата: тональность требует всех слов, а темы проверяем до первой найденной
+        for word in self.sentiment_words:
+            if word in content_lower:
+                found |= self.bits[word]
+        for _, words in self.theme_words:
+            theme_found = 0
+            for word in words:
+                if word in content_lower:
+                    theme_found |= self.bits[word]
+            if theme_found:
+                found |= theme_found
+                break
+        return found
+
+    def _label(self, found):
+        """(тема, тональность) по маске найденных слов; результаты кешируются по маске"""
+        label = self.labels.get(found)
+        if label is not None:
+            return label
+
+        theme = self.default_theme
+        for candidate, mask in self.theme_masks:
+            if found & mask:
+                theme = candidate
+                break
+
+        pos_count = (found & self.positive_mask).bit_count()
+        neg_count = (found & self.negative_mask).bit_count()
+        if pos_count > neg_count:
+            sentiment = 'positive'
+        elif neg_count > pos_count:
+            sentiment = 'negative'
+        else:
+            sentiment = 'neutral'
+
+        label = self.labels[found] = (theme, sentiment)
+        return label
+
+    def classify(self, content):
+        """(тема, тональность) письма"""
+        if not content:
+            return self.default_theme, 'neutral'
+        return self._label(self.find_hits(content.lower()))
+
+    def classify_many(self, texts):
+        """[(тема, тональность)] для списка текстов, в том же порядке.
+
+        С автоматом тексты склеиваются через разделитель, которого нет в словарях,
+        и проходятся одним вызовом iter: совпадение относим к тексту по позиции
+        его конца. Так на пачку уходит один проход автомата, а не по вызову на письмо.
+        """
+        if self.automaton is None:
+            return [self.classify(text) for text in texts]
+
+        lowered = [text.lower() if text else '' for text in texts]
+        # Позиция разделителя после каждого текста в склеенной строке
+        ends = []
+        position = -1
+        for text in lowered:
+            position += len(text) + 1
+            ends.append(position)
+
+        found = [0] * len(lowered)
+        index = 0
+        for end, bit in self.automaton.iter(BATCH_SEPARATOR.join(lowered)):
+            while ends[index] < end:
+                index += 1
+            found[index] |= bit
+        label = self._label
+        return [label(mask) for mask in found]
+
+    def detect_theme(self, content):
+        """Определяем тему письма по содержанию"""
+        return self.classify(content)[0]
+
+    def analyze_sentiment(self, content):
+        """Анализ тональности текста"""
+        return self.classify(content)[1]
+
+
+# Общий экземпляр — словари компилируются один раз при импорте
+default_classifier = KeywordClassifier()
+
+
+def classify(content):
+    return default_classifier.classify(content)
+
+
+def classify_many(texts):
+    return default_classifier.classify_many(texts)
+
+
+def detect_theme(content):
+    return default_classifier.detect_theme(content)
+
+
+def analyze_sentiment(content):
+    return default_classifier.analyze_sentiment(content)
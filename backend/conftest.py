@@ -0,0 +1,14 @@
+# conftest.py
+"""Тесты работают с временной базой, а не с postcards.db из каталога backend.
+
+Переменные окружения задаем до импорта модулей сервера: database и ingest
+читают их при импорте. Excel по этому пути нет, поэтому db_init (импорт app)
+создает демо-данные.
+"""
+import os
+import tempfile
+
+_tmp = tempfile.mkdtemp(prefix='postcards-test-')
+os.environ['POSTCARDS_DB'] = os.path.join(_tmp, 'postcards.db')
+os.environ['POSTCARDS_EXCEL'] = os.path.join(_tmp, 'missing.xlsx')
+os.environ['POSTCARDS_SNAPSHOT'] = ''
@@ -1,76 +1,871 @@
 import sqlite3
 import os
+import time
+import queue
+import threading
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import manifest
+import search
+import geo
+import fast_json
+import timeline
+import facets
+
+# Настройки соединений для чтения
+READ_PRAGMAS = {
+    'mmap_size': 256 * 1024 * 1024,  # читаем файл через mmap, без копирования в буферы SQLite
+    'cache_size': -32768,            # 32 МБ кеша страниц на соединение
+    'temp_store': 'MEMORY',
+}
+
+
+# Как часто перечитываем поколение данных (секунды). Загрузка может идти в другом
+# процессе, поэтому кеш ответов узнает о ней не позже чем через этот интервал
+GENERATION_CHECK_INTERVAL = 1.0
+
+
+class DatabaseUnavailable(Exception):
+    """Запрос к базе не выполнился: база занята, повреждена или нет свободного соединения.
+
+    Пустой ответ вместо ошибки попал бы в кеш ответов и получил бы ETag текущего
+    поколения — клиенты видели бы его до следующей загрузки. app.py отвечает 503.
+    """
+
+
+# Запросы API. Планы всех запросов проверяет `python -m migrations --check`
+CITIES_SQL = 'SELECT * FROM cities'
+CITY_SQL = 'SELECT * FROM cities WHERE id = ?'
+# Письма, отправленные из города и полученные им (представление city_letters)
+CITY_LETTERS_SQL = 'SELECT * FROM city_letters WHERE city_id = ? ORDER BY id'
+# Статистика заранее посчитана при загрузке (letter_stats) — читаем несколько десятков строк
+STATISTICS_SQL = 'SELECT dimension, value, count FROM letter_stats'
+
+# Города внутри bbox по R*Tree city_rtree. R*Tree хранит координаты во float32
+# и округляет наружу, поэтому точную границу проверяем по самой таблице cities
+BBOX_CITIES_WHERE = '''
+    FROM city_rtree
+    JOIN cities ON cities.id = city_rtree.id
+    WHERE city_rtree.max_lat >= ? AND city_rtree.min_lat <= ?
+      AND city_rtree.max_lon >= ? AND city_rtree.min_lon <= ?
+      AND cities.latitude BETWEEN ? AND ? AND cities.longitude BETWEEN ? AND ?
+'''
+CITIES_BBOX_SQL = 'SELECT cities.* ' + BBOX_CITIES_WHERE
+BBOX_CITY_IDS_SQL = 'SELECT cities.id ' + BBOX_CITIES_WHERE
+
+
+def bbox_params(bbox):
+    """Параметры BBOX_CITIES_WHERE для bbox (запад, юг, восток, север) из geo.parse_bbox"""
+    west, south, east, north = bbox
+    return (south, north, west, east) * 2
+
+
+def bbox_letters_condition(bbox, table='letters'):
+    """Условие «город отправителя или получателя внутри bbox» и его параметры"""
+    return (f'({table}.from_city_id IN ({BBOX_CITY_IDS_SQL}) OR {table}.to_city_id IN ({BBOX_CITY_IDS_SQL}))',
+            bbox_params(bbox) * 2)
+
+
+# Полнотекстовый поиск: самые релевантные по BM25 (у отрывка вес меньше — он повторяет начало текста);
+# подстрока в любом месте текста — по триграммному индексу
+SEARCH_INDEXES = {
+    'letters_fts': (search.SNIPPET_TOKENS, 'bm25(letters_fts, 1.0, 0.2)'),
+    'letters_trigram': (search.TRIGRAM_SNIPPET_TOKENS, 'bm25(letters_trigram)'),
+}
+
+
+def search_sql(index, match, limit, offset=0, bbox=None):
+    """SQL и параметры поиска по индексу index ('letters_fts' или 'letters_trigram')"""
+    snippet_tokens, rank = SEARCH_INDEXES[index]
+    conditions = [f'{index} MATCH ?']
+    params = [match]
+    if bbox is not None:
+        condition, condition_params = bbox_letters_condition(bbox)
+        conditions.append(condition)
+        params.extend(condition_params)
+    sql = f'''
+        SELECT letters.*,
+               snippet({index}, 0, '{search.HIGHLIGHT_OPEN}', '{search.HIGHLIGHT_CLOSE}', '…', {snippet_tokens}) AS snippet,
+               {rank} AS rank
+        FROM {index}
+        JOIN letters ON letters.id = {index}.rowid
+        WHERE {' AND '.join(conditions)}
+        ORDER BY rank
+        LIMIT ? OFFSET ?
+    '''
+    return sql, (*params, limit, offset)
+
+
+SEARCH_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+
+# Кластеры маркеров в клетках видимой области (geo.bbox_cells); крупные первыми,
+# а LIMIT страхует от огромного bbox на крупном зуме
+CLUSTERS_SQL = '''
+    SELECT city_count, letter_count, latitude, longitude, south, west, north, east, city_id, name
+    FROM city_clusters
+    WHERE zoom = ? AND cell_x BETWEEN ? AND ? AND cell_y BETWEEN ? AND ?
+    ORDER BY letter_count DESC
+    LIMIT ?
+'''
+CLUSTERS_LIMIT = 1000
+CLUSTER_COLUMNS = ('city_count', 'letter_count', 'latitude', 'longitude', 'south', 'west', 'north', 'east',
+                   'city_id', 'name')
+
+# Поля писем города, которые можно запросить в /api/cities/{id}?fields=
+CITY_LETTER_FIELDS = ('id', 'city_id', 'source_key', 'from_city_id', 'to_city_id',
+                      'year', 'content', 'theme', 'sentiment', 'excerpt')
+# По умолчанию без полного текста: карточке города хватает отрывка
+CITY_LETTER_DEFAULT_FIELDS = ('id', 'year', 'theme', 'sentiment', 'excerpt')
+CITY_LETTER_SORTS = {
+    'id': 'id',
+    'year': 'year, id',
+    '-year': 'year DESC, id DESC',
+}
+CITY_LETTERS_LIMIT = 50
+CITY_LETTERS_MAX_LIMIT = 500
+
+LETTERS_PAGE_LIMIT = 50
+LETTERS_PAGE_MAX_LIMIT = 500
+
+
+def letters_page_sql(city_id=None, theme=None, sentiment=None, year_from=None, year_to=None, cursor=None,
+                     limit=LETTERS_PAGE_LIMIT, bbox=None):
+    """SQL и параметры одной страницы писем с фильтрами.
+
+    Пагинация по ключу: страница начинается после id последнего письма
+    предыдущей страницы (cursor), поэтому стоимость страницы не зависит от
+    ее номера, в отличие от OFFSET. С city_id письма берутся из представления
+    city_letters (у них есть поле city_id), без него — каждая открытка один раз.
+    bbox — только письма, у которых город отправителя или получателя в этой области.
+    """
+    conditions = []
+    params = []
+    for column, value in (('city_id', city_id), ('theme', theme), ('sentiment', sentiment)):
+        if value is not None:
+            conditions.append(f'{column} = ?')
+            params.append(value)
+    if year_from is not None:
+        conditions.append('year >= ?')
+        params.append(year_from)
+    if year_to is not None:
+        conditions.append('year <= ?')
+        params.append(year_to)
+    if cursor is not None:
+        conditions.append('id > ?')
+        params.append(cursor)
+    table = 'city_letters' if city_id is not None else 'letters'
+    if bbox is not None:
+        condition, condition_params = bbox_letters_condition(bbox, table)
+        conditions.append(condition)
+        params.extend(condition_params)
+
+    sql = f'SELECT * FROM {table}'
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += ' ORDER BY id LIMIT ?'
+    params.append(limit)
+    return sql, tuple(params)
+
+
+def parse_city_letter_fields(value):
+    """'id,year,excerpt' -> ('id', 'year', 'excerpt'); неизвестное поле — ValueError"""
+    fields = tuple(dict.fromkeys(field.strip() for field in value.split(',') if field.strip()))
+    unknown = [field for field in fields if field not in CITY_LETTER_FIELDS]
+    if not fields or unknown:
+        raise ValueError(f"Неизвестные поля: {', '.join(unknown) or repr(value)}; "
+                         f"допустимы: {', '.join(CITY_LETTER_FIELDS)}")
+    return fields
+
+
+def make_city_cursor(sort, year, letter_id):
+    """Курсор страницы писем города: 'id' или 'год:id' (год неизвестен — 'null:id')"""
+    if sort == 'id':
+        return str(letter_id)
+    return f"{'null' if year is None else year}:{letter_id}"
+
+
+def parse_city_cursor(sort, cursor):
+    """Обратное к make_city_cursor: (год, id); неверный курсор — ValueError"""
+    try:
+        if sort == 'id':
+            return None, int(cursor)
+        year, _, letter_id = cursor.partition(':')
+        return (None if year == 'null' else int(year)), int(letter_id)
+    except ValueError:
+        raise ValueError(f"Неверный курсор {cursor!r} для сортировки {sort}")
+
+
+def city_letters_sql(city_id, fields=CITY_LETTER_DEFAULT_FIELDS, sort='id', cursor=None, limit=CITY_LETTERS_LIMIT):
+    """SQL и параметры писем города: выбранные поля, сортировка и страница.
+
+    Пагинация по ключу, как в letters_page_sql: при сортировке по году ключ —
+    (year, id). Письма без года SQLite ставит раньше всех по возрастанию и
+    позже всех по убыванию. limit=None — все письма города одним ответом.
+    Первыми столбцами всегда идут id и year — из них строится курсор.
+    """
+    conditions = ['city_id = ?']
+    params = [city_id]
+    if cursor is not None:
+        year, last_id = parse_city_cursor(sort, cursor)
+        if sort == 'id':
+            conditions.append('id > ?')
+            params.append(last_id)
+        elif sort == 'year' and year is None:
+            conditions.append('(year IS NULL AND id > ? OR year IS NOT NULL)')
+            params.append(last_id)
+        elif sort == 'year':
+            conditions.append('(year, id) > (?, ?)')
+            params.extend([year, last_id])
+        elif year is None:
+            conditions.append('year IS NULL AND id < ?')
+            params.append(last_id)
+        else:
+            conditions.append('((year, id) < (?, ?) OR year IS NULL)')
+            params.extend([year, last_id])
+
+    sql = (f'SELECT id, year, {", ".join(fields)} FROM city_letters '
+           f'WHERE {" AND ".join(conditions)} ORDER BY {CITY_LETTER_SORTS[sort]}')
+    if limit is not None:
+        sql += ' LIMIT ?'
+        params.append(limit)
+    return sql, tuple(params)
+
+
+CONNECTIONS_LIMIT = 30
+CONNECTIONS_MAX_LIMIT = 1000
+
+# Крупнейшие города карты: с координатами, не меньше min_letters писем, первые top по числу писем
+TOP_CITIES_WHERE = '''
+    FROM cities
+    WHERE latitude IS NOT NULL AND longitude IS NOT NULL AND letter_count >= ?
+    ORDER BY letter_count DESC, id LIMIT ?
+'''
+TOP_CITIES_SQL = 'SELECT id ' + TOP_CITIES_WHERE
+TOP_CITY_ROWS_SQL = 'SELECT id, name, latitude, longitude, letter_count ' + TOP_CITIES_WHERE
+TOP_CITIES_MAX_LIMIT = 1000
+
+
+def connections_sql(min_count=1, city_ids=None, limit=CONNECTIONS_LIMIT, directed=True, with_letters=False,
+                    top_cities=None):
+    """SQL и параметры самых сильных связей из city_mentions.
+
+    directed=True — ребра «город → упомянутый город»; False — пары городов без
+    направления (source_id < target_id), счетчики обоих направлений суммируются.
+    city_ids — оставляем только связи, оба конца которых в списке.
+    top_cities — (min_letters, top): оба конца среди крупнейших городов карты
+    (TOP_CITIES_SQL); список городов собирает сама база.
+    """
+    conditions, params = [], []
+    if city_ids:
+        placeholders = ', '.join('?' * len(city_ids))
+        conditions.append(f'city_id IN ({placeholders}) AND mentioned_city_id IN ({placeholders})')
+        params.extend(city_ids)
+        params.extend(city_ids)
+    if top_cities:
+        conditions.append(f'city_id IN ({TOP_CITIES_SQL}) AND mentioned_city_id IN ({TOP_CITIES_SQL})')
+        params.extend(top_cities)
+        params.extend(top_cities)
+
+    if directed:
+        conditions.insert(0, 'count >= ?')
+        params.insert(0, min_count)
+        letters_column = ', letter_ids' if with_letters else ''
+        sql = (
+            f'SELECT city_id AS source_id, mentioned_city_id AS target_id, count{letters_column} '
+            f'FROM city_mentions WHERE {" AND ".join(conditions)} '
+            f'ORDER BY count DESC, source_id, target_id LIMIT ?'
+        )
+    else:
+        where = f'WHERE {" AND ".join(conditions)} ' if conditions else ''
+        letters_column = ', json_group_array(json(letter_ids)) AS letter_ids' if with_letters else ''
+        sql = (
+            f'SELECT MIN(city_id, mentioned_city_id) AS source_id, MAX(city_id, mentioned_city_id) AS target_id, '
+            f'SUM(count) AS count{letters_column} '
+            f'FROM city_mentions {where}'
+            f'GROUP BY source_id, target_id HAVING SUM(count) >= ? '
+            f'ORDER BY count DESC, source_id, target_id LIMIT ?'
+        )
+        params.append(min_count)
+    params.append(limit)
+    return sql, tuple(params)
+
+
+TIMELINE_CITIES_LIMIT = 10
+TIMELINE_CITIES_MAX_LIMIT = 100
+# Годы, если диапазон не задан; год 0 в кубе — итог по всем годам, он в ряды не входит
+TIMELINE_YEARS = (1, 9999)
+# Годы, которые есть в корпусе: дальше них ряд нулями не дополняем
+CORPUS_YEARS_SQL = "SELECT MIN(value), MAX(value) FROM letter_stats WHERE dimension = 'year'"
+
+
+def timeline_sql(group=None, theme=None, sentiment=None, city_id=None, year_from=None, year_to=None,
+                 limit=TIMELINE_CITIES_LIMIT):
+    """SQL и параметры клеток letter_cube: строки (ключ ряда, год, count).
+
+    Измерения без фильтра читаются из итоговых клеток куба. group раскладывает
+    ряд по темам, тональностям или крупнейшим (за все годы) городам — значения
+    тем и тональностей берем из letter_stats, так что каждая клетка читается
+    по первичному ключу.
+    """
+    theme = timeline.ALL_THEMES if theme is None else theme
+    sentiment = timeline.ALL_SENTIMENTS if sentiment is None else sentiment
+    city_id = timeline.ALL_CITIES if city_id is None else city_id
+    years = (
+        TIMELINE_YEARS[0] if year_from is None else max(year_from, TIMELINE_YEARS[0]),
+        TIMELINE_YEARS[1] if year_to is None else year_to,
+    )
+    if group == 'theme':
+        sql = (
+            "SELECT theme AS key, year, count FROM letter_cube "
+            "WHERE theme IN (SELECT value FROM letter_stats WHERE dimension = 'theme') "
+            "AND sentiment = ? AND city_id = ? AND year BETWEEN ? AND ?"
+        )
+        params = (sentiment, city_id, *years)
+    elif group == 'sentiment':
+        sql = (
+            "SELECT sentiment AS key, year, count FROM letter_cube "
+            "WHERE theme = ? AND sentiment IN (SELECT value FROM letter_stats WHERE dimension = 'sentiment') "
+            "AND city_id = ? AND year BETWEEN ? AND ?"
+        )
+        params = (theme, city_id, *years)
+    elif group == 'city':
+        sql = (
+            'SELECT city_id AS key, year, count FROM letter_cube '
+            'WHERE theme = ? AND sentiment = ? AND city_id IN ('
+            '    SELECT city_id FROM letter_cube WHERE theme = ? AND sentiment = ? AND year = ? AND city_id != ? '
+            '    ORDER BY count DESC, city_id LIMIT ?'
+            ') AND year BETWEEN ? AND ?'
+        )
+        params = (theme, sentiment, theme, sentiment, timeline.ALL_YEARS, timeline.ALL_CITIES, limit, *years)
+    else:
+        sql = (
+            'SELECT NULL AS key, year, count FROM letter_cube '
+            'WHERE theme = ? AND sentiment = ? AND city_id = ? AND year BETWEEN ? AND ?'
+        )
+        params = (theme, sentiment, city_id, *years)
+    return sql, params
+
+
+def facets_sql(dimension=None, filters=None, limit=facets.FACET_CITIES_LIMIT):
+    """SQL и параметры фасета dimension по letters (None — общее число писем).
+
+    Запасной путь /api/facets без индекса в памяти (facets.py): фильтр самого
+    измерения к его счетчикам не применяется. Фасет городов — по
+    представлению city_letters, письмо внутри одного города считается один раз.
+    """
+    filters = filters or {}
+    conditions = []
+    params = []
+    for name, column in (('theme', 'theme'), ('sentiment', 'sentiment'), ('decade', 'year - year % 10'),
+                         ('city', None)):
+        values = filters.get(name)
+        if not values or name == dimension:
+            continue
+        placeholders = ', '.join('?' * len(values))
+        if column is None:
+            conditions.append(f'(from_city_id IN ({placeholders}) OR to_city_id IN ({placeholders}))')
+            params.extend(values * 2)
+        else:
+            conditions.append(f'{column} IN ({placeholders})')
+            params.extend(values)
+    if filters.get('year_from') is not None:
+        conditions.append('year >= ?')
+        params.append(filters['year_from'])
+    if filters.get('year_to') is not None:
+        conditions.append('year <= ?')
+        params.append(filters['year_to'])
+
+    if dimension == 'city':
+        select, table = 'city_id, COUNT(*)', 'city_letters'
+        group = ' GROUP BY city_id ORDER BY COUNT(*) DESC, city_id LIMIT ?'
+    elif dimension == 'decade':
+        select, table, group = 'year - year % 10, COUNT(*)', 'letters', ' GROUP BY 1'
+        conditions.append('year IS NOT NULL')
+    elif dimension is not None:
+        select, table, group = f'{dimension}, COUNT(*)', 'letters', f' GROUP BY {dimension}'
+    else:
+        select, table, group = 'COUNT(*)', 'letters', ''
+    sql = f'SELECT {select} FROM {table}'
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += group
+    if dimension == 'city':
+        params.append(limit)
+    return sql, tuple(params)
+
+
+def facets_from_sqlite(conn, filters, city_limit=facets.FACET_CITIES_LIMIT):
+    """Те же фасеты, что CorpusIndex.facets, подсчетом в SQLite"""
+    return {
+        'total': conn.execute(*facets_sql(None, filters)).fetchone()[0],
+        'facets': {
+            dimension: [tuple(row) for row in conn.execute(*facets_sql(dimension, filters, city_limit))]
+            for dimension in facets.DIMENSIONS
+        },
+    }
+
+
+# имя: (SQL, пример параметров, допустим ли полный просмотр таблицы)
+API_QUERIES = {
+    'cities': (CITIES_SQL, (), True),  # список всех городов — просмотр таблицы неизбежен
+    'city': (CITY_SQL, (1,), False),
+    'city_letters': (CITY_LETTERS_SQL, (1,), False),
+    'city_letters_page': city_letters_sql(1, cursor='10') + (False,),
+    'city_letters_year': city_letters_sql(1, sort='year', cursor='1913:10') + (False,),
+    'city_letters_year_desc': city_letters_sql(1, sort='-year', cursor='1913:10') + (False,),
+    'statistics': (STATISTICS_SQL, (), True),
+    'clusters': (CLUSTERS_SQL, (5, 10, 20, 5, 15, CLUSTERS_LIMIT), False),
+    'search': search_sql('letters_fts', '"одесс"*', SEARCH_LIMIT) + (False,),
+    'search_substring': search_sql('letters_trigram', '"десс"', SEARCH_LIMIT) + (False,),
+    'search_bbox': search_sql('letters_fts', '"одесс"*', SEARCH_LIMIT, bbox=(30, 45, 32, 47)) + (False,),
+    'cities_bbox': (CITIES_BBOX_SQL, bbox_params((30, 45, 40, 60)), False),
+    'search_fuzzy_terms': (
+        'SELECT term, COUNT(*) FROM search_trigrams WHERE trigram IN (?, ?) AND length BETWEEN ? AND ? GROUP BY term',
+        ('  о', ' од', 5, 7), False
+    ),
+    'connections': connections_sql(min_count=2) + (False,),
+    'connections_cities': connections_sql(city_ids=[1, 2, 3]) + (False,),
+    'connections_top': connections_sql(directed=False, top_cities=(3, 80)) + (False,),
+    'top_cities': (TOP_CITIES_SQL, (3, 80), False),
+    'top_city_rows': (TOP_CITY_ROWS_SQL, (3, 80), False),
+    # Пары без направления группируются по всей таблице — она в разы меньше letters
+    'connections_pairs': connections_sql(directed=False) + (True,),
+    'timeline': timeline_sql() + (False,),
+    'corpus_years': (CORPUS_YEARS_SQL, (), False),
+    'timeline_filters': timeline_sql(theme='семья', sentiment='positive', city_id=1, year_from=1900) + (False,),
+    'timeline_themes': timeline_sql(group='theme', city_id=1) + (False,),
+    'timeline_sentiments': timeline_sql(group='sentiment', theme='семья') + (False,),
+    'timeline_cities': timeline_sql(group='city', theme='семья') + (False,),
+    'letters_page': letters_page_sql(cursor=0) + (False,),
+    'letters_page_city': letters_page_sql(city_id=1, cursor=0) + (False,),
+    'letters_page_theme': letters_page_sql(theme='семья', cursor=0) + (False,),
+    'letters_page_bbox': letters_page_sql(cursor=0, bbox=(30, 45, 32, 47)) + (False,),
+    'letters_page_filters': letters_page_sql(city_id=1, theme='семья', sentiment='positive',
+                                             year_from=1900, year_to=1920, cursor=0) + (False,),
+    # Запасной путь фасетов без numpy: без фильтров это агрегаты по всем письмам
+    'facets_total': facets_sql(None, {'theme': ['семья'], 'year_from': 1900}) + (True,),
+    'facets_decades': facets_sql('decade', {'city': [1, 2]}) + (True,),
+    'facets_cities': facets_sql('city', {'theme': ['семья'], 'sentiment': ['positive']}) + (True,),
+}
+
+
+class ConnectionPool:
+    """Потокобезопасный пул постоянных соединений SQLite только для чтения.
+
+    FastAPI выполняет синхронные эндпоинты в пуле потоков, поэтому вместо
+    sqlite3.connect на каждый запрос соединение берется из пула и
+    возвращается обратно. Соединения создаются лениво, не больше size штук;
+    если все заняты, запрос ждет свободное до timeout секунд.
+    """
+
+    def __init__(self, db_path, size=8, timeout=30.0, read_only=False, immutable=False):
+        self.db_path = db_path
+        self.size = size
+        self.timeout = timeout
+        self.read_only = read_only or immutable
+        # immutable — замороженный снимок: SQLite не проверяет изменения файла и не берет блокировки
+        self.immutable = immutable
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._stats = {
+            'acquired': 0,
+            'waits': 0,
+            'wait_seconds': 0.0,
+            'max_wait_seconds': 0.0,
+            'busy_seconds': 0.0,
+            'max_busy_seconds': 0.0,
+        }
+
+    def _uri(self):
+        path = os.path.abspath(self.db_path)
+        if self.immutable:
+            return f'file:{path}?mode=ro&immutable=1'
+        if self.read_only:
+            return f'file:{path}?mode=ro'
+        return f'file:{path}'
+
+    def _connect(self):
+        conn = sqlite3.connect(self._uri(), uri=True, check_same_thread=False, timeout=self.timeout)
+        conn.row_factory = sqlite3.Row
+        if not self.read_only:
+            # WAL: читатели не блокируют загрузку корпуса и не блокируются ею.
+            # Обычно база уже в WAL после загрузки; если файл занят, читаем как есть.
+            try:
+                conn.execute('PRAGMA journal_mode = WAL')
+            except sqlite3.OperationalError:
+                pass
+        for name, value in READ_PRAGMAS.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+        conn.execute('PRAGMA query_only = ON')
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait(), False
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if can_create:
+            try:
+                return self._connect(), False
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=self.timeout), True
+        except queue.Empty:
+            raise TimeoutError(f"Нет свободного соединения с БД за {self.timeout} с")
+
+    @contextmanager
+    def connection(self):
+        """Берем соединение из пула на время блока with"""
+        started = time.perf_counter()
+        conn, waited = self._acquire()
+        acquired = time.perf_counter()
+        try:
+            yield conn
+        finally:
+            # Незавершенное чтение держит снимок WAL — закрываем его перед возвратом
+            if conn.in_transaction:
+                conn.rollback()
+            busy = time.perf_counter() - acquired
+            wait = acquired - started
+            self._idle.put(conn)
+            with self._lock:
+                stats = self._stats
+                stats['acquired'] += 1
+                if waited:
+                    stats['waits'] += 1
+                stats['wait_seconds'] += wait
+                stats['max_wait_seconds'] = max(stats['max_wait_seconds'], wait)
+                stats['busy_seconds'] += busy
+                stats['max_busy_seconds'] = max(stats['max_busy_seconds'], busy)
+
+    def stats(self):
+        """Размер пула и время ожидания/работы соединений — чтобы подобрать size"""
+        with self._lock:
+            stats = dict(self._stats)
+            created = self._created
+        idle = self._idle.qsize()
+        acquired = stats['acquired'] or 1
+        stats.update({
+            'size': self.size,
+            'created': created,
+            'idle': idle,
+            'in_use': created - idle,
+            'read_only': self.read_only,
+            'immutable': self.immutable,
+            'avg_wait_ms': round(stats['wait_seconds'] / acquired * 1000, 3),
+            'avg_busy_ms': round(stats['busy_seconds'] / acquired * 1000, 3),
+        })
+        return stats
+
+    def close(self):
+        """Закрываем свободные соединения (занятые закроются при возврате в новый пул)"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
 
 class Database:
-    def __init__(self, db_path="postcards.db"):
+    def __init__(self, db_path="postcards.db", pool_size=8, read_only=False, immutable=False):
         self.db_path = db_path
+        self.pool = ConnectionPool(db_path, size=pool_size, read_only=read_only, immutable=immutable)
+        self._generation = 0
+        self._generation_checked = None
+
+    def connection(self):
+        return self.pool.connection()
+
+    def generation_is_stale(self):
+        return (self._generation_checked is None
+                or time.monotonic() - self._generation_checked >= GENERATION_CHECK_INTERVAL)
+
+    def generation(self):
+        """Поколение данных; в базу заглядываем не чаще раза в GENERATION_CHECK_INTERVAL"""
+        if self.generation_is_stale():
+            self._generation_checked = time.monotonic()
+            try:
+                with self.connection() as conn:
+                    self._generation = manifest.read_generation(conn)
+            except Exception as e:
+                print(f"❌ Ошибка чтения поколения данных: {e}")
+        return self._generation
+
+    def pool_stats(self):
+        return self.pool.stats()
     
     def get_cities(self):
         try:
-            conn = sqlite3.connect(self.db_path)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            
-            cursor.execute('SELECT * FROM cities')
-            cities = [dict(row) for row in cursor.fetchall()]
-            
-            conn.close()
+            with self.connection() as conn:
+                cursor = conn.execute(CITIES_SQL)
+                cities = [dict(row) for row in cursor.fetchall()]
             return cities
         except Exception as e:
             print(f"❌ Ошибка загрузки городов: {e}")
-            return []
+            raise DatabaseUnavailable(str(e)) from e
     
     def get_city_detail(self, city_id):
         try:
-            conn = sqlite3.connect(self.db_path)
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            
-            cursor.execute('SELECT * FROM cities WHERE id = ?', (city_id,))
-            city_row = cursor.fetchone()
-            city = dict(city_row) if city_row else None
+            with self.connection() as conn:
+                cursor = conn.cursor()
+                
+                cursor.execute(CITY_SQL, (city_id,))
+                city_row = cursor.fetchone()
+                city = dict(city_row) if city_row else None
+                
+                if city:
+                    cursor.execute(CITY_LETTERS_SQL, (city_id,))
+                    letters = [dict(row) for row in cursor.fetchall()]
+                    city['letters'] = letters
             
-            if city:
-                cursor.execute('SELECT * FROM letters WHERE city_id = ?', (city_id,))
-                letters = [dict(row) for row in cursor.fetchall()]
-                city['letters'] = letters
-            
-            conn.close()
             return city
         except Exception as e:
             print(f"❌ Ошибка загрузки деталей города: {e}")
-            return None
+            raise DatabaseUnavailable(str(e)) from e
     
+    def get_cities_json(self, bbox=None):
+        """Список городов (или только внутри bbox) сразу в JSON (байты) — для ответа API без промежуточных dict"""
+        sql, params = (CITIES_SQL, ()) if bbox is None else (CITIES_BBOX_SQL, bbox_params(bbox))
+        try:
+            with self.connection() as conn:
+                return fast_json.json_array(conn, sql, params)
+        except Exception as e:
+            print(f"❌ Ошибка загрузки городов: {e}")
+            raise DatabaseUnavailable(str(e)) from e
+
+    def get_city_detail_json(self, city_id, fields=CITY_LETTER_DEFAULT_FIELDS, sort='id', cursor=None,
+                             limit=CITY_LETTERS_LIMIT):
+        """Город со страницей писем сразу в JSON (байты) или None, если города нет.
+
+        В ответе next_cursor — курсор следующей страницы (None на последней).
+        limit=None — все письма города.
+        """
+        if limit is not None:
+            limit = max(1, min(limit, CITY_LETTERS_MAX_LIMIT))
+        sql, params = city_letters_sql(city_id, fields, sort, cursor, limit)
+        try:
+            with self.connection() as conn:
+                cursor = fast_json.tuple_cursor(conn).execute(CITY_SQL, (city_id,))
+                row = cursor.fetchone()
+                if row is None:
+                    return None
+                city = dict(zip(fast_json.column_names(cursor), row))
+                rows = cursor.execute(sql, params).fetchall()
+            city['letters'] = [dict(zip(fields, row[2:])) for row in rows]
+            city['next_cursor'] = (
+                make_city_cursor(sort, rows[-1][1], rows[-1][0])
+                if limit is not None and len(rows) == limit else None
+            )
+            return fast_json.dumps(city)
+        except Exception as e:
+            print(f"❌ Ошибка загрузки деталей города: {e}")
+            raise DatabaseUnavailable(str(e)) from e
+
+    def get_clusters_json(self, zoom, cells, top_cities=None):
+        """Кластеры городов зума zoom в диапазоне клеток (x0, x1, y0, y1) сразу в JSON (байты).
+
+        top_cities — (min_letters, top): кластеры только из крупнейших городов карты
+        (TOP_CITIES_SQL). Их не больше TOP_CITIES_MAX_LIMIT, поэтому такие кластеры
+        считаем на лету, а не читаем из city_clusters.
+        """
+        try:
+            with self.connection() as conn:
+                if top_cities is None:
+                    return fast_json.json_array(conn, CLUSTERS_SQL, (zoom, *cells, CLUSTERS_LIMIT))
+                cities = fast_json.tuple_cursor(conn).execute(TOP_CITY_ROWS_SQL, top_cities).fetchall()
+        except Exception as e:
+            print(f"❌ Ошибка загрузки кластеров: {e}")
+            raise DatabaseUnavailable(str(e)) from e
+        x0, x1, y0, y1 = cells
+        clusters = [
+            row[3:] for row in geo.cluster_cities(cities, zoom)
+            if x0 <= row[1] <= x1 and y0 <= row[2] <= y1
+        ]
+        clusters.sort(key=lambda row: -row[1])
+        return fast_json.dumps([dict(zip(CLUSTER_COLUMNS, row)) for row in clusters[:CLUSTERS_LIMIT]])
+
+    def get_connections(self, min_count=1, city_ids=None, limit=CONNECTIONS_LIMIT, directed=True, with_letters=False,
+                        top_cities=None, with_cities=False):
+        """Самые сильные связи городов по упоминаниям в письмах.
+
+        with_cities=True — у связи есть source и target: id, название и координаты городов.
+        """
+        limit = max(1, min(limit, CONNECTIONS_MAX_LIMIT))
+        sql, params = connections_sql(min_count, city_ids, limit, directed, with_letters, top_cities)
+        cities = {}
+        try:
+            with self.connection() as conn:
+                connections = [dict(row) for row in conn.execute(sql, params)]
+                if with_cities and connections:
+                    ids = sorted({c['source_id'] for c in connections} | {c['target_id'] for c in connections})
+                    placeholders = ', '.join('?' * len(ids))
+                    cities = {
+                        row['id']: dict(row) for row in conn.execute(
+                            f'SELECT id, name, latitude, longitude FROM cities WHERE id IN ({placeholders})', ids
+                        )
+                    }
+        except Exception as e:
+            print(f"❌ Ошибка загрузки связей: {e}")
+            raise DatabaseUnavailable(str(e)) from e
+        if with_cities:
+            for connection in connections:
+                connection['source'] = cities.get(connection['source_id'])
+                connection['target'] = cities.get(connection['target_id'])
+        if with_letters:
+            for connection in connections:
+                letter_ids = fast_json.loads(connection['letter_ids'])
+                if not directed:
+                    # Массив массивов id — по одному на каждое направление
+                    letter_ids = sorted(letter_id for group in letter_ids for letter_id in group)
+                connection['letter_ids'] = letter_ids
+        return connections
+
+    def get_timeline(self, group=None, theme=None, sentiment=None, city_id=None, year_from=None, year_to=None,
+                     granularity='year', limit=TIMELINE_CITIES_LIMIT):
+        """Ряды числа писем по годам или десятилетиям из куба letter_cube"""
+        limit = max(1, min(limit or TIMELINE_CITIES_LIMIT, TIMELINE_CITIES_MAX_LIMIT))
+        sql, params = timeline_sql(group, theme, sentiment, city_id, year_from, year_to, limit)
+        names = {}
+        try:
+            with self.connection() as conn:
+                rows = [tuple(row) for row in conn.execute(sql, params)]
+                corpus_years = tuple(conn.execute(CORPUS_YEARS_SQL).fetchone())
+                if group == 'city' and rows:
+                    city_ids = sorted({key for key, _, _ in rows})
+                    placeholders = ', '.join('?' * len(city_ids))
+                    names = dict(conn.execute(f'SELECT id, name FROM cities WHERE id IN ({placeholders})', city_ids))
+        except Exception as e:
+            print(f"❌ Ошибка загрузки временного ряда: {e}")
+            raise DatabaseUnavailable(str(e)) from e
+
+        periods, series = timeline.build_series(rows, granularity, year_from, year_to, corpus_years)
+        if group == 'city':
+            for item in series:
+                item['name'] = names.get(item['key'])
+        return {
+            "group": group,
+            "granularity": granularity,
+            "filters": {
+                "theme": theme, "sentiment": sentiment, "city_id": city_id,
+                "year_from": year_from, "year_to": year_to,
+            },
+            "periods": periods,
+            "series": series,
+        }
+
+    def get_facets(self, filters, city_limit=facets.FACET_CITIES_LIMIT):
+        """Число писем по темам, тональностям, десятилетиям и городам для фильтров.
+
+        Считает колоночный индекс в памяти (facets.facet_index), а без него — SQLite.
+        """
+        city_limit = max(1, min(city_limit, facets.FACET_CITIES_MAX_LIMIT))
+        index = facets.facet_index.current(self)
+        try:
+            with self.connection() as conn:
+                if index is not None:
+                    result, source = index.facets(filters, city_limit), 'index'
+                else:
+                    result, source = facets_from_sqlite(conn, filters, city_limit), 'sqlite'
+                city_ids = [city_id for city_id, _ in result['facets']['city']]
+                placeholders = ', '.join('?' * len(city_ids))
+                names = dict(conn.execute(
+                    f'SELECT id, name FROM cities WHERE id IN ({placeholders})', city_ids
+                )) if city_ids else {}
+        except Exception as e:
+            print(f"❌ Ошибка подсчета фасетов: {e}")
+            raise DatabaseUnavailable(str(e)) from e
+
+        response = {'filters': filters, 'total': result['total'], 'source': source, 'facets': {}}
+        for dimension in facets.DIMENSIONS:
+            counts = facets.sort_counts(dimension, result['facets'][dimension])
+            response['facets'][dimension] = [
+                {'value': value, 'name': names.get(value), 'count': count} if dimension == 'city'
+                else {'value': value, 'count': count}
+                for value, count in counts
+            ]
+        return response
+
+    def get_letters(self, city_id=None, theme=None, sentiment=None, year_from=None, year_to=None,
+                    cursor=None, limit=LETTERS_PAGE_LIMIT, bbox=None):
+        """Страница писем с фильтрами. Возвращает (письма, курсор следующей страницы или None)"""
+        limit = max(1, min(limit, LETTERS_PAGE_MAX_LIMIT))
+        sql, params = letters_page_sql(city_id, theme, sentiment, year_from, year_to, cursor, limit, bbox)
+        try:
+            with self.connection() as conn:
+                letters = [dict(row) for row in conn.execute(sql, params)]
+        except Exception as e:
+            print(f"❌ Ошибка загрузки писем: {e}")
+            raise DatabaseUnavailable(str(e)) from e
+        next_cursor = letters[-1]['id'] if len(letters) == limit else None
+        return letters, next_cursor
+
+    def search_letters(self, q, limit=SEARCH_LIMIT, offset=0, mode='words', bbox=None):
+        """Поиск писем в режиме из search.SEARCH_MODES; bbox — только письма городов в этой области.
+
+        Возвращает (письма со snippet и rank, смещение следующей страницы или None).
+        """
+        limit = max(1, min(limit, SEARCH_MAX_LIMIT))
+        try:
+            with self.connection() as conn:
+                index, match = 'letters_fts', None
+                if mode == 'substring':
+                    match = search.substring_query(q)
+                    if match is not None:
+                        index = 'letters_trigram'
+                elif mode == 'fuzzy':
+                    match = search.fuzzy_query(conn, q)
+                if match is None and mode != 'fuzzy':
+                    # Слова, а также слишком короткие для триграмм подстроки — по началу слова
+                    match = search.fts_query(q)
+                if match is None:
+                    return [], None
+                sql, params = search_sql(index, match, limit, offset, bbox)
+                results = [dict(row) for row in conn.execute(sql, params)]
+        except Exception as e:
+            print(f"❌ Ошибка поиска: {e}")
+            raise DatabaseUnavailable(str(e)) from e
+        next_offset = offset + limit if len(results) == limit else None
+        return results, next_offset
+
     # database.py
     def get_statistics(self):
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # Вместо COUNT(*) из letters, считаем уникальные письма
-            cursor.execute('SELECT COUNT(DISTINCT content) FROM letters WHERE content != ""')
-            total_letters = cursor.fetchone()[0]
-            
-            # Альтернативный метод: если хотите точнее считать
-            # cursor.execute('SELECT COUNT(*) FROM (SELECT DISTINCT content, year FROM letters WHERE content != "")')
-            # total_letters = cursor.fetchone()[0]
-            
-            cursor.execute('SELECT COUNT(*) FROM cities')
-            total_cities = cursor.fetchone()[0]
-            
-            # Для тем и тональности используем DISTINCT
-            cursor.execute('SELECT theme, COUNT(DISTINCT content) FROM letters WHERE content != "" GROUP BY theme')
-            themes = [{"theme": row[0] or "другое", "count": row[1]} for row in cursor.fetchall()]
-            
-            cursor.execute('SELECT sentiment, COUNT(DISTINCT content) FROM letters WHERE content != "" GROUP BY sentiment')
-            sentiments = [{"sentiment": row[0] or "neutral", "count": row[1]} for row in cursor.fetchall()]
-            
-            cursor.execute('SELECT MIN(year), MAX(year) FROM letters WHERE year IS NOT NULL')
-            year_range = cursor.fetchone()
-            years_range = [year_range[0] or 1900, year_range[1] or 1950]
-            
-            conn.close()
-            
+            with self.connection() as conn:
+                rows = conn.execute(STATISTICS_SQL).fetchall()
+
+            totals = {}
+            themes = []
+            sentiments = []
+            years = []
+            for dimension, value, count in rows:
+                if dimension == 'total':
+                    totals[value] = count
+                elif dimension == 'theme':
+                    themes.append({"theme": value, "count": count})
+                elif dimension == 'sentiment':
+                    sentiments.append({"sentiment": value, "count": count})
+                elif dimension == 'year':
+                    years.append(value)
+            total_letters = totals.get('letters', 0)
+            total_cities = totals.get('cities', 0)
+            years_range = [min(years), max(years)] if years else [1900, 1950]
+
             return {
                 "total_letters": total_letters,
                 "total_cities": total_cities,
@@ -80,13 +875,92 @@ class Database:
             }
         except Exception as e:
             print(f"❌ Ошибка загрузки статистики: {e}")
-            return {
-                "total_letters": 0,
-                "total_cities": 0,
-                "years_range": [1900, 1950],
-                "popular_themes": [],
-                "sentiment_distribution": []
-            }
+            raise DatabaseUnavailable(str(e)) from e
+
+class AsyncDatabase:
+    """Асинхронный доступ к Database для async-эндпоинтов.
+
+    Запросы выполняются в собственном пуле потоков размером с пул соединений:
+    у каждого потока всегда есть свободное соединение, а ожидающие запросы
+    стоят в очереди исполнителя, не занимая ни потоков, ни соединений. Так
+    цикл событий uvicorn держит сколько угодно медленных клиентов, а к SQLite
+    одновременно обращаются не больше pool.size запросов.
+    """
+
+    def __init__(self, database):
+        self.database = database
+        self.workers = database.pool.size
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='sqlite-reader')
+        self._lock = threading.Lock()
+        self._stats = {'submitted': 0, 'pending': 0, 'max_pending': 0}
+
+    async def run(self, func, *args):
+        """Выполняем синхронную функцию в пуле читателей"""
+        with self._lock:
+            self._stats['submitted'] += 1
+            self._stats['pending'] += 1
+            self._stats['max_pending'] = max(self._stats['max_pending'], self._stats['pending'])
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(func, *args))
+        finally:
+            with self._lock:
+                self._stats['pending'] -= 1
+
+    async def generation(self):
+        # Пока значение свежее, в пул потоков не ходим
+        if not self.database.generation_is_stale():
+            return self.database.generation()
+        return await self.run(self.database.generation)
+
+    async def get_cities_json(self, bbox=None):
+        return await self.run(self.database.get_cities_json, bbox)
+
+    async def get_city_detail_json(self, city_id, *args):
+        return await self.run(self.database.get_city_detail_json, city_id, *args)
+
+    async def get_clusters_json(self, zoom, cells, top_cities=None):
+        return await self.run(self.database.get_clusters_json, zoom, cells, top_cities)
+
+    async def run_json(self, func, *args):
+        """Результат func сразу в JSON (байты) — кодируем в том же потоке пула, а в кеш
+        ответов кладем ровно то, что уйдет клиенту"""
+        return await self.run(lambda: fast_json.dumps(func(*args)))
+
+    async def get_statistics_json(self):
+        return await self.run_json(self.database.get_statistics)
+
+    async def get_connections_json(self, *args):
+        return await self.run_json(self.database.get_connections, *args)
+
+    async def get_timeline_json(self, *args):
+        return await self.run_json(self.database.get_timeline, *args)
+
+    async def get_facets_json(self, *args):
+        return await self.run_json(self.database.get_facets, *args)
+
+    async def get_letters(self, *args):
+        return await self.run(self.database.get_letters, *args)
+
+    async def search_letters(self, *args):
+        return await self.run(self.database.search_letters, *args)
+
+    def stats(self):
+        """Очередь запросов к пулу читателей"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['workers'] = self.workers
+        return stats
+
 
-# Создаем глобальный экземпляр БД
-db = Database()
\ No newline at end of file
+# Создаем глобальный экземпляр БД.
+# POSTCARDS_DB — путь к базе, POSTCARDS_DB_MODE: rw (по умолчанию), ro — только чтение,
+# immutable — замороженный снимок
+_db_mode = os.environ.get('POSTCARDS_DB_MODE', 'rw')
+db = Database(
+    os.environ.get('POSTCARDS_DB', 'postcards.db'),
+    pool_size=int(os.environ.get('POSTCARDS_DB_POOL_SIZE', 8)),
+    read_only=_db_mode == 'ro',
+    immutable=_db_mode == 'immutable',
+)
+adb = AsyncDatabase(db)
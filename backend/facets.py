@@ -0,0 +1,324 @@
+# facets.py
+"""Колоночный индекс корпуса в памяти процесса для /api/facets.
+
+Фасетный поиск: для любого сочетания фильтров (темы, тональности,
+десятилетия, города, диапазон лет) — сколько писем в каждой теме,
+тональности, десятилетии и городе. На письмо индекс держит несколько байт:
+
+    years                  — int16, 0 если год неизвестен
+    from_cities, to_cities — uint16 (int32 при 65536+ городах), номер
+                             города в city_ids, 0 — города нет
+
+и для каждой темы, тональности и десятилетия — битовую карту писем
+(np.packbits, бит на письмо; номера тем и тональностей целиком заменены
+картами). Фильтр — OR карт значений внутри измерения и AND между
+измерениями, подсчет — popcount по таблице на 256 значений: операции над
+n/8 байтами без строк SQLite и без цикла Python по письмам. Своих карт у
+городов нет (их тысячи): фильтр по городу — сравнение колонок, счетчики
+городов — np.bincount по отобранным письмам.
+
+Как принято в фасетном поиске, счетчики измерения считаются без его
+собственного фильтра: при theme=любовь в фасете тем видны и остальные
+темы — столько писем прибавится, если выбрать их тоже. Письмо внутри
+одного города считается у него один раз, как в letter_stats.
+
+Индекс строится при старте сервера — из снимка postcards.arrow, если он
+того же поколения, иначе из letters — и перестраивается, когда меняется
+поколение данных. Нужен numpy; без него или с POSTCARDS_FACET_INDEX=0
+/api/facets отвечает теми же числами из SQLite (GROUP BY по letters).
+
+    python -m facets [--db postcards.db] [--theme семья] [--decade 1910] [--city-id 1] [--check]
+"""
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import threading
+import manifest
+import snapshot
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+ENABLED = os.environ.get('POSTCARDS_FACET_INDEX', '1') != '0'
+BATCH_ROWS = 64 * 1024
+BITMAP_DIMENSIONS = ('theme', 'sentiment', 'decade')
+DIMENSIONS = BITMAP_DIMENSIONS + ('city',)
+FACET_CITIES_LIMIT = 20
+FACET_CITIES_MAX_LIMIT = 500
+
+# Число единичных битов в каждом байте
+POPCOUNT = None if np is None else np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def _snapshot_codes(column):
+    """Колонка-словарь снимка -> (номера int8, значения); NULL — последнее значение None"""
+    values = column.chunk(0).dictionary.to_pylist() if column.num_chunks else []
+    null_code = len(values)
+    values.append(None)
+    codes = [snapshot.pc.fill_null(chunk.indices, null_code).to_numpy() for chunk in column.chunks]
+    return (np.concatenate(codes) if codes else np.zeros(0)).astype(np.int8), values
+
+
+def _snapshot_ints(table, name, dtype):
+    return snapshot.pc.fill_null(table.column(name), 0).to_numpy().astype(dtype)
+
+
+class CorpusIndex:
+    """Колонки и битовые карты писем одного поколения данных"""
+
+    def __init__(self, years, themes, theme_values, sentiments, sentiment_values, from_ids, to_ids, generation):
+        self.generation = generation
+        self.size = len(years)
+        self.years = years
+        # Номера городов: 0 — нет города, дальше id по возрастанию
+        self.city_ids = np.union1d(np.zeros(1, np.int32), np.concatenate([from_ids, to_ids]))
+        city_type = np.uint16 if len(self.city_ids) <= 1 << 16 else np.int32
+        self.from_cities = np.searchsorted(self.city_ids, from_ids).astype(city_type)
+        self.to_cities = np.searchsorted(self.city_ids, to_ids).astype(city_type)
+
+        decades = years - years % 10
+        self.bitmaps = {
+            'theme': {value: np.packbits(themes == code) for code, value in enumerate(theme_values)},
+            'sentiment': {value: np.packbits(sentiments == code) for code, value in enumerate(sentiment_values)},
+            'decade': {int(decade): np.packbits(decades == decade) for decade in np.unique(decades) if decade},
+        }
+        self.packed_size = (self.size + 7) // 8
+
+    @classmethod
+    def from_sqlite(cls, conn, generation):
+        theme_codes, sentiment_codes = {}, {}
+        chunks = []
+        cursor = conn.execute('SELECT year, theme, sentiment, from_city_id, to_city_id FROM letters ORDER BY id')
+        while True:
+            batch = cursor.fetchmany(BATCH_ROWS)
+            if not batch:
+                break
+            years, themes, sentiments, from_ids, to_ids = zip(*batch)
+            chunks.append((
+                np.array([year or 0 for year in years], np.int16),
+                np.array([theme_codes.setdefault(theme, len(theme_codes)) for theme in themes], np.int8),
+                np.array([sentiment_codes.setdefault(value, len(sentiment_codes)) for value in sentiments], np.int8),
+                np.array([city_id or 0 for city_id in from_ids], np.int32),
+                np.array([city_id or 0 for city_id in to_ids], np.int32),
+            ))
+        dtypes = (np.int16, np.int8, np.int8, np.int32, np.int32)
+        years, themes, sentiments, from_ids, to_ids = (
+            np.concatenate(parts) for parts in zip(*chunks)
+        ) if chunks else (np.zeros(0, dtype) for dtype in dtypes)
+        return cls(years, themes, list(theme_codes), sentiments, list(sentiment_codes), from_ids, to_ids, generation)
+
+    @classmethod
+    def from_snapshot(cls, table, generation):
+        """Индекс из снимка Arrow; None, если снимок другого поколения"""
+        metadata = table.schema.metadata or {}
+        if int(metadata.get(b'generation', -1)) != generation:
+            return None
+        table = table.unify_dictionaries()
+        themes, theme_values = _snapshot_codes(table.column('theme'))
+        sentiments, sentiment_values = _snapshot_codes(table.column('sentiment'))
+        return cls(
+            _snapshot_ints(table, 'year', np.int16), themes, theme_values, sentiments, sentiment_values,
+            _snapshot_ints(table, 'from_city_id', np.int32), _snapshot_ints(table, 'to_city_id', np.int32),
+            generation,
+        )
+
+    def nbytes(self):
+        arrays = [self.years, self.city_ids, self.from_cities, self.to_cities]
+        arrays += [bitmap for bitmaps in self.bitmaps.values() for bitmap in bitmaps.values()]
+        return sum(array.nbytes for array in arrays)
+
+    def count(self, mask):
+        return self.size if mask is None else int(POPCOUNT[mask].sum())
+
+    def _city_codes(self, city_ids):
+        city_ids = np.asarray(sorted(set(city_ids)), np.int32)
+        codes = np.searchsorted(self.city_ids, city_ids)
+        found = (codes < len(self.city_ids)) & (self.city_ids[np.minimum(codes, len(self.city_ids) - 1)] == city_ids)
+        return codes[found & (city_ids != 0)]
+
+    def filter_masks(self, filters):
+        """Упакованные маски фильтров по измерениям; измерения без фильтра пропускаются"""
+        masks = {}
+        for dimension in BITMAP_DIMENSIONS:
+            values = filters.get(dimension)
+            if values:
+                bitmaps = self.bitmaps[dimension]
+                mask = np.zeros(self.packed_size, np.uint8)
+                for value in values:
+                    if value in bitmaps:
+                        mask |= bitmaps[value]
+                masks[dimension] = mask
+        if filters.get('city'):
+            codes = self._city_codes(filters['city'])
+            masks['city'] = np.packbits(np.isin(self.from_cities, codes) | np.isin(self.to_cities, codes))
+        year_from, year_to = filters.get('year_from'), filters.get('year_to')
+        if year_from is not None or year_to is not None:
+            selected = self.years != 0
+            if year_from is not None:
+                selected &= self.years >= year_from
+            if year_to is not None:
+                selected &= self.years <= year_to
+            masks['years'] = np.packbits(selected)
+        return masks
+
+    @staticmethod
+    def combine(masks, skip=None):
+        """AND масок всех измерений, кроме skip (None — фильтров нет)"""
+        mask = None
+        for dimension, bitmap in masks.items():
+            if dimension != skip:
+                mask = bitmap if mask is None else mask & bitmap
+        return mask
+
+    def city_counts(self, mask, limit):
+        """[(city_id, писем)] крупнейших городов среди писем маски"""
+        from_cities, to_cities = self.from_cities, self.to_cities
+        if mask is not None:
+            selected = np.unpackbits(mask, count=self.size).view(bool)
+            from_cities, to_cities = from_cities[selected], to_cities[selected]
+        counts = np.bincount(from_cities, minlength=len(self.city_ids))
+        counts += np.bincount(to_cities[to_cities != from_cities], minlength=len(self.city_ids))
+        counts[0] = 0
+        top = np.argsort(-counts, kind='stable')[:limit]
+        return [(int(self.city_ids[code]), int(counts[code])) for code in top if counts[code]]
+
+    def facets(self, filters, city_limit=FACET_CITIES_LIMIT):
+        """{'total': писем по всем фильтрам, 'facets': {измерение: [(значение, писем)]}}"""
+        masks = self.filter_masks(filters)
+        facets = {}
+        for dimension in BITMAP_DIMENSIONS:
+            others = self.combine(masks, skip=dimension)
+            facets[dimension] = [
+                (value, self.count(bitmap if others is None else bitmap & others))
+                for value, bitmap in self.bitmaps[dimension].items()
+            ]
+        facets['city'] = self.city_counts(self.combine(masks, skip='city'), city_limit)
+        return {'total': self.count(self.combine(masks)), 'facets': facets}
+
+
+def sort_counts(dimension, counts):
+    """Без нулей; десятилетия по порядку, остальное — по убыванию числа писем"""
+    counts = [(value, count) for value, count in counts if count]
+    if dimension == 'decade':
+        return sorted(counts)
+    if dimension == 'city':
+        return counts
+    return sorted(counts, key=lambda item: (-item[1], str(item[0])))
+
+
+class FacetIndex:
+    """Индекс текущего поколения данных: строится при первом запросе и после каждой загрузки"""
+
+    def __init__(self, enabled=ENABLED):
+        self.enabled = enabled and np is not None
+        self.index = None
+        self.build_seconds = None
+        self._failed_generation = None
+        self._lock = threading.Lock()
+
+    def current(self, database):
+        """Индекс для database.generation(); None — индекс выключен или не построился"""
+        if not self.enabled:
+            return None
+        generation = database.generation()
+        index = self.index
+        if index is not None and index.generation == generation:
+            return index
+        with self._lock:
+            if generation != self._failed_generation and (self.index is None or self.index.generation != generation):
+                self._build(database, generation)
+            index = self.index
+        return index if index is not None and index.generation == generation else None
+
+    def _build(self, database, generation):
+        started = time.perf_counter()
+        try:
+            index = None
+            path = snapshot.default_path(database.db_path)
+            if path and snapshot.pa is not None and os.path.exists(path):
+                index = CorpusIndex.from_snapshot(snapshot.load_snapshot(path), generation)
+            source = 'снимка'
+            if index is None:
+                with database.connection() as conn:
+                    index = CorpusIndex.from_sqlite(conn, generation)
+                source = 'базы'
+        except Exception as e:
+            print(f"❌ Ошибка построения индекса фасетов: {e}")
+            self._failed_generation = generation
+            return
+        self.index = index
+        self.build_seconds = time.perf_counter() - started
+        print(f"🧮 Индекс фасетов из {source}: {index.size} писем, {index.nbytes() / 1e6:.1f} МБ "
+              f"за {self.build_seconds:.2f} с")
+
+    def stats(self):
+        index = self.index
+        if index is None:
+            return {'enabled': self.enabled, 'letters': None}
+        return {
+            'enabled': self.enabled,
+            'generation': index.generation,
+            'letters': index.size,
+            'bytes': index.nbytes(),
+            'bytes_per_letter': round(index.nbytes() / max(index.size, 1), 2),
+            'build_seconds': round(self.build_seconds, 3),
+        }
+
+
+# Глобальный индекс процесса сервера
+facet_index = FacetIndex()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Фасеты корпуса: колоночный индекс против SQLite")
+    parser.add_argument('--db', default='postcards.db', help="путь к базе SQLite")
+    parser.add_argument('--theme', action='append')
+    parser.add_argument('--sentiment', action='append')
+    parser.add_argument('--decade', action='append', type=int)
+    parser.add_argument('--city-id', action='append', type=int)
+    parser.add_argument('--year-from', type=int)
+    parser.add_argument('--year-to', type=int)
+    parser.add_argument('--check', action='store_true', help="сравнить с подсчетом в SQLite")
+    args = parser.parse_args(argv)
+
+    if np is None:
+        print("❌ Для индекса фасетов нужен numpy (pip install numpy)")
+        return 1
+    from database import facets_from_sqlite
+
+    filters = {
+        'theme': args.theme, 'sentiment': args.sentiment, 'decade': args.decade, 'city': args.city_id,
+        'year_from': args.year_from, 'year_to': args.year_to,
+    }
+    conn = sqlite3.connect(f'file:{os.path.abspath(args.db)}?mode=ro', uri=True)
+    try:
+        started = time.perf_counter()
+        index = CorpusIndex.from_sqlite(conn, manifest.read_generation(conn))
+        print(f"🧮 Индекс: {index.size} писем, {index.nbytes() / 1e6:.2f} МБ "
+              f"({index.nbytes() / max(index.size, 1):.1f} байт на письмо) за {time.perf_counter() - started:.2f} с")
+        result, seconds = snapshot.best_of(lambda: index.facets(filters), repeat=5)
+        print(f"⏱️ Индекс: фасеты за {seconds * 1000:.2f} мс, писем {result['total']}")
+        for dimension in DIMENSIONS:
+            counts = sort_counts(dimension, result['facets'][dimension])
+            print(f"  {dimension}: " + ', '.join(f"{value}={count}" for value, count in counts[:10]))
+        if args.check:
+            expected, seconds = snapshot.best_of(lambda: facets_from_sqlite(conn, filters), repeat=5)
+            same = expected['total'] == result['total'] and all(
+                sort_counts(dimension, expected['facets'][dimension])
+                == sort_counts(dimension, result['facets'][dimension])
+                for dimension in DIMENSIONS
+            )
+            print(f"⏱️ SQLite: то же за {seconds * 1000:.2f} мс, результат {'совпадает' if same else 'ОТЛИЧАЕТСЯ'}")
+            if not same:
+                return 1
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,64 @@
+# fast_json.py
+"""Быстрая сериализация ответов API в JSON.
+
+Ответы кодируются без sqlite3.Row и без jsonable_encoder сразу в байты,
+которые отдаются готовым Response: списки строк собирает в JSON сам SQLite
+(json_array), остальное — orjson. Если orjson не установлен, используется
+стандартный json с тем же результатом.
+"""
+import json
+from fastapi import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(value):
+    """JSON в байтах UTF-8"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def tuple_cursor(conn):
+    """Курсор, отдающий кортежи, даже если у соединения row_factory = sqlite3.Row"""
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    return cursor
+
+
+def column_names(cursor):
+    return [column[0] for column in cursor.description]
+
+
+# SQL запроса -> тот же запрос, собирающий строки в массив JSON-объектов
+_ARRAY_SQL = {}
+
+
+def json_array(conn, sql, params=()):
+    """Строки запроса как массив объектов {колонка: значение} в JSON (байты).
+
+    Массив собирает сам SQLite (json_group_array, json_object), поэтому в Python
+    не создаются ни кортежи, ни dict на каждую строку. Порядок строк —
+    порядок запроса, включая его ORDER BY.
+    """
+    array_sql = _ARRAY_SQL.get(sql)
+    if array_sql is None:
+        names = column_names(tuple_cursor(conn).execute(f'SELECT * FROM ({sql}) LIMIT 0', params))
+        pairs = ', '.join(f"'{name}', \"{name}\"" for name in names)
+        array_sql = _ARRAY_SQL[sql] = f'SELECT json_group_array(json_object({pairs})) FROM ({sql})'
+    (data,) = tuple_cursor(conn).execute(array_sql, params).fetchone()
+    return data.encode('utf-8')
+
+
+class JSONBytesResponse(Response):
+    """Ответ с уже закодированным JSON — FastAPI не сериализует его повторно"""
+    media_type = 'application/json'
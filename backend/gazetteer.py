@@ -0,0 +1,344 @@
+# gazetteer.py
+"""Офлайн-справочник населенных пунктов: название из корпуса -> координаты.
+
+Справочник — файл data/gazetteer.csv (путь меняется через POSTCARDS_GAZETTEER):
+
+    name,latitude,longitude,variants
+    Санкт-Петербург,59.9343,30.3351,Петербург|Петроград|Ленинград|СПб
+
+В variants через «|» перечислены исторические названия и варианты написания.
+Все названия сводятся к ключу (place_key): нижний регистр, дореформенные
+буквы и «ё» свернуты как в поиске, пунктуация и дефисы — пробелы.
+
+Строка корпуса разбирается с конца: «РСФСР, Свердловская обл., г. Свердловск»
+дает кандидатов «свердловск», затем (если не нашлось) части левее. Из каждой
+части отрезаются типы поселений («г.», «село», «станция», «губернский и
+уездный город»), части-регионы без названия поселения пропускаются.
+
+Сначала ищем точное совпадение ключа в словаре, затем нечеткое: кандидаты
+отбираются по общим триграммам, как в fuzzy-поиске писем, и проверяются
+расстоянием Левенштейна (fuzzy_edits правок). Первая буква должна совпасть,
+а другое окончание опечаткой не считается: «Александровское» — не
+«Александровск». Ничья решается по числу общих триграмм и названию, так что
+результат не зависит от порядка строк.
+
+Разобранные названия кешируются в таблице place_resolutions вместе с версией
+справочника: повторная загрузка корпуса не разбирает их заново, а правка
+gazetteer.csv сбрасывает кеш. Не найденные места получают координаты NULL —
+их письма остаются в базе, но маркера на карте у них нет.
+
+Проверка справочника на названиях из базы:
+
+    python -m gazetteer [--db postcards.db] [--unresolved 30] [названия ...]
+"""
+import os
+import re
+import csv
+import sys
+import time
+import sqlite3
+import hashlib
+import argparse
+from search import fold, word_trigrams, edit_distance
+
+# Меняем при изменении разбора названий — это сбрасывает кеш place_resolutions
+GAZETTEER_ALGORITHM_VERSION = 1
+
+DEFAULT_GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'gazetteer.csv')
+GAZETTEER_PATH = os.environ.get('POSTCARDS_GAZETTEER', DEFAULT_GAZETTEER_PATH)
+
+# Типы поселений перед названием: «г. Москва», «губернский и уездный город Тверь»
+PLACE_TYPE_WORDS = {
+    'г', 'гор', 'город', 'городок', 'губернский', 'уездный', 'безуездный', 'заштатный', 'и',
+    'с', 'село', 'сельцо', 'д', 'дер', 'деревня', 'п', 'пос', 'поселок', 'пгт', 'рп',
+    'ст', 'станция', 'станица', 'м', 'мест', 'местечко', 'слобода', 'сл',
+    'х', 'хутор', 'аул', 'кишлак', 'курорт', 'порт', 'гп', 'дп', 'нп',
+}
+# Слова, по которым часть строки считается регионом, а не поселением
+REGION_WORDS = {
+    'область', 'обл', 'губерния', 'губ', 'губерн', 'уезд', 'у', 'район', 'р', 'край',
+    'округ', 'волость', 'вол', 'республика', 'асср', 'сср', 'рсфср', 'ссср', 'усср', 'бсср',
+    'зсфср', 'узсср', 'казсср', 'автономная', 'советская', 'социалистическая',
+    'области', 'губернии', 'уезда', 'района', 'края',
+}
+# Нечеткий поиск строже, чем в письмах: короткое незнакомое название чаще
+# оказывается другим селом, чем опечаткой («Ардатов» — не «Саратов»)
+FUZZY_MIN_LENGTH = 7
+FUZZY_TWO_EDITS_LENGTH = 11
+
+# Пометки транскрипции, которые не относятся к названию
+NOISE_WORDS = {'нрзб', 'отсутствует'}
+
+_TOKEN_RE = re.compile(r'\w+')
+_PARENTHESES_RE = re.compile(r'\([^)]*\)')
+
+CREATE_RESOLUTIONS_SQL = '''
+    CREATE TABLE IF NOT EXISTS place_resolutions (
+        name TEXT PRIMARY KEY,
+        place TEXT,
+        latitude REAL,
+        longitude REAL,
+        method TEXT NOT NULL,
+        version TEXT NOT NULL
+    ) WITHOUT ROWID
+'''
+UPSERT_RESOLUTION_SQL = '''
+    INSERT OR REPLACE INTO place_resolutions (name, place, latitude, longitude, method, version)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+
+def fuzzy_edits(key):
+    """Допустимое число опечаток в ключе названия"""
+    if len(key) < FUZZY_MIN_LENGTH:
+        return 0
+    if len(key) < FUZZY_TWO_EDITS_LENGTH:
+        return 1
+    return 2
+
+
+def _other_ending(key, candidate):
+    """Отличается только окончание: «Петропавловка», «Александровское» — села,
+    названные по городу, а не опечатки в нем. Обрезанное «Жуковски» — опечатка."""
+    stem = len(key) - 2
+    return len(candidate) <= len(key) and key[:stem] == candidate[:stem]
+
+
+def place_key(text):
+    """Ключ названия для словаря: 'Ростов-на-Дону' -> 'ростов на дону'"""
+    return ' '.join(_TOKEN_RE.findall(fold((text or '').lower())))
+
+
+def _part_candidates(part):
+    """Ключи-кандидаты одной части строки (между запятыми)"""
+    # Номера («Североморск-7», «Нижний Тагил 2») — почтовые отделения, а не часть названия
+    tokens = [
+        token for token in _TOKEN_RE.findall(fold(part.lower()))
+        if token not in NOISE_WORDS and not token.isdigit()
+    ]
+    if not tokens:
+        return
+    # «Северо-Кавказский край г. Нальчик» — название после последнего типа поселения
+    for index in range(len(tokens) - 1, -1, -1):
+        if tokens[index] in PLACE_TYPE_WORDS:
+            if index + 1 < len(tokens):
+                yield ' '.join(tokens[index + 1:])
+            break
+    if any(token in REGION_WORDS for token in tokens):
+        return
+    start = 0
+    while start < len(tokens) - 1 and tokens[start] in PLACE_TYPE_WORDS:
+        start += 1
+    yield ' '.join(tokens[start:])
+
+
+def candidate_keys(name):
+    """Ключи, под которыми ищем строку корпуса, от самого точного к самому общему"""
+    keys = []
+    # Пояснения в скобках («(Gottingen)») — не часть названия; квадратные скобки транскрипции снимаем
+    name = _PARENTHESES_RE.sub(' ', str(name)).replace('[', '').replace(']', '')
+    for part in reversed(name.split(',')):
+        for key in _part_candidates(part):
+            if key not in keys:
+                keys.append(key)
+    return keys
+
+
+class Gazetteer:
+    """Словарь ключей названий и триграммный индекс для нечеткого поиска"""
+
+    def __init__(self, places, version=''):
+        self.version = version
+        self.places = []
+        self.index = {}
+        for name, latitude, longitude, variants in places:
+            place_id = len(self.places)
+            self.places.append((name, latitude, longitude))
+            for variant in [name, *variants]:
+                key = place_key(variant)
+                # При повторе ключа побеждает место, записанное в файле раньше
+                if key and key not in self.index:
+                    self.index[key] = place_id
+
+        self.keys = sorted(self.index)
+        self.postings = {}
+        for key_id, key in enumerate(self.keys):
+            for trigram in word_trigrams(key):
+                self.postings.setdefault(trigram, []).append(key_id)
+
+    @classmethod
+    def load(cls, path=None):
+        """Читаем справочник из CSV; без файла — пустой справочник"""
+        path = path or GAZETTEER_PATH
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError as e:
+            print(f"⚠️ Справочник мест не найден ({e}), координаты городов не определятся")
+            return cls([], version=f'{GAZETTEER_ALGORITHM_VERSION}:empty')
+
+        places = []
+        for row in csv.DictReader(data.decode('utf-8-sig').splitlines()):
+            name = (row.get('name') or '').strip()
+            if not name or name.startswith('#'):
+                continue
+            variants = [v.strip() for v in (row.get('variants') or '').split('|') if v.strip()]
+            places.append((name, float(row['latitude']), float(row['longitude']), variants))
+        version = f'{GAZETTEER_ALGORITHM_VERSION}:{hashlib.sha1(data).hexdigest()[:16]}'
+        return cls(places, version=version)
+
+    def _fuzzy(self, key):
+        """Ближайший ключ словаря не дальше fuzzy_edits(key) правок с той же первой буквой (или None)"""
+        edits = fuzzy_edits(key)
+        if edits == 0:
+            return None
+        trigrams = word_trigrams(key)
+        min_shared = max(1, len(trigrams) - 3 * edits)
+        shared = {}
+        for trigram in trigrams:
+            for key_id in self.postings.get(trigram, ()):
+                shared[key_id] = shared.get(key_id, 0) + 1
+        best = None
+        for key_id, count in shared.items():
+            if count < min_shared:
+                continue
+            candidate = self.keys[key_id]
+            if candidate[0] != key[0] or _other_ending(key, candidate):
+                continue
+            distance = edit_distance(key, candidate, edits)
+            if distance <= edits:
+                match = (distance, -count, candidate)
+                if best is None or match < best:
+                    best = match
+        return best[2] if best else None
+
+    def resolve(self, name):
+        """(место, широта, долгота, способ) для строки корпуса; способ 'exact', 'fuzzy' или 'none'"""
+        keys = candidate_keys(name)
+        for key in keys:
+            if key in self.index:
+                return self.places[self.index[key]] + ('exact',)
+        for key in keys:
+            match = self._fuzzy(key)
+            if match is not None:
+                return self.places[self.index[match]] + ('fuzzy',)
+        return None, None, None, 'none'
+
+
+_loaded = {}
+
+
+def get_gazetteer(path=None):
+    """Справочник, загруженный один раз на процесс (перечитываем, если файл изменился)"""
+    path = path or GAZETTEER_PATH
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        mtime = None
+    cached = _loaded.get(path)
+    if cached is None or cached[0] != mtime:
+        cached = _loaded[path] = (mtime, Gazetteer.load(path))
+    return cached[1]
+
+
+def gazetteer_version(path=None):
+    """Версия справочника для манифеста загрузки"""
+    return get_gazetteer(path).version
+
+
+class PlaceResolver:
+    """Координаты названий с кешем в place_resolutions (в транзакции загрузки)"""
+
+    def __init__(self, conn, gazetteer=None):
+        self.conn = conn
+        self.gazetteer = gazetteer or get_gazetteer()
+        conn.execute(CREATE_RESOLUTIONS_SQL)
+        # Кеш другой версии справочника больше не верен, а координаты уже
+        # загруженных городов надо пересчитать (relocate_cities)
+        cursor = conn.execute('DELETE FROM place_resolutions WHERE version != ?', (self.gazetteer.version,))
+        self.stale = cursor.rowcount > 0
+        self.cache = {
+            name: (latitude, longitude)
+            for name, latitude, longitude in conn.execute('SELECT name, latitude, longitude FROM place_resolutions')
+        }
+        self.pending = []
+
+    def coordinates(self, name):
+        """(широта, долгота) или (None, None), если место не найдено"""
+        if name not in self.cache:
+            place, latitude, longitude, method = self.gazetteer.resolve(name)
+            self.cache[name] = (latitude, longitude)
+            self.pending.append((name, place, latitude, longitude, method, self.gazetteer.version))
+        return self.cache[name]
+
+    def save(self):
+        if self.pending:
+            self.conn.executemany(UPSERT_RESOLUTION_SQL, self.pending)
+            self.pending.clear()
+
+
+def relocate_cities(conn, resolver=None):
+    """Пересчитываем координаты всех городов по справочнику. Возвращает число измененных."""
+    resolver = resolver or PlaceResolver(conn)
+    updates = []
+    for city_id, name, latitude, longitude in conn.execute(
+        'SELECT id, name, latitude, longitude FROM cities ORDER BY id'
+    ).fetchall():
+        coordinates = resolver.coordinates(name)
+        if coordinates != (latitude, longitude):
+            updates.append(coordinates + (city_id,))
+    conn.executemany('UPDATE cities SET latitude = ?, longitude = ? WHERE id = ?', updates)
+    resolver.save()
+    return len(updates)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Проверка справочника мест на названиях городов")
+    parser.add_argument('names', nargs='*', help="названия для разбора (по умолчанию — все города базы)")
+    parser.add_argument('--db', default='postcards.db', help="путь к базе SQLite")
+    parser.add_argument('--gazetteer', default=None, help="путь к gazetteer.csv")
+    parser.add_argument('--unresolved', type=int, default=30, help="сколько не найденных названий показать")
+    args = parser.parse_args(argv)
+
+    gazetteer = Gazetteer.load(args.gazetteer or GAZETTEER_PATH)
+    print(f"📚 Справочник: {len(gazetteer.places)} мест, {len(gazetteer.index)} названий, версия {gazetteer.version}")
+
+    if args.names:
+        for name in args.names:
+            place, latitude, longitude, method = gazetteer.resolve(name)
+            print(f"  {name!r} -> {place} ({latitude}, {longitude}) [{method}]")
+        return 0
+
+    conn = sqlite3.connect(args.db)
+    try:
+        cities = conn.execute('SELECT name, letter_count FROM cities ORDER BY letter_count DESC, name').fetchall()
+    except sqlite3.OperationalError as e:
+        print(f"❌ Не удалось прочитать города: {e}")
+        return 1
+    finally:
+        conn.close()
+
+    started = time.perf_counter()
+    methods = {}
+    letters = {}
+    unresolved = []
+    for name, letter_count in cities:
+        method = gazetteer.resolve(name)[3]
+        methods[method] = methods.get(method, 0) + 1
+        letters[method] = letters.get(method, 0) + (letter_count or 0)
+        if method == 'none':
+            unresolved.append((name, letter_count))
+    elapsed = time.perf_counter() - started
+
+    total_letters = sum(letters.values()) or 1
+    print(f"⏱️ {len(cities)} названий разобрано за {elapsed:.2f} с")
+    for method in ('exact', 'fuzzy', 'none'):
+        print(f"  {method:<6} {methods.get(method, 0):>6} названий, "
+              f"{100 * letters.get(method, 0) / total_letters:5.1f}% писем")
+    for name, letter_count in unresolved[:args.unresolved]:
+        print(f"  ? {name} ({letter_count})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,202 @@
+# geo.py
+"""Города на карте: прямоугольник видимой области и кластеры маркеров.
+
+Кластеры строятся на сетке в проекции Web Mercator (как плитки Leaflet):
+на зуме z мир шириной 256 · 2^z пикселей делится на квадраты по
+CLUSTER_CELL_PX пикселей, и все города одного квадрата становятся одним
+маркером. Для каждого зума от 0 до CLUSTER_MAX_ZOOM кластеры с числом
+городов и писем считаются один раз при загрузке корпуса (city_clusters),
+а /api/cities/clusters читает только клетки видимой области — на экране
+1920×1080 их не больше нескольких сотен. Инкрементальная загрузка
+пересчитывает только клетки городов, у которых изменились число писем или
+координаты (update_city_clusters).
+
+Для запросов «города в видимой области» рядом с cities живет R*Tree
+city_rtree (id, min_lat, max_lat, min_lon, max_lon): триггеры на cities
+поддерживают его при инкрементальной загрузке, а после полной — он
+строится заново (rebuild_city_rtree).
+"""
+import math
+
+CLUSTER_CELL_PX = 80
+CLUSTER_MAX_ZOOM = 12
+TILE_PX = 256
+# Если изменилась большая доля городов, кластеры дешевле пересобрать целиком:
+# на мелких зумах клетка накрывает сотни городов, и каждая читается заново
+CLUSTER_UPDATE_MAX_SHARE = 0.02
+# Web Mercator не определен у полюсов — обрезаем широту, как Leaflet
+MAX_LATITUDE = 85.0511287798
+
+INSERT_CLUSTER_SQL = '''
+    INSERT INTO city_clusters (
+        zoom, cell_x, cell_y, city_count, letter_count, latitude, longitude,
+        south, west, north, east, city_id, name
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+
+def parse_bbox(value):
+    """'запад,юг,восток,север' (как L.LatLngBounds.toBBoxString) -> кортеж чисел; ошибка — ValueError"""
+    try:
+        west, south, east, north = (float(part) for part in value.split(','))
+    except ValueError:
+        raise ValueError(f"bbox должен быть 'запад,юг,восток,север', получено {value!r}")
+    if not all(math.isfinite(part) for part in (west, south, east, north)) or west > east or south > north:
+        raise ValueError(f"Неверный bbox {value!r}")
+    return west, south, east, north
+
+
+def mercator(latitude, longitude):
+    """Доли мира (x, y) в проекции Web Mercator: (0, 0) — северо-запад, (1, 1) — юго-восток"""
+    latitude = max(-MAX_LATITUDE, min(MAX_LATITUDE, latitude))
+    longitude = max(-180.0, min(180.0, longitude))
+    sin_lat = math.sin(math.radians(latitude))
+    x = (longitude + 180.0) / 360.0
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return x, y
+
+
+def cells_per_side(zoom):
+    return TILE_PX * 2 ** zoom / CLUSTER_CELL_PX
+
+
+def cell(x, y, zoom):
+    """Клетка сетки зума zoom для точки (x, y) из mercator()"""
+    side = cells_per_side(zoom)
+    last = math.ceil(side) - 1
+    return min(int(x * side), last), min(int(y * side), last)
+
+
+def cluster_zoom(zoom):
+    """Зум, для которого посчитаны кластеры: дальше CLUSTER_MAX_ZOOM города уже не сливаются"""
+    return max(0, min(zoom, CLUSTER_MAX_ZOOM))
+
+
+def bbox_cells(bbox, zoom):
+    """Диапазон клеток (x0, x1, y0, y1), покрывающий bbox на зуме zoom"""
+    west, south, east, north = bbox
+    x0, y0 = cell(*mercator(north, west), zoom)
+    x1, y1 = cell(*mercator(south, east), zoom)
+    return x0, x1, y0, y1
+
+
+def _city_points(rows):
+    return [
+        (city_id, name, latitude, longitude, letter_count or 0, mercator(latitude, longitude))
+        for city_id, name, latitude, longitude, letter_count in rows
+    ]
+
+
+def _cluster_rows(zoom, cities):
+    """Строки city_clusters зума zoom для городов из _city_points"""
+    clusters = {}
+    for city_id, name, latitude, longitude, letters, (x, y) in cities:
+        key = cell(x, y, zoom)
+        cluster = clusters.get(key)
+        if cluster is None:
+            clusters[key] = cluster = {
+                'cities': 0, 'letters': 0, 'weight': 0, 'lat_sum': 0.0, 'lon_sum': 0.0,
+                'south': latitude, 'west': longitude, 'north': latitude, 'east': longitude,
+                'top': (letters, -city_id, name),
+            }
+        # Маркер кластера — в центре тяжести его городов с весом по числу писем
+        weight = max(letters, 1)
+        cluster['cities'] += 1
+        cluster['letters'] += letters
+        cluster['weight'] += weight
+        cluster['lat_sum'] += latitude * weight
+        cluster['lon_sum'] += longitude * weight
+        cluster['south'] = min(cluster['south'], latitude)
+        cluster['west'] = min(cluster['west'], longitude)
+        cluster['north'] = max(cluster['north'], latitude)
+        cluster['east'] = max(cluster['east'], longitude)
+        # Город с наибольшим числом писем дает кластеру название
+        cluster['top'] = max(cluster['top'], (letters, -city_id, name))
+    rows = []
+    for (cell_x, cell_y), cluster in clusters.items():
+        _, top_id, top_name = cluster['top']
+        rows.append((
+            zoom, cell_x, cell_y, cluster['cities'], cluster['letters'],
+            cluster['lat_sum'] / cluster['weight'], cluster['lon_sum'] / cluster['weight'],
+            cluster['south'], cluster['west'], cluster['north'], cluster['east'], -top_id, top_name,
+        ))
+    return rows
+
+
+def cluster_cities(cities, zoom):
+    """Кластеры зума zoom для набора городов (id, название, широта, долгота, число писем),
+    которого нет в city_clusters, — например, только крупнейших. Строки как в city_clusters."""
+    return _cluster_rows(zoom, _city_points(cities))
+
+
+def rebuild_city_clusters(conn):
+    """Пересобираем city_clusters для всех зумов. Возвращает число кластеров."""
+    cities = _city_points(conn.execute(
+        'SELECT id, name, latitude, longitude, letter_count FROM cities '
+        'WHERE latitude IS NOT NULL AND longitude IS NOT NULL'
+    ))
+    conn.execute('DELETE FROM city_clusters')
+    rows = []
+    for zoom in range(CLUSTER_MAX_ZOOM + 1):
+        rows.extend(_cluster_rows(zoom, cities))
+    rows.sort()
+    conn.executemany(INSERT_CLUSTER_SQL, rows)
+    return len(rows)
+
+
+def cell_bbox(cell_x, cell_y, zoom):
+    """(запад, юг, восток, север) клетки; крайние клетки тянутся до границ мира,
+    как и точки, которые в них прижимает cell()"""
+    side = cells_per_side(zoom)
+    last = math.ceil(side) - 1
+
+    def latitude(y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y))))
+
+    west = -math.inf if cell_x == 0 else cell_x / side * 360.0 - 180.0
+    east = math.inf if cell_x == last else (cell_x + 1) / side * 360.0 - 180.0
+    north = math.inf if cell_y == 0 else latitude(cell_y / side)
+    south = -math.inf if cell_y == last else latitude((cell_y + 1) / side)
+    return west, south, east, north
+
+
+def update_city_clusters(conn, points):
+    """Пересчитываем только клетки, в которые попадают points — прежние и новые
+    (широта, долгота) городов, у которых изменились число писем или координаты.
+    Города клетки берем из city_rtree. Возвращает число пересчитанных клеток.
+    """
+    cities = conn.execute('SELECT COUNT(*) FROM city_rtree').fetchone()[0]
+    if len(points) > cities * CLUSTER_UPDATE_MAX_SHARE:
+        return rebuild_city_clusters(conn)
+    changed = 0
+    for zoom in range(CLUSTER_MAX_ZOOM + 1):
+        cells = {cell(*mercator(latitude, longitude), zoom) for latitude, longitude in points}
+        for cell_x, cell_y in sorted(cells):
+            west, south, east, north = cell_bbox(cell_x, cell_y, zoom)
+            # На границе клетки R*Tree отдает и соседей — точную клетку проверяет cell()
+            cities = [
+                city for city in _city_points(conn.execute(
+                    'SELECT c.id, c.name, c.latitude, c.longitude, c.letter_count '
+                    'FROM city_rtree r JOIN cities c ON c.id = r.id '
+                    'WHERE r.min_lat <= ? AND r.max_lat >= ? AND r.min_lon <= ? AND r.max_lon >= ? '
+                    'ORDER BY c.id',
+                    (north, south, east, west)
+                ))
+                if cell(*city[-1], zoom) == (cell_x, cell_y)
+            ]
+            conn.execute(
+                'DELETE FROM city_clusters WHERE zoom = ? AND cell_x = ? AND cell_y = ?', (zoom, cell_x, cell_y)
+            )
+            conn.executemany(INSERT_CLUSTER_SQL, _cluster_rows(zoom, cities))
+            changed += 1
+    return changed
+
+
+def rebuild_city_rtree(conn):
+    """Заполняем city_rtree по cities заново (после загрузки со снятыми триггерами)"""
+    conn.execute('DELETE FROM city_rtree')
+    conn.execute(
+        'INSERT INTO city_rtree (id, min_lat, max_lat, min_lon, max_lon) '
+        'SELECT id, latitude, latitude, longitude, longitude FROM cities '
+        'WHERE latitude IS NOT NULL AND longitude IS NOT NULL'
+    )
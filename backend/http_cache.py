@@ -0,0 +1,195 @@
+# http_cache.py
+"""Условные запросы (ETag / If-None-Match) и сжатие ответов.
+
+GenerationETagMiddleware — ответы API зависят только от данных, поэтому ETag
+строится из поколения данных (manifest.bump_generation) и адреса запроса.
+Если клиент прислал совпадающий If-None-Match, отвечаем 304 сразу, не вызывая
+эндпоинт и не обращаясь к базе за данными. ETag получают только ответы 200:
+ошибка (например, 503 при занятой базе) не должна потом подтверждаться 304.
+
+CompressionMiddleware — сжимает текстовые ответы (JSON, HTML, CSS, JS) больше
+minimum_size байт: brotli, если он установлен и клиент его принимает, иначе gzip.
+Сжатое представление получает собственный сильный ETag с суффиксом кодировки,
+а в If-None-Match суффикс снимается, чтобы StaticFiles и API сравнивали
+исходные теги.
+"""
+import gzip
+import hashlib
+import inspect
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'image/svg+xml')
+ENCODING_SUFFIXES = ('-br', '-gzip')
+
+
+def make_etag(generation, path, query_string, salt=''):
+    """Сильный ETag: одинаков для одного адреса, пока не изменились данные"""
+    digest = hashlib.sha1(f'{salt}|{path}?{query_string}'.encode('utf-8')).hexdigest()[:16]
+    return f'"{generation}-{digest}"'
+
+
+def etag_matches(if_none_match, etag):
+    """Есть ли etag среди тегов If-None-Match (сравнение по значению, W/ игнорируем)"""
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or any(tag.removeprefix('W/') == etag for tag in tags)
+
+
+def _strip_encoding_suffix(tag):
+    """'"abc-br"' -> ('"abc"', '-br'); StaticFiles отдает теги и без кавычек"""
+    quote = '"' if tag.endswith('"') else ''
+    for suffix in ENCODING_SUFFIXES:
+        if tag.endswith(suffix + quote):
+            return tag[:len(tag) - len(suffix + quote)] + quote, suffix
+    return tag, ''
+
+
+def _with_encoding_suffix(etag, suffix):
+    if etag.endswith('"'):
+        return etag[:-1] + suffix + '"'
+    return etag + suffix
+
+
+class GenerationETagMiddleware:
+    """ETag по поколению данных и 304 без выполнения запроса"""
+
+    def __init__(self, app, generation, prefix='/api/', exclude=(), salt=''):
+        self.app = app
+        self.generation = generation
+        self.prefix = prefix
+        self.exclude = set(exclude)
+        self.salt = salt
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get('path', '')
+        if (scope['type'] != 'http' or scope['method'] not in ('GET', 'HEAD')
+                or not path.startswith(self.prefix) or path in self.exclude):
+            await self.app(scope, receive, send)
+            return
+
+        # Поколение читается из базы не чаще раза в секунду, но все равно не в цикле событий:
+        # асинхронную функцию (AsyncDatabase.generation) ждем, синхронную — в пуле потоков
+        if inspect.iscoroutinefunction(self.generation):
+            generation = await self.generation()
+        else:
+            generation = await run_in_threadpool(self.generation)
+        etag = make_etag(generation, path, scope.get('query_string', b'').decode('latin-1'), self.salt)
+
+        if etag_matches(Headers(scope=scope).get('if-none-match'), etag):
+            await send({
+                'type': 'http.response.start',
+                'status': 304,
+                'headers': [(b'etag', etag.encode()), (b'cache-control', b'no-cache')],
+            })
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        async def send_with_etag(message):
+            # Ответы с ошибкой уходят без ETag — клиент не сможет их перепроверить и получить 304
+            if message['type'] == 'http.response.start' and message['status'] == 200:
+                headers = MutableHeaders(scope=message)
+                headers['ETag'] = etag
+                # Браузер хранит ответ, но перед использованием перепроверяет его по ETag
+                headers['Cache-Control'] = 'no-cache'
+            await send(message)
+
+        await self.app(scope, receive, send_with_etag)
+
+
+class CompressionMiddleware:
+    """brotli/gzip для текстовых ответов больше minimum_size байт"""
+
+    def __init__(self, app, minimum_size=1024, gzip_level=6, brotli_quality=5):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    def choose_encoding(self, accept_encoding):
+        accepted = {part.split(';')[0].strip().lower() for part in accept_encoding.split(',')}
+        if brotli is not None and 'br' in accepted:
+            return 'br'
+        if 'gzip' in accepted:
+            return 'gzip'
+        return None
+
+    def compress(self, body, encoding):
+        if encoding == 'br':
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, compresslevel=self.gzip_level)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] != 'GET':
+            await self.app(scope, receive, send)
+            return
+
+        request_headers = Headers(scope=scope)
+        encoding = self.choose_encoding(request_headers.get('accept-encoding', ''))
+
+        # Клиент присылает ETag сжатого представления — внутрь передаем исходный тег
+        matched_suffix = ''
+        if_none_match = request_headers.get('if-none-match')
+        if if_none_match:
+            tags = []
+            for tag in if_none_match.split(','):
+                tag, suffix = _strip_encoding_suffix(tag.strip())
+                matched_suffix = matched_suffix or suffix
+                tags.append(tag)
+            scope = dict(scope)
+            scope['headers'] = [
+                (name, value) for name, value in scope['headers'] if name != b'if-none-match'
+            ] + [(b'if-none-match', ', '.join(tags).encode('latin-1'))]
+
+        start = None
+        chunks = []
+
+        async def send_compressed(message):
+            nonlocal start
+            if message['type'] == 'http.response.start':
+                headers = Headers(raw=message['headers'])
+                if message['status'] == 304:
+                    # 304 подтверждает то представление, которое уже есть у клиента
+                    if matched_suffix and 'etag' in headers:
+                        mutable = MutableHeaders(scope=message)
+                        mutable['ETag'] = _with_encoding_suffix(headers['etag'], matched_suffix)
+                    await send(message)
+                    return
+                content_type = headers.get('content-type', '')
+                content_length = headers.get('content-length')
+                if (encoding is None or message['status'] != 200 or 'content-encoding' in headers
+                        or not content_type.startswith(COMPRESSIBLE_TYPES)
+                        or (content_length is not None and int(content_length) < self.minimum_size)):
+                    await send(message)
+                    return
+                start = message
+                return
+
+            if start is None:
+                await send(message)
+                return
+
+            chunks.append(message.get('body', b''))
+            if message.get('more_body', False):
+                return
+
+            body = b''.join(chunks)
+            headers = MutableHeaders(scope=start)
+            if len(body) >= self.minimum_size:
+                body = self.compress(body, encoding)
+                headers['Content-Encoding'] = encoding
+                headers['Content-Length'] = str(len(body))
+                headers.add_vary_header('Accept-Encoding')
+                if 'etag' in headers:
+                    # У сжатого представления свой сильный ETag
+                    headers['ETag'] = _with_encoding_suffix(headers['etag'], '-' + encoding)
+            await send(start)
+            await send({'type': 'http.response.body', 'body': body})
+
+        await self.app(scope, receive, send_compressed)
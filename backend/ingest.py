@@ -0,0 +1,693 @@
+# ingest.py
+"""Потоковая загрузка корпуса открыток из Excel в SQLite.
+
+Запуск отдельно от веб-сервера (из каталога backend):
+
+    python -m ingest [путь к xlsx] [--db postcards.db] [--batch-size 5000] [--force] [--full] [--workers N] [--no-snapshot]
+
+Книга читается построчно (xlsx_reader — значения как у openpyxl read-only,
+но втрое быстрее), письма пишутся пачками через executemany в одной
+транзакции, поэтому память ограничена размером пачки.
+База остается в режиме WAL, так что загружать можно и при запущенном
+сервере: его читатели видят прежний корпус до COMMIT.
+
+По умолчанию загрузка инкрементальная: каждая строка Excel получает ключ
+(ссылка на открытку или хеш содержимого) и хеш значимых полей, и в базу
+применяются только добавленные, измененные и удаленные строки.
+
+Классификация писем может идти в пуле процессов (--workers), запись в базу
+всегда делает один процесс, поэтому результат совпадает с последовательным.
+
+Скорость полной загрузки (1 CPU, синтетический корпус synth_corpus на 100 тыс.
+строк): около 30 с, то есть примерно 3 тыс. строк/с и 5 минут на миллион.
+Цель «миллион строк меньше чем за минуту» не достигнута. Время уходит на
+чтение книги (около 7 с, в одном потоке: XML листа разбирается только
+последовательно), построение писем и счетчиков в Python (около 13 с) и
+полнотекстовые индексы после вставки (около 10 с).
+"""
+import sqlite3
+import os
+import sys
+import time
+import argparse
+import hashlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime
+import manifest
+import classifier
+import migrations
+import search
+import mentions
+import geo
+import gazetteer
+import timeline
+import snapshot
+import xlsx_reader
+
+# POSTCARDS_EXCEL и POSTCARDS_DB меняют корпус и базу сервера (например, для bench_scale)
+DEFAULT_EXCEL_PATH = os.environ.get('POSTCARDS_EXCEL', "../data/Пишу тебе. Корпус для хакатона (2024).xlsx")
+DEFAULT_DB_PATH = os.environ.get('POSTCARDS_DB', "postcards.db")
+BATCH_SIZE = 5000
+# Строк в одной пачке для пула классификаторов и сколько пачек на воркер держим в работе
+CHUNK_SIZE = 1000
+CHUNKS_IN_FLIGHT = 4
+
+# Колонки Excel, которые мы используем
+COL_FROM_CITY = 'Населенный пункт (откуда)'
+COL_TO_CITY = 'Населенный пункт (куда)'
+COL_TEXT = 'Текст открытки'
+COL_DATE = 'Дата открытки (нормализованная)'
+COL_PRINT_DATE = 'Дата печати открытки'
+# Первая колонка без заголовка — ссылка на карточку открытки на pishutebe.ru
+COL_CARD_URL = 'Unnamed: 0'
+
+# Поля строки, от которых зависят письма в базе — по ним считаем хеш строки
+SOURCE_COLUMNS = (COL_FROM_CITY, COL_TO_CITY, COL_TEXT, COL_DATE, COL_PRINT_DATE)
+
+MISSING_VALUES = {'[нрзб]', '[отсутствует]', 'нрзб', 'отсутствует'}
+CITY_PREFIXES = ['г.', 'город', 'гор.', 'с.', 'село', 'дер.', 'деревня']
+
+# Таблицы с данными корпуса — их очищает полная перезагрузка
+DATA_TABLES = ['letters', 'cities', 'source_rows', 'letter_stats', 'letter_cube']
+
+INSERT_CITY_SQL = 'INSERT INTO cities (name, latitude, longitude, letter_count) VALUES (?, ?, ?, ?)'
+INSERT_LETTER_SQL = '''
+    INSERT INTO letters (source_key, from_city_id, to_city_id, year, content, theme, sentiment, excerpt)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+UPSERT_SOURCE_SQL = 'INSERT OR REPLACE INTO source_rows (source_key, row_hash) VALUES (?, ?)'
+
+# Удаляем письма порциями, чтобы не упереться в лимит параметров SQLite
+DELETE_CHUNK = 500
+
+# Приращение счетчика сводной статистики; нулевые строки потом удаляем
+UPSERT_STAT_SQL = '''
+    INSERT INTO letter_stats (dimension, value, count) VALUES (?, ?, ?)
+    ON CONFLICT (dimension, value) DO UPDATE SET count = count + excluded.count
+'''
+
+
+def iter_excel_rows(excel_path):
+    """Построчно читаем книгу, отдаем словари {колонка: значение}.
+
+    Читаем первый лист и идущие за ним листы с тем же заголовком: в лист
+    xlsx помещается чуть больше миллиона строк, и большой корпус
+    продолжается на следующих листах.
+    """
+    sheets = xlsx_reader.iter_workbook(excel_path)
+    try:
+        first_header = None
+        for _, rows in sheets:
+            header = next(rows, None)
+            if header is None:
+                return
+            # Пустые ячейки в конце заголовка в файле есть не всегда
+            names = [name for name in header if name is not None]
+            if first_header is None:
+                first_header = names
+            elif names != first_header:
+                return
+            # Колонки без заголовка называем как pandas: 'Unnamed: N'
+            header = [
+                str(name).strip() if name is not None else f'Unnamed: {index}'
+                for index, name in enumerate(header)
+            ]
+            for values in rows:
+                # Пропущенные и полностью пустые строки (часто в конце листа) пропускаем
+                if all(value is None for value in values):
+                    continue
+                yield dict(zip(header, values))
+    finally:
+        sheets.close()
+
+
+def row_hash(row):
+    """Хеш значимых полей строки — меняется, только если меняются письма"""
+    digest = hashlib.sha1()
+    for column in SOURCE_COLUMNS:
+        digest.update(repr(row.get(column)).encode('utf-8'))
+        digest.update(b'\x1f')
+    return digest.hexdigest()
+
+
+def iter_source_rows(excel_path):
+    """(ключ строки, хеш строки, строка) для каждой строки Excel.
+
+    Ключ — ссылка на открытку, а если ее нет — хеш содержимого. Повторы
+    одного ключа нумеруем, чтобы ключ оставался уникальным и стабильным.
+    """
+    seen = {}
+    for row in iter_excel_rows(excel_path):
+        digest = row_hash(row)
+        card_url = row.get(COL_CARD_URL)
+        source_key = str(card_url).strip() if card_url else 'sha1:' + digest
+        repeat = seen.get(source_key, 0)
+        seen[source_key] = repeat + 1
+        if repeat:
+            source_key = f'{source_key}#{repeat}'
+        yield source_key, digest, row
+
+
+def normalize_city_name(city_str):
+    """Нормализуем название населенного пункта"""
+    if city_str is None:
+        return None
+
+    city_str = str(city_str).strip()
+    if city_str in MISSING_VALUES:
+        return None
+
+    # Убираем указания на губернии
+    if 'губерния' in city_str.lower():
+        parts = city_str.split(',')
+        city_str = parts[-1].strip()
+
+    # Убираем префиксы
+    for prefix in CITY_PREFIXES:
+        if city_str.lower().startswith(prefix.lower()):
+            city_str = city_str[len(prefix):].strip()
+
+    return city_str if city_str else None
+
+
+def parse_year(date_value, print_date_value=None):
+    """Год письма из нормализованной даты, иначе из даты печати открытки"""
+    year = None
+    # openpyxl отдает настоящие даты как datetime, текстовые — как 'дд.мм.гггг'
+    if isinstance(date_value, (datetime, date)):
+        year = date_value.year
+    elif date_value is not None:
+        try:
+            date_str = str(date_value)
+            if '.' in date_str:
+                year = int(date_str.split('.')[-1])
+        except ValueError:
+            year = None
+    if year is not None and (year < 1800 or year > 2100):
+        year = None
+
+    # Если год не определился, пробуем из других полей
+    if not year and print_date_value is not None:
+        if isinstance(print_date_value, (datetime, date)):
+            return print_date_value.year
+        try:
+            year = int(str(print_date_value).split('.')[-1])
+        except ValueError:
+            year = 1900  # год по умолчанию
+
+    return year
+
+
+def make_excerpt(content):
+    return content[:100] + '...' if len(content) > 100 else content
+
+
+def letter_fields(row):
+    """Поля строки, нужные для построения письма (их передаем в процессы-классификаторы)"""
+    return row.get(COL_TEXT), row.get(COL_DATE), row.get(COL_PRINT_DATE)
+
+
+def build_letter_from_fields(content, date_value, print_date_value):
+    """Поля письма: (year, content, theme, sentiment, excerpt)"""
+    content = '' if content is None else str(content)
+    year = parse_year(date_value, print_date_value)
+    theme, sentiment = classifier.classify(content)
+    return (year, content, theme, sentiment, make_excerpt(content))
+
+
+def build_letter(row):
+    """Поля письма из строки Excel: (year, content, theme, sentiment, excerpt)"""
+    return build_letter_from_fields(*letter_fields(row))
+
+
+def build_letters_chunk(chunk):
+    """Письма пачки строк (поля из letter_fields): всю пачку классифицирует один
+    вызов classify_many. Выполняется и в процессе-воркере, и в основном процессе"""
+    contents = ['' if content is None else str(content) for content, _, _ in chunk]
+    labels = classifier.classify_many(contents)
+    return [
+        (parse_year(date_value, print_date_value), content, theme, sentiment, make_excerpt(content))
+        for content, (_, date_value, print_date_value), (theme, sentiment) in zip(contents, chunk, labels)
+    ]
+
+
+def _chunk_with_letters(chunk):
+    letters = build_letters_chunk([letter_fields(item[-1]) for item in chunk])
+    for item, letter in zip(chunk, letters):
+        yield item + (letter,)
+
+
+def with_letters(items, workers=1, chunk_size=CHUNK_SIZE):
+    """Добавляем к каждому элементу (…, row) построенное письмо: (…, row, letter).
+
+    Письма строятся пачками по chunk_size строк (build_letters_chunk), при
+    workers > 1 — в пуле процессов. Результаты забираем строго в порядке
+    отправки, поэтому вывод детерминирован и совпадает с последовательным.
+    В работе держим не больше workers * CHUNKS_IN_FLIGHT пачек, чтобы память
+    не росла с размером корпуса.
+    """
+    if workers <= 1:
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= chunk_size:
+                yield from _chunk_with_letters(chunk)
+                chunk = []
+        yield from _chunk_with_letters(chunk)
+        return
+
+    max_pending = workers * CHUNKS_IN_FLIGHT
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        def submit(chunk):
+            future = executor.submit(build_letters_chunk, [letter_fields(item[-1]) for item in chunk])
+            pending.append((chunk, future))
+
+        chunk = []
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= chunk_size:
+                submit(chunk)
+                chunk = []
+                while len(pending) >= max_pending:
+                    done_chunk, future = pending.popleft()
+                    for done_item, letter in zip(done_chunk, future.result()):
+                        yield done_item + (letter,)
+        if chunk:
+            submit(chunk)
+
+        while pending:
+            done_chunk, future = pending.popleft()
+            for done_item, letter in zip(done_chunk, future.result()):
+                yield done_item + (letter,)
+
+
+def set_bulk_pragmas(conn):
+    """Настройки SQLite на время массовой загрузки: без fsync.
+
+    Журнал не выключаем: с journal_mode = OFF откат не определен, и ошибка
+    посреди загрузки оставила бы таблицы наполовину очищенными. В WAL откат
+    работает, а без fsync загрузка почти так же быстра.
+    """
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    conn.execute('PRAGMA cache_size = -65536')
+
+
+def drop_indexes(conn):
+    """Удаляем индексы и триггеры таблиц данных, возвращаем их SQL для восстановления после загрузки"""
+    objects = migrations.table_objects(conn, DATA_TABLES)
+    for name, (kind, _) in objects.items():
+        conn.execute(f'DROP {kind.upper()} IF EXISTS {name}')
+    return objects
+
+
+def restore_indexes(conn, objects):
+    for _, sql in objects.values():
+        conn.execute(sql)
+    # Триггеры полнотекстового индекса на время загрузки были сняты — строим его целиком
+    search.rebuild_index(conn)
+
+
+def refresh_statistics(conn):
+    """Пересчитываем letter_stats целиком (после записи писем в обход LetterWriter, например демо-данных)"""
+    conn.execute('DELETE FROM letter_stats')
+    conn.execute('''
+        INSERT INTO letter_stats (dimension, value, count)
+        SELECT 'total', 'letters', COUNT(*) FROM letters
+        UNION ALL SELECT 'total', 'cities', COUNT(*) FROM cities
+        UNION ALL SELECT 'theme', COALESCE(theme, 'другое'), COUNT(*) FROM letters GROUP BY 2
+        UNION ALL SELECT 'sentiment', COALESCE(sentiment, 'neutral'), COUNT(*) FROM letters GROUP BY 2
+        UNION ALL SELECT 'year', year, COUNT(*) FROM letters WHERE year IS NOT NULL GROUP BY 2
+    ''')
+    timeline.rebuild_letter_cube(conn)
+    conn.execute('DELETE FROM letter_stats WHERE count <= 0')
+
+
+def load_source_hashes(conn):
+    """{ключ строки: хеш} для уже загруженных строк"""
+    return dict(conn.execute('SELECT source_key, row_hash FROM source_rows'))
+
+
+class LetterWriter:
+    """Пишет письма пачками и копит изменения счетчиков писем по городам
+    и сводной статистики letter_stats.
+
+    Используется и при полной перезагрузке, и при инкрементальной: строку
+    можно добавить, заменить (старые письма удаляются) или удалить по ключу.
+    """
+
+    def __init__(self, conn, batch_size=BATCH_SIZE, keep_removed=False):
+        self.conn = conn
+        self.batch_size = batch_size
+        # keep_removed — запоминаем удаленные письма (id, from_city_id, to_city_id,
+        # content, excerpt), чтобы потом убрать их из производных таблиц
+        self.removed = [] if keep_removed else None
+        self.city_ids = {name: city_id for city_id, name in conn.execute('SELECT id, name FROM cities')}
+        self.places = gazetteer.PlaceResolver(conn)
+        self.count_deltas = {}
+        self.stat_deltas = {}
+        self.cube_deltas = {}
+        self.letters = []
+        self.sources = []
+        self.pending_deletes = []
+        self.inserted = 0
+        self.deleted = 0
+
+    def get_city_id(self, city_name):
+        """id города; новые города вставляем сразу, чтобы получить их id.
+
+        Город, которого нет в справочнике мест, получает координаты NULL:
+        его письма остаются в базе, но маркера на карте нет.
+        """
+        if city_name not in self.city_ids:
+            latitude, longitude = self.places.coordinates(city_name)
+            cursor = self.conn.execute(INSERT_CITY_SQL, (city_name, latitude, longitude, 0))
+            self.city_ids[city_name] = cursor.lastrowid
+        return self.city_ids[city_name]
+
+    def count_stats(self, year, theme, sentiment, city_ids, delta):
+        """Учитываем открытку (delta открыток) в сводной статистике и кубе letter_cube"""
+        timeline.add_to_cube(self.cube_deltas, year, theme, sentiment, city_ids, delta)
+        keys = [('total', 'letters'), ('theme', theme or 'другое'), ('sentiment', sentiment or 'neutral')]
+        if year is not None:
+            keys.append(('year', year))
+        for key in keys:
+            self.stat_deltas[key] = self.stat_deltas.get(key, 0) + delta
+
+    def add(self, source_key, digest, row, letter=None, replace=False):
+        """Добавляем письмо строки; replace=True — сначала удаляем прежнее.
+
+        letter — уже построенное письмо (из пула классификаторов), иначе строим здесь.
+        """
+        if replace:
+            self.pending_deletes.append(source_key)
+
+        from_city = normalize_city_name(row.get(COL_FROM_CITY))
+        to_city = normalize_city_name(row.get(COL_TO_CITY))
+        from_id = self.get_city_id(from_city) if from_city else None
+        to_id = self.get_city_id(to_city) if to_city else None
+
+        if letter is None:
+            letter = build_letter(row)
+
+        # Одна строка на открытку со ссылками на оба города; письмо внутри
+        # одного города считается у него один раз
+        if from_id or to_id:
+            self.letters.append((source_key, from_id, to_id) + letter)
+            city_ids = {from_id, to_id} - {None}
+            for city_id in city_ids:
+                self.count_deltas[city_id] = self.count_deltas.get(city_id, 0) + 1
+            year, _, theme, sentiment, _ = letter
+            self.count_stats(year, theme, sentiment, city_ids, 1)
+        self.sources.append((source_key, digest))
+
+        if len(self.letters) >= self.batch_size:
+            self.flush()
+
+    def delete(self, source_key):
+        self.pending_deletes.append(source_key)
+        if len(self.pending_deletes) >= DELETE_CHUNK:
+            self.flush()
+
+    def _apply_deletes(self):
+        keys = self.pending_deletes
+        self.pending_deletes = []
+        for start in range(0, len(keys), DELETE_CHUNK):
+            chunk = keys[start:start + DELETE_CHUNK]
+            placeholders = ', '.join('?' * len(chunk))
+            for city_id, count in self.conn.execute(
+                f'SELECT city_id, COUNT(*) FROM city_letters WHERE source_key IN ({placeholders}) GROUP BY city_id',
+                chunk
+            ):
+                self.count_deltas[city_id] = self.count_deltas.get(city_id, 0) - count
+            for year, theme, sentiment, from_id, to_id, count in self.conn.execute(
+                f'SELECT year, theme, sentiment, from_city_id, to_city_id, COUNT(*) FROM letters '
+                f'WHERE source_key IN ({placeholders}) GROUP BY year, theme, sentiment, from_city_id, to_city_id',
+                chunk
+            ):
+                self.count_stats(year, theme, sentiment, {from_id, to_id} - {None}, -count)
+            if self.removed is not None:
+                self.removed.extend(self.conn.execute(
+                    f'SELECT id, from_city_id, to_city_id, content, excerpt FROM letters '
+                    f'WHERE source_key IN ({placeholders})',
+                    chunk
+                ))
+            cursor = self.conn.execute(f'DELETE FROM letters WHERE source_key IN ({placeholders})', chunk)
+            self.deleted += cursor.rowcount
+            self.conn.execute(f'DELETE FROM source_rows WHERE source_key IN ({placeholders})', chunk)
+
+    def flush(self):
+        # Сначала удаления: замененная строка должна потерять старые письма до вставки новых
+        if self.pending_deletes:
+            self._apply_deletes()
+        if self.letters:
+            self.conn.executemany(INSERT_LETTER_SQL, self.letters)
+            self.inserted += len(self.letters)
+            self.letters.clear()
+        if self.sources:
+            self.conn.executemany(UPSERT_SOURCE_SQL, self.sources)
+            self.sources.clear()
+
+    def finish(self):
+        """Сбрасываем остаток пачки и применяем изменения счетчиков городов"""
+        self.flush()
+        self.places.save()
+        self.conn.executemany(
+            'UPDATE cities SET letter_count = letter_count + ? WHERE id = ?',
+            [(delta, city_id) for city_id, delta in self.count_deltas.items() if delta]
+        )
+        # Города, у которых не осталось писем, при полной загрузке не появились бы
+        self.conn.execute('DELETE FROM cities WHERE letter_count <= 0')
+        self.count_deltas.clear()
+
+        self.conn.executemany(
+            UPSERT_STAT_SQL,
+            [(dimension, value, delta) for (dimension, value), delta in self.stat_deltas.items() if delta]
+        )
+        self.conn.execute(
+            "INSERT OR REPLACE INTO letter_stats (dimension, value, count) "
+            "SELECT 'total', 'cities', COUNT(*) FROM cities"
+        )
+        self.conn.execute('DELETE FROM letter_stats WHERE count <= 0')
+        self.stat_deltas.clear()
+
+        timeline.apply_cube_deltas(self.conn, self.cube_deltas)
+        self.cube_deltas.clear()
+
+
+def _load_full(conn, excel_path, batch_size, workers):
+    """Полная перезагрузка: очищаем таблицы и заливаем все строки"""
+    set_bulk_pragmas(conn)
+    conn.execute('BEGIN')
+    # Индексы (и полнотекстовый) создаем после массовой вставки — так быстрее,
+    # чем обновлять их на каждой строке
+    indexes = drop_indexes(conn)
+    for table in DATA_TABLES:
+        conn.execute(f'DELETE FROM {table}')
+    # id писем и городов снова начинаются с 1
+    placeholders = ', '.join('?' * len(DATA_TABLES))
+    conn.execute(f'DELETE FROM sqlite_sequence WHERE name IN ({placeholders})', DATA_TABLES)
+
+    writer = LetterWriter(conn, batch_size)
+    rows = 0
+    for source_key, digest, row, letter in with_letters(iter_source_rows(excel_path), workers):
+        rows += 1
+        inserted_before = writer.inserted
+        writer.add(source_key, digest, row, letter)
+        if writer.inserted != inserted_before:
+            print(f"  … {rows} строк, {writer.inserted} писем")
+    writer.finish()
+
+    restore_indexes(conn, indexes)
+    # Триггеры R*Tree городов тоже были сняты
+    geo.rebuild_city_rtree(conn)
+    mentions.rebuild_city_mentions(conn)
+    geo.rebuild_city_clusters(conn)
+    return {'rows': rows, 'added': rows, 'changed': 0, 'removed': 0}, writer
+
+
+def _load_incremental(conn, excel_path, batch_size, workers):
+    """Инкрементальная загрузка: применяем только добавленные, измененные и удаленные строки"""
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute('BEGIN')
+
+    known = load_source_hashes(conn)
+    cities_before = load_city_states(conn)
+    # AUTOINCREMENT: новые письма этой загрузки получат id больше последнего
+    last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM letters').fetchone()[0]
+    writer = LetterWriter(conn, batch_size, keep_removed=True)
+    counters = {'rows': 0, 'added': 0, 'changed': 0}
+
+    def changed_rows():
+        """Только новые и измененные строки — классифицировать остальные незачем"""
+        for source_key, digest, row in iter_source_rows(excel_path):
+            counters['rows'] += 1
+            old_digest = known.pop(source_key, None)
+            if old_digest is None:
+                counters['added'] += 1
+                yield source_key, digest, False, row
+            elif old_digest != digest:
+                counters['changed'] += 1
+                yield source_key, digest, True, row
+
+    for source_key, digest, replace, row, letter in with_letters(changed_rows(), workers):
+        writer.add(source_key, digest, row, letter, replace=replace)
+
+    # Все, что осталось в known, из Excel удалили
+    for source_key in known:
+        writer.delete(source_key)
+    writer.finish()
+    # Справочник мест изменился — координаты прежних городов пересчитываем
+    # (R*Tree обновят триггеры)
+    if writer.places.stale:
+        gazetteer.relocate_cities(conn, writer.places)
+    cities_after = load_city_states(conn)
+    update_derived_tables(conn, writer.removed, last_id, cities_before, cities_after)
+
+    return dict(counters, removed=len(known)), writer
+
+
+def load_city_states(conn):
+    """{id: (название, широта, долгота, число писем)} всех городов"""
+    return {
+        city_id: state for city_id, *state in conn.execute(
+            'SELECT id, name, latitude, longitude, letter_count FROM cities'
+        )
+    }
+
+
+def update_derived_tables(conn, removed, last_id, cities_before, cities_after):
+    """Переносим изменения писем в словарь нечеткого поиска, граф упоминаний и кластеры карты.
+
+    Тексты в индексах уже обновили триггеры. Здесь читаются только удаленные
+    письма removed и новые (id больше last_id), а кластеры пересчитываются в
+    клетках городов, у которых изменились число писем или координаты. Граф
+    упоминаний строится заново, только если изменился набор городов: новое
+    название может найтись в старых письмах.
+    """
+    added = conn.execute(
+        'SELECT id, from_city_id, to_city_id, content, excerpt FROM letters WHERE id > ?', (last_id,)
+    ).fetchall()
+    if removed or added:
+        terms = set()
+        for *_, content, excerpt in removed + added:
+            for text in (content, excerpt):
+                if text:
+                    terms |= search.index_terms(text)
+        search.update_terms(conn, terms)
+
+    if cities_before.keys() != cities_after.keys():
+        mentions.rebuild_city_mentions(conn)
+    elif removed or added:
+        mentions.apply_mention_deltas(conn, [row[:4] for row in removed], [row[:4] for row in added])
+
+    points = set()
+    for city_id in cities_before.keys() | cities_after.keys():
+        before, after = cities_before.get(city_id), cities_after.get(city_id)
+        if before == after:
+            continue
+        for state in (before, after):
+            if state and state[1] is not None and state[2] is not None:
+                points.add((state[1], state[2]))
+    if points:
+        geo.update_city_clusters(conn, points)
+
+
+def ingest_excel(excel_path=DEFAULT_EXCEL_PATH, db_path=DEFAULT_DB_PATH, batch_size=BATCH_SIZE,
+                 incremental=False, workers=1, write_snapshot=True):
+    """Загрузка корпуса из Excel. Возвращает словарь со статистикой.
+
+    incremental=True — применяем к базе только изменения относительно прошлой
+    загрузки. Если база собрана другой версией схемы или классификатора,
+    все равно делаем полную перезагрузку.
+
+    workers > 1 — классифицируем письма в пуле процессов; в базу по-прежнему
+    пишет только текущий процесс.
+
+    write_snapshot — после загрузки пишем колоночный снимок (snapshot.py).
+    """
+    started = time.perf_counter()
+    # Отпечаток снимаем до чтения, чтобы правка файла во время загрузки не потерялась
+    fingerprint = manifest.source_fingerprint(excel_path)
+
+    if incremental and not manifest.is_compatible(db_path):
+        print("ℹ️ База собрана другой версией схемы, выполняем полную загрузку")
+        incremental = False
+
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    migrations.migrate(conn)
+
+    try:
+        if incremental:
+            stats, writer = _load_incremental(conn, excel_path, batch_size, workers)
+        else:
+            stats, writer = _load_full(conn, excel_path, batch_size, workers)
+        manifest.bump_generation(conn)
+        # Манифест меняется в той же транзакции, что и письма: если загрузка
+        # упадет, откат вернет и прежние письма, и прежний манифест
+        manifest.write_manifest(conn, fingerprint)
+        conn.execute('COMMIT')
+        # Пока сервер держит соединения, при закрытии WAL не удаляется: переносим
+        # его в базу и обрезаем, иначе после полной загрузки он размером с базу
+        busy, _, _ = conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+        if busy:
+            print("ℹ️ Журнал WAL занят читателями, его перенесет автоматическая контрольная точка")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
+
+    if write_snapshot:
+        snapshot.write_after_ingest(db_path)
+
+    elapsed = time.perf_counter() - started
+    stats.update({
+        'mode': 'incremental' if incremental else 'full',
+        'workers': workers,
+        'cities': len(writer.city_ids),
+        'letters_inserted': writer.inserted,
+        'letters_deleted': writer.deleted,
+        'seconds': elapsed,
+    })
+    if incremental:
+        print(f"✅ Обработано {stats['rows']} строк: +{stats['added']} новых, "
+              f"{stats['changed']} измененных, -{stats['removed']} удаленных за {elapsed:.1f} с")
+    else:
+        print(f"✅ Обработано {stats['rows']} строк: {stats['cities']} городов и "
+              f"{writer.inserted} писем за {elapsed:.1f} с")
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Загрузка корпуса открыток из Excel в SQLite")
+    parser.add_argument('excel_path', nargs='?', default=DEFAULT_EXCEL_PATH, help="путь к xlsx-файлу корпуса")
+    parser.add_argument('--db', default=DEFAULT_DB_PATH, help="путь к базе SQLite")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="писем в одной пачке INSERT")
+    parser.add_argument('--force', action='store_true', help="загрузить даже если файл не менялся")
+    parser.add_argument('--full', action='store_true', help="полная перезагрузка вместо применения изменений")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="процессов для классификации писем (1 — без пула)")
+    parser.add_argument('--no-snapshot', action='store_true', help="не писать колоночный снимок после загрузки")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.excel_path):
+        print(f"❌ Файл не найден: {args.excel_path}")
+        return 1
+
+    if not args.force and manifest.is_up_to_date(args.db, args.excel_path):
+        print("⏭️ Корпус не изменился, загрузка не нужна (используйте --force)")
+        return 0
+
+    print(f"🔄 Загружаем {args.excel_path} в {args.db}...")
+    ingest_excel(args.excel_path, args.db, args.batch_size, incremental=not args.full, workers=args.workers,
+                 write_snapshot=not args.no_snapshot)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+# manifest.py
+import sqlite3
+import os
+import hashlib
+import json
+from classifier import CLASSIFIER_VERSION
+from gazetteer import gazetteer_version
+
+# Версия схемы БД. Меняем при любом изменении таблиц — это заставит
+# перезагрузить корпус (версия классификатора живет в classifier.py).
+SCHEMA_VERSION = 4
+
+MANIFEST_KEY = 'excel_source'
+# Номер поколения данных: растет при каждой записи корпуса, по нему сбрасываются кеши ответов
+GENERATION_KEY = 'generation'
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    """SHA-256 содержимого файла, читаем кусками"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_fingerprint(path, with_hash=True):
+    """Отпечаток исходного файла: размер, время изменения и хеш содержимого"""
+    stat = os.stat(path)
+    fingerprint = {
+        'path': os.path.abspath(path),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'schema_version': SCHEMA_VERSION,
+        'classifier_version': CLASSIFIER_VERSION,
+        # Правка справочника мест не требует полной загрузки: инкрементальная
+        # пересчитает координаты городов
+        'gazetteer_version': gazetteer_version(),
+    }
+    if with_hash:
+        fingerprint['sha256'] = file_sha256(path)
+    return fingerprint
+
+
+def _ensure_table(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS ingest_manifest (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+
+
+def load_manifest(db_path):
+    """Читаем сохраненный манифест загрузки (или None)"""
+    if not os.path.exists(db_path):
+        return None
+    conn = sqlite3.connect(db_path)
+    try:
+        row = conn.execute(
+            'SELECT value FROM ingest_manifest WHERE key = ?', (MANIFEST_KEY,)
+        ).fetchone()
+    except sqlite3.OperationalError:
+        # Таблицы манифеста еще нет — база создана старой версией
+        row = None
+    finally:
+        conn.close()
+    return json.loads(row[0]) if row else None
+
+
+def write_manifest(conn, fingerprint):
+    """Записываем манифест в транзакции conn — вместе с самими письмами"""
+    _ensure_table(conn)
+    conn.execute(
+        'INSERT OR REPLACE INTO ingest_manifest (key, value) VALUES (?, ?)',
+        (MANIFEST_KEY, json.dumps(fingerprint, ensure_ascii=False))
+    )
+
+
+def save_manifest(db_path, excel_path, fingerprint=None):
+    """Сохраняем манифест отдельной транзакцией"""
+    if fingerprint is None:
+        fingerprint = source_fingerprint(excel_path)
+    conn = sqlite3.connect(db_path)
+    write_manifest(conn, fingerprint)
+    conn.commit()
+    conn.close()
+
+
+def clear_manifest(db_path):
+    """Сбрасываем манифест (например, когда в базе демо-данные)"""
+    conn = sqlite3.connect(db_path)
+    _ensure_table(conn)
+    conn.execute('DELETE FROM ingest_manifest WHERE key = ?', (MANIFEST_KEY,))
+    conn.commit()
+    conn.close()
+
+
+def bump_generation(conn):
+    """Увеличиваем поколение данных в той же транзакции, что и запись писем"""
+    _ensure_table(conn)
+    conn.execute(
+        "INSERT INTO ingest_manifest (key, value) VALUES (?, '1') "
+        "ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1",
+        (GENERATION_KEY,)
+    )
+
+
+def read_generation(conn):
+    """Текущее поколение данных (0, если база еще ни разу не загружалась)"""
+    try:
+        row = conn.execute('SELECT value FROM ingest_manifest WHERE key = ?', (GENERATION_KEY,)).fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return int(row[0]) if row else 0
+
+
+def is_compatible(db_path):
+    """Собрана ли база текущими версиями схемы и классификатора из Excel"""
+    saved = load_manifest(db_path)
+    return bool(saved) and (
+        saved.get('schema_version') == SCHEMA_VERSION
+        and saved.get('classifier_version') == CLASSIFIER_VERSION
+    )
+
+
+def is_up_to_date(db_path, excel_path):
+    """Проверяем, соответствует ли база текущему Excel-файлу.
+
+    Сначала сравниваем дешевые поля (размер, mtime, версии). Если изменился
+    только mtime (файл пересохранили или скопировали), сверяем хеш содержимого
+    и при совпадении обновляем манифест без перезагрузки.
+    """
+    saved = load_manifest(db_path)
+    if not saved:
+        return False
+
+    current = source_fingerprint(excel_path, with_hash=False)
+    for key in ('size', 'schema_version', 'classifier_version', 'gazetteer_version'):
+        if saved.get(key) != current[key]:
+            return False
+
+    if saved.get('mtime_ns') == current['mtime_ns']:
+        return True
+
+    current['sha256'] = file_sha256(excel_path)
+    if saved.get('sha256') != current['sha256']:
+        return False
+
+    save_manifest(db_path, excel_path, current)
+    return True
@@ -0,0 +1,140 @@
+# mentions.py
+"""Граф связей между городами: какие города упоминаются в письмах других городов.
+
+Письмо города A «упоминает» город B, если название B встречается в тексте
+письма без учета регистра, как раньше во фронтенде (hasCityMention), но
+только с начала слова: «Рим» не находится в «приметы», а «Санкт-Петербург»
+находится в «Санкт-Петербурге». Названия короче MIN_NAME_LENGTH букв
+(«С», «По» — следы ошибок разметки) и пометки транскрипции в квадратных
+скобках («[нрзб]») не учитываются.
+
+Упоминания собираются один раз при загрузке корпуса в таблицу city_mentions
+(A → B, число писем, id писем), а /api/connections читает из нее самые
+сильные связи. Инкрементальная загрузка переносит в граф только измененные
+письма, если набор городов остался прежним.
+
+Названия всех городов компилируются в автомат Ахо–Корасик (pyahocorasick),
+и каждое письмо просматривается за один проход. Без pyahocorasick
+проверяем вхождение каждого названия — заметно медленнее.
+"""
+import json
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+MIN_NAME_LENGTH = 3
+
+# Письма для графа: (id, from_city_id, to_city_id, content)
+LETTERS_SQL = 'SELECT id, from_city_id, to_city_id, content FROM letters ORDER BY id'
+
+INSERT_MENTION_SQL = '''
+    INSERT INTO city_mentions (city_id, mentioned_city_id, count, letter_ids)
+    VALUES (?, ?, ?, ?)
+'''
+
+
+class CityNameMatcher:
+    """Находит id всех городов, чьи названия встречаются в тексте"""
+
+    def __init__(self, cities):
+        # Разные города могут совпадать по названию без учета регистра
+        self.ids_by_name = {}
+        for city_id, name in cities:
+            name = (name or '').strip().lower()
+            if '[' in name or ']' in name:
+                continue
+            if sum(char.isalpha() for char in name) >= MIN_NAME_LENGTH:
+                self.ids_by_name.setdefault(name, []).append(city_id)
+
+        self.automaton = None
+        if ahocorasick is not None and self.ids_by_name:
+            self.automaton = ahocorasick.Automaton()
+            for name, ids in self.ids_by_name.items():
+                self.automaton.add_word(name, (len(name), tuple(ids)))
+            self.automaton.make_automaton()
+
+    @staticmethod
+    def _at_word_start(content_lower, start):
+        return start == 0 or not content_lower[start - 1].isalnum()
+
+    def find(self, content_lower):
+        found = set()
+        if self.automaton is not None:
+            for end, (length, ids) in self.automaton.iter(content_lower):
+                if self._at_word_start(content_lower, end - length + 1):
+                    found.update(ids)
+            return found
+        for name, ids in self.ids_by_name.items():
+            start = content_lower.find(name)
+            while start != -1:
+                if self._at_word_start(content_lower, start):
+                    found.update(ids)
+                    break
+                start = content_lower.find(name, start + 1)
+        return found
+
+
+def letter_edges(matcher, letters):
+    """{(город, упомянутый город): [id писем]} для писем (id, from_city_id, to_city_id, content)"""
+    edges = {}
+    for letter_id, from_id, to_id, content in letters:
+        if not content:
+            continue
+        # Текст открытки просматриваем один раз, упоминания — у обоих ее городов
+        found = matcher.find(content.lower())
+        for city_id in {from_id, to_id} - {None}:
+            for mentioned_id in found:
+                if mentioned_id != city_id:
+                    edges.setdefault((city_id, mentioned_id), []).append(letter_id)
+    return edges
+
+
+def rebuild_city_mentions(conn, letters_sql=LETTERS_SQL):
+    """Пересобираем city_mentions по всем письмам. Возвращает число связей.
+
+    Новый город может упоминаться в старых письмах, поэтому после загрузки,
+    изменившей набор городов, граф строится заново целиком. letters_sql —
+    запрос писем для старых версий схемы (миграции).
+    """
+    matcher = CityNameMatcher(conn.execute('SELECT id, name FROM cities').fetchall())
+    edges = letter_edges(matcher, conn.execute(letters_sql))
+
+    conn.execute('DELETE FROM city_mentions')
+    conn.executemany(INSERT_MENTION_SQL, (
+        (city_id, mentioned_id, len(letter_ids), json.dumps(letter_ids))
+        for (city_id, mentioned_id), letter_ids in sorted(edges.items())
+    ))
+    return len(edges)
+
+
+def apply_mention_deltas(conn, removed, added):
+    """Переносим в city_mentions удаленные и добавленные письма (id, from_city_id, to_city_id, content).
+
+    Годится, только пока набор городов не менялся: иначе новое название может
+    найтись в старых письмах, и граф нужно пересобрать (rebuild_city_mentions).
+    Читаются и пишутся только связи, которых касаются эти письма. Возвращает
+    число измененных связей.
+    """
+    matcher = CityNameMatcher(conn.execute('SELECT id, name FROM cities').fetchall())
+    removed_edges = letter_edges(matcher, removed)
+    added_edges = letter_edges(matcher, added)
+    changed = 0
+    for edge in sorted(removed_edges.keys() | added_edges.keys()):
+        row = conn.execute(
+            'SELECT letter_ids FROM city_mentions WHERE city_id = ? AND mentioned_city_id = ?', edge
+        ).fetchone()
+        letter_ids = set(json.loads(row[0])) if row else set()
+        letter_ids.difference_update(removed_edges.get(edge, ()))
+        letter_ids.update(added_edges.get(edge, ()))
+        if letter_ids:
+            conn.execute(
+                'INSERT OR REPLACE INTO city_mentions (city_id, mentioned_city_id, count, letter_ids) '
+                'VALUES (?, ?, ?, ?)',
+                edge + (len(letter_ids), json.dumps(sorted(letter_ids)))
+            )
+        elif row:
+            conn.execute('DELETE FROM city_mentions WHERE city_id = ? AND mentioned_city_id = ?', edge)
+        changed += 1
+    return changed
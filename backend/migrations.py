@@ -0,0 +1,501 @@
+# migrations.py
+"""Версионированные миграции схемы postcards.db.
+
+Текущая версия схемы хранится в PRAGMA user_version. migrate() применяет
+по порядку все миграции новее нее, каждую в своей транзакции, поэтому
+существующая база обновляется на месте без перезагрузки корпуса.
+
+Новую миграцию добавляем в конец MIGRATIONS; уже выпущенные не меняем.
+
+Проверка, что все запросы API используют индексы (база не меняется):
+
+    python -m migrations [--db postcards.db] --check
+"""
+import sqlite3
+import sys
+import argparse
+from search import fold_sql, rebuild_terms
+from mentions import rebuild_city_mentions
+from geo import rebuild_city_clusters, rebuild_city_rtree
+from gazetteer import CREATE_RESOLUTIONS_SQL, relocate_cities
+from timeline import rebuild_letter_cube
+
+
+def _column_names(conn, table):
+    return {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+
+
+def _initial_schema(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS cities (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE,
+            latitude REAL,
+            longitude REAL,
+            letter_count INTEGER
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS letters (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            city_id INTEGER,
+            year INTEGER,
+            content TEXT,
+            theme TEXT,
+            sentiment TEXT,
+            excerpt TEXT,
+            FOREIGN KEY (city_id) REFERENCES cities (id)
+        )
+    ''')
+
+
+def _source_rows(conn):
+    # Базы до инкрементальной загрузки создавались без source_key
+    if 'source_key' not in _column_names(conn, 'letters'):
+        conn.execute('ALTER TABLE letters ADD COLUMN source_key TEXT')
+    # Строки исходного Excel: ключ строки и хеш ее содержимого
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS source_rows (
+            source_key TEXT PRIMARY KEY,
+            row_hash TEXT
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_letters_source_key ON letters (source_key)')
+
+
+def _letters_indexes(conn):
+    # (city_id, year) заменяет одиночный индекс по city_id: письма города сразу по годам
+    conn.execute('DROP INDEX IF EXISTS idx_letters_city_id')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_letters_city_year ON letters (city_id, year)')
+    # source_key в конце делает индексы покрывающими для подсчета открыток по темам и тональности
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_letters_theme_sentiment ON letters (theme, sentiment, source_key)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_letters_sentiment ON letters (sentiment, source_key)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_letters_year ON letters (year)')
+
+
+def _letters_keyset_indexes(conn):
+    # Постраничная выдача идет по id. Одноколоночный индекс неявно хранит rowid
+    # последним, поэтому 'city_id = ? AND id > ? ORDER BY id' читает ровно страницу
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_letters_city_id ON letters (city_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_letters_theme ON letters (theme)')
+
+
+def _letters_fts(conn):
+    # Индекс читает текст через представление со свернутой орфографией (ё → е и т.п.),
+    # а сами письма в letters хранятся как есть
+    conn.execute(f'''
+        CREATE VIEW IF NOT EXISTS letters_fts_source AS
+        SELECT id, {fold_sql('content')} AS content, {fold_sql('excerpt')} AS excerpt
+        FROM letters
+    ''')
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS letters_fts USING fts5(
+            content, excerpt,
+            content='letters_fts_source', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        )
+    ''')
+    # Триггеры поддерживают индекс при инкрементальной загрузке
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS letters_fts_ai AFTER INSERT ON letters BEGIN
+            INSERT INTO letters_fts (rowid, content, excerpt)
+            VALUES (new.id, {fold_sql('new.content')}, {fold_sql('new.excerpt')});
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS letters_fts_ad AFTER DELETE ON letters BEGIN
+            INSERT INTO letters_fts (letters_fts, rowid, content, excerpt)
+            VALUES ('delete', old.id, {fold_sql('old.content')}, {fold_sql('old.excerpt')});
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS letters_fts_au AFTER UPDATE OF content, excerpt ON letters BEGIN
+            INSERT INTO letters_fts (letters_fts, rowid, content, excerpt)
+            VALUES ('delete', old.id, {fold_sql('old.content')}, {fold_sql('old.excerpt')});
+            INSERT INTO letters_fts (rowid, content, excerpt)
+            VALUES (new.id, {fold_sql('new.content')}, {fold_sql('new.excerpt')});
+        END
+    ''')
+    conn.execute("INSERT INTO letters_fts (letters_fts) VALUES ('rebuild')")
+
+
+def _letters_trigram(conn):
+    # Триграммный индекс по тому же представлению: поиск подстроки в любом месте текста
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS letters_trigram USING fts5(
+            content,
+            content='letters_fts_source', content_rowid='id',
+            tokenize='trigram'
+        )
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS letters_trigram_ai AFTER INSERT ON letters BEGIN
+            INSERT INTO letters_trigram (rowid, content) VALUES (new.id, {fold_sql('new.content')});
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS letters_trigram_ad AFTER DELETE ON letters BEGIN
+            INSERT INTO letters_trigram (letters_trigram, rowid, content)
+            VALUES ('delete', old.id, {fold_sql('old.content')});
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS letters_trigram_au AFTER UPDATE OF content ON letters BEGIN
+            INSERT INTO letters_trigram (letters_trigram, rowid, content)
+            VALUES ('delete', old.id, {fold_sql('old.content')});
+            INSERT INTO letters_trigram (rowid, content) VALUES (new.id, {fold_sql('new.content')});
+        END
+    ''')
+    conn.execute("INSERT INTO letters_trigram (letters_trigram) VALUES ('rebuild')")
+
+    # Словарь letters_fts и его триграммы — для нечеткого поиска слов
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS letters_fts_vocab USING fts5vocab(letters_fts, 'row')")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS search_trigrams (
+            trigram TEXT,
+            length INTEGER,
+            term TEXT,
+            PRIMARY KEY (trigram, length, term)
+        ) WITHOUT ROWID
+    ''')
+    rebuild_terms(conn)
+
+
+def _letter_stats(conn):
+    # Сводная статистика корпуса, которую ingest поддерживает приращениями:
+    # ('total', 'letters' | 'cities'), ('theme', тема), ('sentiment', тональность), ('year', год)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS letter_stats (
+            dimension TEXT,
+            value,
+            count INTEGER,
+            PRIMARY KEY (dimension, value)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('DELETE FROM letter_stats')
+    conn.execute('''
+        INSERT INTO letter_stats (dimension, value, count)
+        SELECT 'total', 'letters', COUNT(DISTINCT source_key) FROM letters
+        UNION ALL SELECT 'total', 'cities', COUNT(*) FROM cities
+        UNION ALL SELECT 'theme', COALESCE(theme, 'другое'), COUNT(DISTINCT source_key) FROM letters GROUP BY 2
+        UNION ALL SELECT 'sentiment', COALESCE(sentiment, 'neutral'), COUNT(DISTINCT source_key) FROM letters GROUP BY 2
+        UNION ALL SELECT 'year', year, COUNT(DISTINCT source_key) FROM letters WHERE year IS NOT NULL GROUP BY 2
+    ''')
+
+
+def _city_mentions(conn):
+    # Граф упоминаний: письма города city_id, в которых названо mentioned_city_id
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS city_mentions (
+            city_id INTEGER,
+            mentioned_city_id INTEGER,
+            count INTEGER,
+            letter_ids TEXT,
+            PRIMARY KEY (city_id, mentioned_city_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_city_mentions_count ON city_mentions (count)')
+    # На этой версии схемы у письма один город — letters.city_id
+    rebuild_city_mentions(conn, 'SELECT id, city_id, NULL, content FROM letters ORDER BY id')
+
+
+def _letters_city_refs(conn):
+    # Открытка хранится одной строкой с городами отправителя и получателя,
+    # а не копией у каждого города. Таблицу пересоздаем: SQLite не удаляет
+    # столбцы с индексами. Представление полнотекстового индекса ссылается
+    # на letters и помешает переименованию — снимаем его на время, а триггеры
+    # пропадут вместе со старой таблицей — их тоже восстанавливаем
+    saved = table_objects(conn, ['letters', 'letters_fts_source'], ('trigger', 'view'))
+    conn.execute('DROP VIEW IF EXISTS letters_fts_source')
+    conn.execute('''
+        CREATE TABLE letters_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            source_key TEXT,
+            from_city_id INTEGER,
+            to_city_id INTEGER,
+            year INTEGER,
+            content TEXT,
+            theme TEXT,
+            sentiment TEXT,
+            excerpt TEXT,
+            FOREIGN KEY (from_city_id) REFERENCES cities (id),
+            FOREIGN KEY (to_city_id) REFERENCES cities (id)
+        )
+    ''')
+
+    # Копии одной открытки объединяем по source_key: первая (город отправителя)
+    # дает id и from_city_id, вторая — to_city_id. Открытка с одной копией
+    # считается отправленной из этого города; точные города восстановит
+    # полная перезагрузка (manifest.SCHEMA_VERSION)
+    postcards = {}
+    for letter_id, city_id, source_key, *fields in conn.execute(
+        'SELECT id, city_id, source_key, year, content, theme, sentiment, excerpt FROM letters ORDER BY id'
+    ):
+        key = source_key if source_key is not None else ('id', letter_id)
+        postcard = postcards.get(key)
+        if postcard is None:
+            postcards[key] = [letter_id, source_key, city_id, None] + fields
+        elif postcard[3] is None and city_id != postcard[2]:
+            postcard[3] = city_id
+    conn.executemany(
+        'INSERT INTO letters_new (id, source_key, from_city_id, to_city_id, year, content, theme, sentiment, excerpt) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        postcards.values()
+    )
+
+    conn.execute('DROP TABLE letters')
+    conn.execute('ALTER TABLE letters_new RENAME TO letters')
+    for _, sql in saved.values():
+        conn.execute(sql)
+
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_letters_source_key ON letters (source_key)')
+    # Одноколоночные индексы неявно заканчиваются rowid: письма города сразу по id
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_letters_from_city ON letters (from_city_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_letters_to_city ON letters (to_city_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_letters_theme_sentiment ON letters (theme, sentiment)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_letters_sentiment ON letters (sentiment)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_letters_year ON letters (year)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_letters_theme ON letters (theme)')
+
+    # Письма города — отправленные из него и полученные им (письмо внутри
+    # города — один раз). Условие city_id = ? SQLite переносит в обе части
+    # UNION ALL, и каждая читает свой индекс
+    conn.execute('''
+        CREATE VIEW IF NOT EXISTS city_letters AS
+        SELECT id, from_city_id AS city_id, source_key, from_city_id, to_city_id,
+               year, content, theme, sentiment, excerpt
+        FROM letters WHERE from_city_id IS NOT NULL
+        UNION ALL
+        SELECT id, to_city_id AS city_id, source_key, from_city_id, to_city_id,
+               year, content, theme, sentiment, excerpt
+        FROM letters WHERE to_city_id IS NOT NULL AND to_city_id IS NOT from_city_id
+    ''')
+
+    # id писем изменились — поисковые индексы и граф упоминаний строим заново
+    conn.execute("INSERT INTO letters_fts (letters_fts) VALUES ('rebuild')")
+    conn.execute("INSERT INTO letters_trigram (letters_trigram) VALUES ('rebuild')")
+    rebuild_terms(conn)
+    rebuild_city_mentions(conn)
+
+
+def _city_letters_year_indexes(conn):
+    # Письма города по годам: ветви city_letters читаются в порядке (year, id)
+    # и сливаются без сортировки
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_letters_from_city_year ON letters (from_city_id, year)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_letters_to_city_year ON letters (to_city_id, year)')
+
+
+def _city_clusters(conn):
+    # Кластеры маркеров карты для каждого зума: клетка сетки Web Mercator -> города и письма
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS city_clusters (
+            zoom INTEGER,
+            cell_x INTEGER,
+            cell_y INTEGER,
+            city_count INTEGER,
+            letter_count INTEGER,
+            latitude REAL,
+            longitude REAL,
+            south REAL,
+            west REAL,
+            north REAL,
+            east REAL,
+            city_id INTEGER,
+            name TEXT,
+            PRIMARY KEY (zoom, cell_x, cell_y)
+        ) WITHOUT ROWID
+    ''')
+    rebuild_city_clusters(conn)
+
+
+def _city_rtree(conn):
+    # Пространственный индекс городов: точка — вырожденный прямоугольник
+    conn.execute('CREATE VIRTUAL TABLE IF NOT EXISTS city_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon)')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS cities_rtree_ai AFTER INSERT ON cities
+        WHEN new.latitude IS NOT NULL AND new.longitude IS NOT NULL BEGIN
+            INSERT INTO city_rtree (id, min_lat, max_lat, min_lon, max_lon)
+            VALUES (new.id, new.latitude, new.latitude, new.longitude, new.longitude);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS cities_rtree_ad AFTER DELETE ON cities BEGIN
+            DELETE FROM city_rtree WHERE id = old.id;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS cities_rtree_au AFTER UPDATE OF latitude, longitude ON cities BEGIN
+            DELETE FROM city_rtree WHERE id = old.id;
+            INSERT INTO city_rtree (id, min_lat, max_lat, min_lon, max_lon)
+            SELECT new.id, new.latitude, new.latitude, new.longitude, new.longitude
+            WHERE new.latitude IS NOT NULL AND new.longitude IS NOT NULL;
+        END
+    ''')
+    rebuild_city_rtree(conn)
+
+
+def _place_resolutions(conn):
+    # Кеш разбора названий справочником мест; прежние координаты городов
+    # (случайные для незнакомых названий) пересчитываем по справочнику
+    conn.execute(CREATE_RESOLUTIONS_SQL)
+    relocate_cities(conn)
+    rebuild_city_clusters(conn)
+
+
+def _letter_cube(conn):
+    # Куб год × тема × тональность × город с итоговыми клетками ('' и 0 — «все»)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS letter_cube (
+            theme TEXT NOT NULL,
+            sentiment TEXT NOT NULL,
+            city_id INTEGER NOT NULL,
+            year INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (theme, sentiment, city_id, year)
+        ) WITHOUT ROWID
+    ''')
+    # Крупнейшие города среза за все годы (year = 0) для group=city
+    conn.execute(
+        'CREATE INDEX IF NOT EXISTS idx_letter_cube_top ON letter_cube (theme, sentiment, year, count DESC, city_id)'
+    )
+    rebuild_letter_cube(conn)
+
+
+def _cities_top_index(conn):
+    # Крупнейшие города карты (TOP_CITIES_SQL): индекс сразу в порядке выдачи
+    conn.execute(
+        'CREATE INDEX IF NOT EXISTS idx_cities_top ON cities (letter_count DESC, id) '
+        'WHERE latitude IS NOT NULL AND longitude IS NOT NULL'
+    )
+
+
+# (версия, описание, функция миграции)
+MIGRATIONS = [
+    (1, 'таблицы cities и letters', _initial_schema),
+    (2, 'source_key и source_rows для инкрементальной загрузки', _source_rows),
+    (3, 'вторичные индексы letters', _letters_indexes),
+    (4, 'индексы для постраничной выдачи писем', _letters_keyset_indexes),
+    (5, 'полнотекстовый индекс letters_fts', _letters_fts),
+    (6, 'триграммный индекс letters_trigram и словарь для нечеткого поиска', _letters_trigram),
+    (7, 'сводная статистика letter_stats', _letter_stats),
+    (8, 'граф упоминаний городов city_mentions', _city_mentions),
+    (9, 'одна строка letters на открытку: from_city_id и to_city_id', _letters_city_refs),
+    (10, 'индексы писем города по годам', _city_letters_year_indexes),
+    (11, 'кластеры маркеров карты city_clusters', _city_clusters),
+    (12, 'R*Tree city_rtree для запросов по видимой области', _city_rtree),
+    (13, 'кеш справочника мест place_resolutions и координаты городов по нему', _place_resolutions),
+    (14, 'куб писем letter_cube для временных рядов', _letter_cube),
+    (15, 'индекс крупнейших городов карты', _cities_top_index),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn, target=LATEST_VERSION):
+    """Применяем недостающие миграции. Возвращает список примененных версий."""
+    applied = []
+    current = get_version(conn)
+    for version, description, step in MIGRATIONS:
+        if version <= current or version > target:
+            continue
+        in_transaction = conn.in_transaction
+        if not in_transaction:
+            conn.execute('BEGIN')
+        try:
+            step(conn)
+            conn.execute(f'PRAGMA user_version = {version}')
+            if not in_transaction:
+                conn.execute('COMMIT')
+        except Exception:
+            if not in_transaction and conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        print(f"🛠️ Миграция {version}: {description}")
+        applied.append(version)
+    return applied
+
+
+def table_objects(conn, tables, types=('index', 'trigger')):
+    """{имя: (тип, SQL)} пользовательских индексов и триггеров таблиц (без автоматических)"""
+    table_marks = ', '.join('?' * len(tables))
+    type_marks = ', '.join('?' * len(types))
+    return {
+        name: (kind, sql) for name, kind, sql in conn.execute(
+            f"SELECT name, type, sql FROM sqlite_master WHERE sql IS NOT NULL "
+            f"AND type IN ({type_marks}) AND tbl_name IN ({table_marks})",
+            list(types) + list(tables)
+        )
+    }
+
+
+def query_plan(conn, sql, params=()):
+    """Строки EXPLAIN QUERY PLAN для запроса"""
+    return [row[-1] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+
+
+def uses_index(plan):
+    """Нет ли в плане полного просмотра таблицы без индекса"""
+    for detail in plan:
+        if detail.startswith('SCAN') and 'USING' not in detail and 'VIRTUAL TABLE' not in detail:
+            return False
+    return True
+
+
+def check_query_plans(conn):
+    """Проверяем планы всех запросов API. Возвращает список (имя, план) с полным просмотром."""
+    from database import API_QUERIES
+
+    failures = []
+    for name, (sql, params, full_scan_ok) in API_QUERIES.items():
+        plan = query_plan(conn, sql, params)
+        ok = full_scan_ok or uses_index(plan)
+        print(f"{'✅' if ok else '❌'} {name}: {' | '.join(plan)}")
+        if not ok:
+            failures.append((name, plan))
+    return failures
+
+
+def check_database(path):
+    """Проверяем планы запросов, не меняя базу: она открывается только для чтения,
+    а устаревшая схема мигрируется в копии в памяти"""
+    source = sqlite3.connect(f'file:{path}?mode=ro', uri=True, isolation_level=None)
+    try:
+        version = get_version(source)
+        if version >= LATEST_VERSION:
+            return check_query_plans(source)
+        print(f"ℹ️ Версия схемы {version} устарела, проверяем мигрированную копию в памяти")
+        conn = sqlite3.connect(':memory:', isolation_level=None)
+        try:
+            source.backup(conn)
+            migrate(conn)
+            return check_query_plans(conn)
+        finally:
+            conn.close()
+    finally:
+        source.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Миграции схемы postcards.db")
+    parser.add_argument('--db', default='postcards.db', help="путь к базе SQLite")
+    parser.add_argument('--check', action='store_true', help="проверить, что запросы API используют индексы")
+    args = parser.parse_args(argv)
+
+    if args.check:
+        return 1 if check_database(args.db) else 0
+    conn = sqlite3.connect(args.db, isolation_level=None)
+    try:
+        applied = migrate(conn)
+        print(f"✅ Версия схемы: {get_version(conn)}" + ("" if applied else " (без изменений)"))
+        return 0
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
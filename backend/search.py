@@ -0,0 +1,239 @@
+# search.py
+"""Полнотекстовый поиск по письмам (SQLite FTS5).
+
+Индекс letters_fts строится по тексту и отрывку письма. Перед индексацией
+и в запросе буквы приводятся к современной орфографии без ё (ё → е,
+ѣ → е, і → и, ѳ → ф, ѵ → и), а слова запроса усекаются до основы и ищутся
+по префиксу: «Одессы» находит «Одесса», «Одессе», «Одессой».
+
+Режимы поиска:
+    words     — по словам (letters_fts, ранжирование BM25);
+    substring — подстрока в любом месте текста (letters_trigram, токенизатор
+                trigram), как прежний поиск перебором, но без полного просмотра;
+                подстроки короче трех символов ищутся как начало слова;
+    fuzzy     — слова с опечатками и вариантами написания: кандидаты из словаря
+                индекса отбираются по числу общих триграмм (search_trigrams) и
+                проверяются расстоянием Левенштейна.
+"""
+import re
+import unicodedata
+
+# Буквы, которые сворачиваем и в индексе, и в запросе
+FOLD_CHARS = {
+    'ё': 'е', 'Ё': 'Е',
+    'ѣ': 'е', 'Ѣ': 'Е',
+    'і': 'и', 'І': 'И',
+    'ѳ': 'ф', 'Ѳ': 'Ф',
+    'ѵ': 'и', 'Ѵ': 'И',
+}
+_FOLD_TABLE = str.maketrans(FOLD_CHARS)
+
+# Окончания, которые отрезаем от слов запроса (самые длинные проверяем первыми)
+RU_ENDINGS = sorted([
+    'иями', 'ями', 'ами', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими', 'ешь', 'ишь', 'ете', 'ите',
+    'ой', 'ей', 'ий', 'ый', 'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ов', 'ев', 'ам', 'ям',
+    'ах', 'ях', 'ом', 'ем', 'ую', 'юю', 'ть', 'ти', 'ла', 'ло', 'ли', 'ет', 'ит', 'ут',
+    'ют', 'ат', 'ят', 'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь', 'й',
+], key=len, reverse=True)
+MIN_STEM = 3
+
+SNIPPET_TOKENS = 16
+# В триграммном индексе токен — три символа, поэтому фрагмент берем длиннее
+TRIGRAM_SNIPPET_TOKENS = 64
+HIGHLIGHT_OPEN = '<mark>'
+HIGHLIGHT_CLOSE = '</mark>'
+
+SEARCH_MODES = ('words', 'substring', 'fuzzy')
+
+# Триграммный индекс не ищет подстроки короче трех символов
+TRIGRAM_MIN = 3
+# Сколько вариантов слова из словаря берем в нечеткий запрос
+FUZZY_MAX_EXPANSIONS = 30
+FUZZY_MIN_TERM = 2
+
+_WORD_RE = re.compile(r'\w+')
+# Слово для токенизатора unicode61: буквы и цифры, подчеркивание — разделитель
+_TOKEN_RE = re.compile(r'[^\W_]+')
+# remove_diacritics снимает знаки только с латиницы: «й» остается «й»
+_LATIN_END = '\u0250'
+
+
+def fold(text):
+    """Приводим текст к виду, в котором он хранится в индексе"""
+    return text.translate(_FOLD_TABLE)
+
+
+def fold_sql(expression):
+    """SQL-выражение, сворачивающее те же буквы, что и fold()"""
+    for source, target in FOLD_CHARS.items():
+        expression = f"replace({expression}, '{source}', '{target}')"
+    return expression
+
+
+def stem(word):
+    """Грубая основа русского слова: отрезаем одно окончание, оставляя не меньше MIN_STEM букв"""
+    if len(word) <= MIN_STEM:
+        return word
+    for ending in RU_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM:
+            return word[:-len(ending)]
+    return word
+
+
+def fts_query(q):
+    """Строка MATCH для FTS5: все слова запроса по префиксу основы (И).
+
+    Каждое слово берется в кавычки, поэтому служебный синтаксис FTS5 из
+    пользовательского ввода не интерпретируется. Пустой запрос — None.
+    """
+    words = _WORD_RE.findall(fold(q.lower()))
+    if not words:
+        return None
+    return ' '.join(f'"{stem(word)}"*' for word in words)
+
+
+def substring_query(q):
+    """Строка MATCH для триграммного индекса или None, если подстрока короче TRIGRAM_MIN"""
+    text = fold(q.strip().lower())
+    if len(text) < TRIGRAM_MIN:
+        return None
+    return '"' + text.replace('"', '""') + '"'
+
+
+def max_edits(word):
+    """Допустимое число правок в зависимости от длины слова"""
+    if len(word) <= 3:
+        return 0
+    if len(word) <= 6:
+        return 1
+    return 2
+
+
+def word_trigrams(word):
+    """Множество триграмм слова с границами: '  w', ' wo', 'wor', ..., 'rd '"""
+    padded = f'  {word} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a, b, limit):
+    """Расстояние Левенштейна; если оно больше limit, возвращаем limit + 1"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (char_a != char_b),
+            ))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return min(previous[-1], limit + 1)
+
+
+def fuzzy_terms(conn, word):
+    """Слова словаря индекса не дальше max_edits(word) правок от word, ближайшие первыми.
+
+    Каждая правка портит не больше трех триграмм, поэтому у подходящего слова
+    не меньше len(триграмм) - 3 * правок общих триграмм с запросом — по этому
+    порогу кандидаты отбираются в SQL, до вычисления расстояния.
+    """
+    edits = max_edits(word)
+    if edits == 0:
+        return [word]
+    trigrams = word_trigrams(word)
+    min_shared = max(1, len(trigrams) - 3 * edits)
+    marks = ', '.join('?' * len(trigrams))
+    candidates = conn.execute(
+        f'''
+        SELECT term, COUNT(*) AS shared FROM search_trigrams
+        WHERE trigram IN ({marks}) AND length BETWEEN ? AND ?
+        GROUP BY term
+        HAVING shared >= ?
+        ''',
+        [*trigrams, len(word) - edits, len(word) + edits, min_shared]
+    )
+    matches = []
+    for term, shared in candidates:
+        distance = edit_distance(word, term, edits)
+        if distance <= edits:
+            matches.append((distance, -shared, term))
+    matches.sort()
+    return [term for _, _, term in matches[:FUZZY_MAX_EXPANSIONS]]
+
+
+def fuzzy_query(conn, q):
+    """Строка MATCH для letters_fts: каждое слово — любой из его близких вариантов (ИЛИ), слова — И"""
+    words = _WORD_RE.findall(fold(q.lower()))
+    if not words:
+        return None
+    groups = []
+    for word in words:
+        terms = fuzzy_terms(conn, word)
+        if not terms:
+            return None
+        groups.append('(' + ' OR '.join(f'"{term}"' for term in terms) + ')')
+    return ' AND '.join(groups)
+
+
+def _strip_latin_diacritics(word):
+    if word.isascii():
+        return word
+    return ''.join(
+        ''.join(part for part in unicodedata.normalize('NFD', char) if not unicodedata.combining(part))
+        if char < _LATIN_END else char
+        for char in word
+    )
+
+
+def index_terms(text):
+    """Множество слов текста в том виде, в каком они попадают в словарь letters_fts
+    (unicode61 remove_diacritics 2 поверх fold)"""
+    return {_strip_latin_diacritics(word) for word in _TOKEN_RE.findall(fold(text.lower()))}
+
+
+def _trigram_rows(terms):
+    # Вставка в порядке первичного ключа заметно быстрее, чем вразнобой
+    return sorted(
+        (trigram, len(term), term)
+        for term in terms
+        if len(term) >= FUZZY_MIN_TERM and not term.isdigit()
+        for trigram in word_trigrams(term)
+    )
+
+
+def rebuild_terms(conn):
+    """Перестраиваем триграммы словаря letters_fts для нечеткого поиска"""
+    conn.execute('DELETE FROM search_trigrams')
+    terms = [term for (term,) in conn.execute('SELECT term FROM letters_fts_vocab').fetchall()]
+    conn.executemany('INSERT INTO search_trigrams (trigram, length, term) VALUES (?, ?, ?)', _trigram_rows(terms))
+
+
+def update_terms(conn, terms):
+    """Сверяем триграммы слов terms со словарем letters_fts после вставки и удаления писем.
+
+    Слово, которое осталось в словаре, получает триграммы (если их еще не было),
+    а исчезнувшее их теряет; остальной словарь не читается. Возвращает число
+    исчезнувших слов.
+    """
+    present, gone = [], []
+    for term in terms:
+        found = conn.execute('SELECT 1 FROM letters_fts_vocab WHERE term = ?', (term,)).fetchone()
+        (present if found else gone).append(term)
+    conn.executemany(
+        'INSERT OR IGNORE INTO search_trigrams (trigram, length, term) VALUES (?, ?, ?)', _trigram_rows(present)
+    )
+    conn.executemany(
+        'DELETE FROM search_trigrams WHERE trigram = ? AND length = ? AND term = ?', _trigram_rows(gone)
+    )
+    return len(gone)
+
+
+def rebuild_index(conn):
+    """Полностью перестраиваем поисковые индексы по таблице letters (после массовой загрузки)"""
+    conn.execute("INSERT INTO letters_fts (letters_fts) VALUES ('rebuild')")
+    conn.execute("INSERT INTO letters_trigram (letters_trigram) VALUES ('rebuild')")
+    rebuild_terms(conn)
@@ -0,0 +1,201 @@
+# synth_corpus.py
+"""Синтетический корпус открыток для бенчмарков на больших объемах.
+
+Пишет книгу xlsx с теми же колонками, что у корпуса хакатона, и похожими
+данными: места из газеттира с убыванием частоты по Ципфу (плюс хвост
+выдуманных деревень, которых в газеттире нет), записи мест в разных
+форматах ('г. Москва', 'РСФСР, г. Ленинград', '[отсутствует]'), даты с
+пиком в 1900–1917 годах, пропуски дат и даты печати вида 'xx.xx.1914',
+тексты из приветствия, нескольких фраз и подписи со словами всех тем и
+тональностей классификатора, упоминания других городов в тексте.
+
+В лист xlsx помещается чуть больше миллиона строк, поэтому большие
+корпуса продолжаются на следующих листах с тем же заголовком (ingest
+читает их подряд). Одинаковые --rows и --seed дают одинаковую книгу.
+
+    python -m synth_corpus synthetic.xlsx [--rows 100000] [--seed 1]
+"""
+import os
+import sys
+import csv
+import time
+import random
+import argparse
+from datetime import datetime
+from itertools import accumulate
+from openpyxl import Workbook
+import gazetteer
+from ingest import COL_FROM_CITY, COL_TO_CITY, COL_TEXT, COL_DATE, COL_PRINT_DATE
+
+SIZES = (10_000, 100_000, 1_000_000, 10_000_000)
+SHEET_ROWS = 1_000_000
+SHEET_TITLE = 'Корпус'
+MISSING = '[отсутствует]'
+
+# Заголовок как в корпусе хакатона; первая колонка без названия — ссылка на открытку
+HEADER = [
+    None, 'Язык текста открытки', COL_TEXT, 'Перевод текста открытки (если на иностранном языке)',
+    'Вид орфографии', 'Адрес отправителя', 'Имя отправителя', 'Адрес получателя', 'Индекс получателя',
+    'Имя получателя', 'Описание изображения', COL_PRINT_DATE,
+    'Доп. сведения о получателе (например, титул, "дядя", "товарищ")',
+    'Доп. сведения об отправителе (например, титул, "твой дядя", "князь")',
+    COL_DATE, 'Страна (откуда)', COL_FROM_CITY, 'Страна (куда)', COL_TO_CITY,
+]
+CARD_URL = 'https://pishutebe.ru/card/{}'
+
+NAMES = ['Маша', 'Коля', 'Анна Петровна', 'Ваня', 'Оля', 'Сергей Иванович', 'Шура', 'Лиза', 'Петя', 'Нина',
+         'Костя', 'Вера Николаевна', 'Миша', 'Таня', 'Гриша', 'Люба']
+GREETINGS = ['Милая {name}!', 'Дорогой {name}!', 'Здравствуй, {name}!', 'Добрый день, {name}!',
+             'Здравствуйте, дорогие мои!', 'Привет из {city}!', 'Уважаемый {name}!', 'Любимая моя {name}!',
+             'Дорогие мама и папа!', 'Христос воскресе, {name}!']
+SENTENCES = [
+    'Доехали благополучно, погода стоит теплая.', 'Пишу тебе с дороги, скоро будем дома.',
+    'Вчера получила твое письмо, спасибо.', 'У нас все по-старому, новостей мало.',
+    'Посылаю тебе вид нашего города.', 'Жду ответа, пиши чаще.', 'Здесь очень красиво, много гуляем.',
+    'Скучаю по вам всем.', 'Дети здоровы, в школе у них все хорошо.', 'На работе много дел, устаю.',
+    'Поздравляю с праздником и желаю счастья!', 'Экзамены сдал, теперь отдыхаю.',
+    'Зима в этом году тяжелая, часто болеем.', 'Жаль, что не смогли увидеться.', 'Как твои дела на службе?',
+    'Передай поклон родителям и брату.', 'Были проездом в {city}, вспоминали тебя.',
+    'Сестра уехала в {city} учиться.', 'Встретил старого товарища, он кланяется.',
+    'Очень рада, что у вас все благополучно.', 'Мама больна, и нам грустно.', 'Поздравляю с Пасхой!',
+    'Скоро вернусь в {city}, тогда все расскажу.', 'Дела идут плохо, заработка нет.',
+    'Познакомились с прекрасными людьми.', 'Спасибо за посылку, все дошло в целости.',
+]
+CLOSINGS = ['Целую крепко.', 'Обнимаю, твоя {name}.', 'Твой друг {name}.', 'До свидания.',
+            'Привет всем нашим.', 'Остаюсь преданный вам {name}.', 'Пиши. {name}.']
+PLACE_FORMATS = [('{}', 30), ('г. {}', 30), ('город {}', 10)]
+SOVIET_PLACE_FORMATS = [('РСФСР, г. {}', 15), ('СССР, г. {}', 5)]
+# Хвост деревень, которых нет в газеттире
+VILLAGE_PARTS = (['Ново', 'Старо', 'Верхне', 'Нижне', 'Красно', 'Бело', 'Сосно', 'Мало'],
+                 ['сел', 'берез', 'полян', 'озер', 'горск', 'дуб', 'лес', 'реч'],
+                 ['ки', 'овка', 'ное', 'ье', 'ино', 'ицы'])
+
+
+class CorpusGenerator:
+    """Строки синтетического корпуса, детерминированные по seed"""
+
+    def __init__(self, rows, seed=1, gazetteer_path=gazetteer.GAZETTEER_PATH):
+        self.rng = random.Random(seed)
+        with open(gazetteer_path, encoding='utf-8', newline='') as f:
+            places = [(row['name'], [v for v in (row.get('variants') or '').split('|') if v])
+                      for row in csv.DictReader(f)]
+        self.places = places
+        # Частота места по Ципфу: газеттир начинается с крупных городов
+        self.place_weights = list(accumulate(1 / (rank + 1) ** 1.1 for rank in range(len(places))))
+        prefixes, roots, endings = VILLAGE_PARTS
+        village_count = max(50, rows // 200)
+        self.villages = [
+            f'{self.rng.choice(["д.", "с.", "село"])} {self.rng.choice(prefixes)}{self.rng.choice(roots)}'
+            f'{self.rng.choice(endings)}-{index}'
+            for index in range(village_count)
+        ]
+
+    def place(self):
+        rng = self.rng
+        if rng.random() < 0.05:
+            return rng.choice(self.villages)
+        name, variants = rng.choices(self.places, cum_weights=self.place_weights)[0]
+        # Иногда — историческое или иное название того же места
+        if variants and rng.random() < 0.15:
+            name = rng.choice(variants)
+        return name
+
+    def place_cell(self, year):
+        rng = self.rng
+        formats = PLACE_FORMATS + (SOVIET_PLACE_FORMATS if year and year >= 1922 else [])
+        template = rng.choices([f for f, _ in formats], weights=[w for _, w in formats])[0]
+        return template.format(self.place())
+
+    def date(self):
+        rng = self.rng
+        if rng.random() < 0.15:
+            return None
+        if rng.random() < 0.55:
+            year = int(rng.triangular(1895, 1918, 1912))
+        else:
+            year = rng.randint(1920, 1991)
+        if rng.random() < 0.1:
+            return datetime(year, 1, 1)
+        return datetime(year, rng.randint(1, 12), rng.randint(1, 28))
+
+    def print_date(self, date):
+        rng = self.rng
+        roll = rng.random()
+        if roll < 0.65:
+            return MISSING
+        year = date.year if date else rng.randint(1895, 1991)
+        year -= rng.randint(0, 3)
+        if roll < 0.85:
+            return f'xx.xx.{year}'
+        return datetime(year, 1, 1)
+
+    def text(self):
+        rng = self.rng
+
+        def fill(template):
+            return template.format(name=rng.choice(NAMES), city=self.place())
+
+        parts = [fill(rng.choice(GREETINGS))]
+        parts += [fill(sentence) for sentence in rng.sample(SENTENCES, rng.randint(1, 5))]
+        parts.append(fill(rng.choice(CLOSINGS)))
+        return ' '.join(parts)
+
+    def row(self, number):
+        rng = self.rng
+        date = self.date()
+        year = date.year if date else None
+        from_city = MISSING if rng.random() < 0.3 else self.place_cell(year)
+        to_city = MISSING if rng.random() < 0.18 else self.place_cell(year)
+        country = 'Российская Империя' if year and year < 1918 else 'СССР'
+        # Колонки, которые ingest не читает, оставляем пустыми: openpyxl тратит
+        # на каждую заполненную ячейку десятки микросекунд, а книгу на 10 млн строк
+        # и так пишет около часа
+        return [
+            CARD_URL.format(number), 'русский', self.text(), None,
+            'Дореволюционная' if year and year < 1918 else 'Современная', None, None, None, None,
+            None, None, self.print_date(date), None, None,
+            date, country, from_city, country, to_city,
+        ]
+
+
+def generate_workbook(path, rows, seed=1):
+    """Пишем книгу из rows строк; возвращает число листов"""
+    generator = CorpusGenerator(rows, seed)
+    workbook = Workbook(write_only=True)
+    sheets = 0
+    tmp_path = path + '.tmp'
+    try:
+        for number in range(rows):
+            if number % SHEET_ROWS == 0:
+                sheets += 1
+                sheet = workbook.create_sheet(SHEET_TITLE if sheets == 1 else f'{SHEET_TITLE} {sheets}')
+                sheet.append(HEADER)
+            sheet.append(generator.row(number + 1))
+        if not sheets:
+            workbook.create_sheet(SHEET_TITLE).append(HEADER)
+            sheets = 1
+        workbook.save(tmp_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+    return sheets
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Синтетический корпус открыток в xlsx")
+    parser.add_argument('out', help="путь к xlsx")
+    parser.add_argument('--rows', type=int, default=SIZES[0], help="число открыток")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    sheets = generate_workbook(args.out, args.rows, args.seed)
+    print(f"📝 {args.out}: {args.rows} открыток на {sheets} листах, {os.path.getsize(args.out) / 1e6:.1f} МБ "
+          f"за {time.perf_counter() - started:.1f} с")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
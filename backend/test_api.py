@@ -0,0 +1,99 @@
+# test_api.py
+"""Эндпоинты чтения поверх демо-данных: кеш ответов и ETag по поколению данных"""
+import sqlite3
+import pytest
+from fastapi.testclient import TestClient
+import database
+import manifest
+from app import app
+from cache import response_cache
+from database import db
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # Поколение перечитываем на каждом запросе, а не раз в секунду
+    monkeypatch.setattr(database, 'GENERATION_CHECK_INTERVAL', 0)
+    response_cache.clear()
+    with TestClient(app) as client:
+        yield client
+
+
+def set_total_letters(count, bump=True):
+    """Меняем статистику в базе, как это сделала бы загрузка корпуса"""
+    conn = sqlite3.connect(db.db_path, isolation_level=None)
+    conn.execute('BEGIN')
+    conn.execute("UPDATE letter_stats SET count = ? WHERE dimension = 'total' AND value = 'letters'", (count,))
+    if bump:
+        manifest.bump_generation(conn)
+    conn.execute('COMMIT')
+    conn.close()
+
+
+def locked_database(patch):
+    """Любой запрос к базе падает, как при занятом файле"""
+    def locked():
+        raise sqlite3.OperationalError('database is locked')
+    patch.setattr(db, 'connection', locked)
+
+
+def test_cache_is_invalidated_by_generation(client):
+    total = client.get('/api/statistics').json()['total_letters']
+    try:
+        # Без нового поколения отвечает кеш
+        set_total_letters(total + 10, bump=False)
+        assert client.get('/api/statistics').json()['total_letters'] == total
+        set_total_letters(total + 10)
+        assert client.get('/api/statistics').json()['total_letters'] == total + 10
+    finally:
+        set_total_letters(total)
+
+
+def test_database_error_is_not_cached(client, monkeypatch):
+    with monkeypatch.context() as patch:
+        locked_database(patch)
+        response = client.get('/api/statistics')
+    assert response.status_code == 503
+    assert response_cache.stats()['entries'] == 0
+
+    response = client.get('/api/statistics')
+    assert response.status_code == 200
+    assert response.json()['total_letters'] > 0
+
+
+def test_etag_round_trip(client):
+    response = client.get('/api/statistics')
+    etag = response.headers['etag']
+    assert client.get('/api/statistics', headers={'If-None-Match': etag}).status_code == 304
+
+    total = response.json()['total_letters']
+    try:
+        set_total_letters(total + 10)
+        response = client.get('/api/statistics', headers={'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['etag'] != etag
+        assert response.json()['total_letters'] == total + 10
+    finally:
+        set_total_letters(total)
+
+
+def test_failed_response_never_gets_304(client, monkeypatch):
+    with monkeypatch.context() as patch:
+        locked_database(patch)
+        failed = client.get('/api/statistics')
+    assert failed.status_code == 503
+    assert 'etag' not in failed.headers
+
+    # Клиенту нечем перепроверять ошибку: после восстановления базы он получает данные
+    response = client.get('/api/statistics', headers={'If-None-Match': failed.headers.get('etag', '')})
+    assert response.status_code == 200
+    assert response.json()['total_letters'] > 0
+
+
+def test_city_detail_missing_or_unavailable(client, monkeypatch):
+    city_id = client.get('/api/cities').json()[0]['id']
+    assert client.get(f'/api/cities/{city_id}').status_code == 200
+    assert client.get('/api/cities/999999').status_code == 404
+    with monkeypatch.context() as patch:
+        locked_database(patch)
+        assert client.get('/api/cities/999999').status_code == 503
@@ -0,0 +1,26 @@
+# test_classifier.py
+"""classify_many совпадает с classify по одному письму"""
+import pytest
+import classifier
+
+TEXTS = [
+    'Дорогой друг! Поздравляю с праздником, желаю здоровья и успехов.',
+    '',
+    None,
+    'Мама больна, на душе тяжело и грустно.',
+    'Ура',
+    'дома',  # вместе с предыдущим текстом было бы «урадома» со словом «рад»
+    'Целую, твоя любимая',
+    'ПОЗДРАВЛЯЮ С ПАСХОЙ',
+]
+
+
+@pytest.mark.parametrize('use_automaton', [True, False])
+def test_classify_many_matches_classify(use_automaton):
+    keyword_classifier = classifier.KeywordClassifier(use_automaton=use_automaton)
+    expected = [keyword_classifier.classify(text) for text in TEXTS]
+    assert keyword_classifier.classify_many(TEXTS) == expected
+
+
+def test_classify_many_empty():
+    assert classifier.classify_many([]) == []
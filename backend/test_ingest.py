@@ -0,0 +1,120 @@
+# test_ingest.py
+"""Инкрементальная загрузка дает ту же базу, что и полная загрузка того же Excel"""
+import json
+import sqlite3
+from datetime import date
+import pytest
+from openpyxl import Workbook
+import ingest
+
+HEADER = (None, ingest.COL_FROM_CITY, ingest.COL_TO_CITY, ingest.COL_TEXT, ingest.COL_DATE, ingest.COL_PRINT_DATE)
+
+ROWS = [
+    ('https://pishutebe.ru/1', 'Москва', 'Тверь', 'Дорогая мама, поздравляю с праздником! Казань ждет меня летом.', 1905),
+    ('https://pishutebe.ru/2', 'Москва', 'Казань', 'Милый друг, целую. Тверь скучна, зато Тула весела.', 1910),
+    ('https://pishutebe.ru/3', 'Москва', 'г. Тула', 'Здоров, работа идет хорошо, Москва шумит.', 1912),
+    ('https://pishutebe.ru/4', 'Казань', 'Москва', 'Грустно без тебя. Брат уехал, Тула далеко.', 1914),
+    ('https://pishutebe.ru/5', 'Тверь', 'Москва', 'Христос воскресе! Поклон всем, кто не уехал в Казань.', 1914),
+    ('https://pishutebe.ru/6', 'Москва', None, 'Учусь в школе, экзамен трудный.', 1915),
+    ('https://pishutebe.ru/7', 'Казань', 'Тула', 'Спасибо за письмо, Москва передает привет.', 1916),
+    ('https://pishutebe.ru/8', 'Москва', 'Тверь', 'Жаль, что Ярославль так и не увидели.', 1920),
+]
+
+
+def write_workbook(path, rows):
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.append(HEADER)
+    for url, from_city, to_city, text, year in rows:
+        sheet.append((url, from_city, to_city, text, date(year, 5, 1), None))
+    workbook.save(path)
+
+
+def load(excel_path, db_path, incremental):
+    return ingest.ingest_excel(str(excel_path), str(db_path), incremental=incremental, write_snapshot=False)
+
+
+def dump(db_path):
+    """Содержимое базы и производных таблиц без id: у полной загрузки id писем и городов другие"""
+    conn = sqlite3.connect(db_path)
+    cities = dict(conn.execute('SELECT id, name FROM cities'))
+    letters = dict(conn.execute('SELECT id, source_key FROM letters'))
+
+    def rows(sql):
+        return sorted(conn.execute(sql), key=repr)
+
+    # Центр кластера — сумма по городам в порядке id, поэтому последние знаки могут отличаться
+    def point(value):
+        return None if value is None else round(value, 9)
+
+    for index in ('letters_fts', 'letters_trigram'):
+        conn.execute(f"CREATE VIRTUAL TABLE temp.{index}_terms USING fts5vocab(main, {index}, 'row')")
+        # Индекс совпадает с текстами писем
+        conn.execute(f"INSERT INTO {index} ({index}) VALUES ('integrity-check')")
+
+    result = {
+        'cities': rows('SELECT name, latitude, longitude, letter_count FROM cities'),
+        'letters': sorted(
+            (key, cities.get(from_id), cities.get(to_id), year, content, theme, sentiment, excerpt)
+            for key, from_id, to_id, year, content, theme, sentiment, excerpt in conn.execute(
+                'SELECT source_key, from_city_id, to_city_id, year, content, theme, sentiment, excerpt FROM letters'
+            )
+        ),
+        'source_rows': rows('SELECT * FROM source_rows'),
+        'letter_stats': rows('SELECT * FROM letter_stats'),
+        'letter_cube': sorted((
+            (theme, sentiment, cities.get(city_id, city_id), year, count)
+            for theme, sentiment, city_id, year, count in conn.execute('SELECT * FROM letter_cube')
+        ), key=repr),
+        'city_mentions': sorted(
+            (cities[city_id], cities[mentioned_id], count, sorted(letters[letter_id] for letter_id in json.loads(ids)))
+            for city_id, mentioned_id, count, ids in conn.execute('SELECT * FROM city_mentions')
+        ),
+        'city_clusters': sorted(
+            (*row[:5], *(point(value) for value in row[5:11]), cities.get(row[11]), row[12])
+            for row in conn.execute('SELECT * FROM city_clusters')
+        ),
+        'city_rtree': sorted(
+            (cities[city_id], *box) for city_id, *box in conn.execute('SELECT * FROM city_rtree')
+        ),
+        'search_trigrams': rows('SELECT * FROM search_trigrams'),
+        'letters_fts': rows('SELECT * FROM letters_fts_terms'),
+        'letters_trigram': rows('SELECT * FROM letters_trigram_terms'),
+    }
+    conn.close()
+    return result
+
+
+def assert_same_as_full(tmp_path, excel_path, db_path, name):
+    full_path = tmp_path / f'{name}-full.db'
+    load(excel_path, full_path, incremental=False)
+    incremental, full = dump(db_path), dump(full_path)
+    for table in full:
+        assert incremental[table] == full[table], table
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_incremental_matches_full_load(tmp_path, workers):
+    excel_path = tmp_path / 'corpus.xlsx'
+    db_path = tmp_path / 'postcards.db'
+    write_workbook(excel_path, ROWS)
+    load(excel_path, db_path, incremental=False)
+
+    # Тот же набор городов: правка текста, смена города на известный, удаление и новая строка
+    rows = list(ROWS)
+    rows[0] = rows[0][:3] + ('Дорогая мама, поздравляю! Тверь, потом Тула.', 1906)
+    rows[1] = (rows[1][0], 'Тула') + rows[1][2:]
+    del rows[4]
+    rows.append(('https://pishutebe.ru/9', 'Тверь', 'Казань', 'Рад был получить весточку. Москва и Казань кланяются.', 1925))
+    write_workbook(excel_path, rows)
+    stats = ingest.ingest_excel(str(excel_path), str(db_path), incremental=True, workers=workers,
+                                write_snapshot=False)
+    assert (stats['mode'], stats['added'], stats['changed'], stats['removed']) == ('incremental', 1, 2, 1)
+    assert_same_as_full(tmp_path, excel_path, db_path, 'same-cities')
+
+    # Новый город и город, у которого не осталось писем
+    rows[2] = (rows[2][0], 'Ярославль') + rows[2][2:]
+    rows = [row for row in rows if 'Казань' not in row[1:3]]
+    write_workbook(excel_path, rows)
+    load(excel_path, db_path, incremental=True)
+    assert_same_as_full(tmp_path, excel_path, db_path, 'new-cities')
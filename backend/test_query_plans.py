@@ -0,0 +1,36 @@
+# test_query_plans.py
+"""Все запросы API на свежей схеме идут по индексам (как migrations --check)"""
+import sqlite3
+import pytest
+import migrations
+from database import API_QUERIES
+
+
+@pytest.fixture(scope='module')
+def conn():
+    conn = sqlite3.connect(':memory:', isolation_level=None)
+    migrations.migrate(conn)
+    yield conn
+    conn.close()
+
+
+def test_schema_is_latest(conn):
+    assert migrations.get_version(conn) == migrations.LATEST_VERSION
+
+
+@pytest.mark.parametrize('name', sorted(API_QUERIES))
+def test_query_uses_index(conn, name):
+    sql, params, full_scan_ok = API_QUERIES[name]
+    plan = migrations.query_plan(conn, sql, params)
+    assert full_scan_ok or migrations.uses_index(plan), ' | '.join(plan)
+
+
+def test_check_does_not_migrate(tmp_path):
+    path = str(tmp_path / 'old.db')
+    old = sqlite3.connect(path, isolation_level=None)
+    migrations.migrate(old, target=migrations.LATEST_VERSION - 1)
+    old.close()
+
+    assert migrations.check_database(path) == []
+    with sqlite3.connect(path) as check:
+        assert migrations.get_version(check) == migrations.LATEST_VERSION - 1
@@ -0,0 +1,51 @@
+# test_xlsx_reader.py
+"""xlsx_reader отдает те же значения, что openpyxl в режиме read-only"""
+from datetime import date, datetime
+from openpyxl import Workbook, load_workbook
+import xlsx_reader
+
+
+def trimmed(rows):
+    """Строки без None в конце и без пустых строк в конце листа: openpyxl
+    дополняет их до размеров листа"""
+    rows = [tuple(row) for row in rows]
+    rows = [row[:max((index + 1 for index, value in enumerate(row) if value is not None), default=0)]
+            for row in rows]
+    while rows and not rows[-1]:
+        rows.pop()
+    return rows
+
+
+def openpyxl_rows(path):
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        return [(sheet.title, trimmed(sheet.iter_rows(values_only=True))) for sheet in workbook.worksheets]
+    finally:
+        workbook.close()
+
+
+def test_values_match_openpyxl(tmp_path):
+    path = tmp_path / 'book.xlsx'
+    workbook = Workbook()
+    sheet = workbook.active
+    sheet.title = 'Корпус'
+    sheet.append([None, 'Текст', 'Число', 'Дата', 'Флаг'])
+    sheet.append(['https://pishutebe.ru/1', 'Привет x005F_ и «кавычки»', 42, date(1910, 5, 1), True])
+    sheet.append([None, '  пробелы  ', 3.25, datetime(1915, 1, 2, 3, 4, 5), False])
+    sheet.append([None, None, 1e-7, '01.02.1903', None])
+    sheet['B6'] = 'после пропущенной строки'
+    sheet['G7'] = 'далеко справа'
+    sheet['D8'] = 45000
+    sheet['D8'].number_format = 'dd.mm.yyyy'
+    other = workbook.create_sheet('Продолжение')
+    other.append([None, 'Текст'])
+    other.append(['https://pishutebe.ru/2', 'вторая страница'])
+    workbook.save(path)
+
+    expected = openpyxl_rows(path)
+    actual = [(name, trimmed(rows)) for name, rows in xlsx_reader.iter_workbook(path)]
+    assert actual == expected
+    # Типы тоже совпадают: дата остается datetime, целое — int
+    for (_, expected_rows), (_, actual_rows) in zip(expected, actual):
+        for expected_row, actual_row in zip(expected_rows, actual_rows):
+            assert [type(value) for value in actual_row] == [type(value) for value in expected_row]
@@ -0,0 +1,107 @@
+# timeline.py
+"""Куб писем год × тема × тональность × город для /api/timeline.
+
+Каждая открытка при загрузке добавляется во все клетки куба, куда она
+попадает, включая итоговые: тема '' — все темы, тональность '' — все,
+город 0 — все города, год 0 — все годы (и письма без года). Поэтому любой
+срез с фильтрами по части измерений — это чтение готовых клеток по
+первичному ключу (theme, sentiment, city_id, year), без просмотра letters:
+
+    /api/timeline                          — письма по годам
+    /api/timeline?theme=семья&group=sentiment — тема по годам с разбивкой по тональности
+    /api/timeline?group=city&granularity=decade — крупнейшие города по десятилетиям
+
+Письмо внутри одного города считается у него один раз, в итоге по всем
+городам — тоже один раз, как в letter_stats. Куб поддерживается
+приращениями в LetterWriter, а целиком строится rebuild_letter_cube.
+"""
+
+ALL_THEMES = ''
+ALL_SENTIMENTS = ''
+ALL_CITIES = 0
+ALL_YEARS = 0
+
+GROUPS = ('theme', 'sentiment', 'city')
+GRANULARITIES = ('year', 'decade')
+
+UPSERT_CUBE_SQL = '''
+    INSERT INTO letter_cube (theme, sentiment, city_id, year, count) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (theme, sentiment, city_id, year) DO UPDATE SET count = count + excluded.count
+'''
+
+
+def cube_cells(year, theme, sentiment, city_ids):
+    """Клетки (theme, sentiment, city_id, year), в которые попадает открытка"""
+    theme = theme or 'другое'
+    sentiment = sentiment or 'neutral'
+    years = (ALL_YEARS,) if year is None else (year, ALL_YEARS)
+    for city_id in (ALL_CITIES, *city_ids):
+        for cell_theme in (theme, ALL_THEMES):
+            for cell_sentiment in (sentiment, ALL_SENTIMENTS):
+                for cell_year in years:
+                    yield cell_theme, cell_sentiment, city_id, cell_year
+
+
+def add_to_cube(deltas, year, theme, sentiment, city_ids, delta):
+    """Копим приращения клеток куба для delta открыток"""
+    for key in cube_cells(year, theme, sentiment, city_ids):
+        deltas[key] = deltas.get(key, 0) + delta
+
+
+def apply_cube_deltas(conn, deltas):
+    conn.executemany(UPSERT_CUBE_SQL, [key + (delta,) for key, delta in sorted(deltas.items()) if delta])
+    conn.execute('DELETE FROM letter_cube WHERE count <= 0')
+
+
+def rebuild_letter_cube(conn):
+    """Пересобираем letter_cube по всем письмам. Возвращает число клеток."""
+    deltas = {}
+    for year, theme, sentiment, from_id, to_id, count in conn.execute(
+        'SELECT year, theme, sentiment, from_city_id, to_city_id, COUNT(*) FROM letters '
+        'GROUP BY year, theme, sentiment, from_city_id, to_city_id'
+    ):
+        add_to_cube(deltas, year, theme, sentiment, {from_id, to_id} - {None}, count)
+    conn.execute('DELETE FROM letter_cube')
+    apply_cube_deltas(conn, deltas)
+    return len(deltas)
+
+
+def period(year, granularity):
+    """Начало периода, в который попадает год"""
+    return year - year % 10 if granularity == 'decade' else year
+
+
+def build_series(rows, granularity, year_from=None, year_to=None, corpus_years=None):
+    """(ключ, год, count) -> периоды подряд и ряды с нулями в пропусках.
+
+    Годы сворачиваются в десятилетия здесь: это не больше десяти клеток на период.
+    year_from и year_to растягивают ряд нулями, но не дальше corpus_years —
+    (первый, последний) год корпуса: year_to=9999 не дает восьми тысяч пустых лет.
+    """
+    counts = {}
+    for key, year, count in rows:
+        series = counts.setdefault(key, {})
+        start = period(year, granularity)
+        series[start] = series.get(start, 0) + count
+
+    starts = [start for series in counts.values() for start in series]
+    if corpus_years and None not in corpus_years:
+        # Нулями дополняем только пересечение запрошенного диапазона с годами корпуса
+        first = corpus_years[0] if year_from is None else max(year_from, corpus_years[0])
+        last = corpus_years[1] if year_to is None else min(year_to, corpus_years[1])
+        if first <= last:
+            if year_from is not None:
+                starts.append(period(first, granularity))
+            if year_to is not None:
+                starts.append(period(last, granularity))
+    if not starts:
+        return [], []
+    step = 10 if granularity == 'decade' else 1
+    periods = list(range(min(starts), max(starts) + 1, step))
+
+    result = [
+        {'key': key, 'total': sum(series.values()), 'counts': [series.get(start, 0) for start in periods]}
+        for key, series in counts.items()
+    ]
+    result.sort(key=lambda series: (-series['total'], str(series['key'])))
+    return periods, result
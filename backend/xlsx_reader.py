@@ -0,0 +1,149 @@
+# xlsx_reader.py
+"""Быстрое построчное чтение листов xlsx с теми же значениями, что у openpyxl.
+
+openpyxl в режиме read-only — большая часть времени загрузки корпуса: лист
+без <dimension> он разбирает дважды (сначала ищет размер листа), на каждую
+ячейку строит словарь и переводит адрес в координаты, а общие строки собирает
+через дескрипторы Text. Здесь общие строки и лист читаются одним проходом
+iterparse (expat), а значения сразу раскладываются в кортеж строки.
+
+Метаданные книги — порядок листов, форматы дат, эпоху 1900/1904 — по-прежнему
+читает openpyxl, и числа с датами переводятся его же функциями, поэтому
+значения совпадают с load_workbook(read_only=True, data_only=True).iter_rows(values_only=True).
+"""
+from xml.etree.ElementTree import iterparse
+from openpyxl.reader.excel import ExcelReader
+from openpyxl.styles.stylesheet import apply_stylesheet
+from openpyxl.utils.cell import column_index_from_string
+from openpyxl.utils.datetime import from_excel, from_ISO8601
+from openpyxl.xml.constants import SHEET_MAIN_NS, SHARED_STRINGS
+
+_SI = f'{{{SHEET_MAIN_NS}}}si'
+_T = f'{{{SHEET_MAIN_NS}}}t'
+_R = f'{{{SHEET_MAIN_NS}}}r'
+_IS = f'{{{SHEET_MAIN_NS}}}is'
+_C = f'{{{SHEET_MAIN_NS}}}c'
+_V = f'{{{SHEET_MAIN_NS}}}v'
+_ROW = f'{{{SHEET_MAIN_NS}}}row'
+_SHEET_DATA = f'{{{SHEET_MAIN_NS}}}sheetData'
+
+
+def _text(element):
+    """Текст строки без форматирования, как openpyxl Text.content: <t> и <t> внутри <r>,
+    без фонетических подсказок <rPh>"""
+    parts = []
+    for child in element:
+        if child.tag == _T:
+            parts.append(child.text or '')
+        elif child.tag == _R:
+            run_text = child.find(_T)
+            if run_text is not None:
+                parts.append(run_text.text or '')
+    return ''.join(parts)
+
+
+def read_shared_strings(source):
+    strings = []
+    for _, element in iterparse(source):
+        if element.tag == _SI:
+            # Экранирование x005F_ openpyxl снимает так же
+            strings.append(_text(element).replace('x005F_', ''))
+            element.clear()
+    return strings
+
+
+def _cast_number(value):
+    if '.' in value or 'E' in value or 'e' in value:
+        return float(value)
+    return int(value)
+
+
+# Буквы столбца -> номер столбца
+_COLUMNS = {}
+
+
+def _column(reference):
+    """'AB12' -> 28"""
+    letters = reference.rstrip('0123456789')
+    column = _COLUMNS.get(letters)
+    if column is None:
+        column = _COLUMNS[letters] = column_index_from_string(letters)
+    return column
+
+
+def iter_sheet_rows(source, shared_strings, date_formats, epoch):
+    """Кортежи значений строк листа. Пропущенные в файле строки отдаются пустым
+    кортежем, пропущенные ячейки — None"""
+    row_number = 0
+    sheet_data = None
+    for event, element in iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if element.tag == _SHEET_DATA:
+                sheet_data = element
+            continue
+        if element.tag != _ROW:
+            continue
+        number = element.get('r')
+        number = int(float(number)) if number else row_number + 1
+        for _ in range(row_number + 1, number):
+            yield ()
+        row_number = number
+
+        values = []
+        column = 0
+        for cell in element:
+            if cell.tag != _C:
+                continue
+            reference = cell.get('r')
+            column = _column(reference) if reference else column + 1
+            data_type = cell.get('t', 'n')
+            if data_type == 'inlineStr':
+                inline = cell.find(_IS)
+                value = _text(inline) if inline is not None else None
+            else:
+                value = cell.findtext(_V) or None
+                if value is None:
+                    pass
+                elif data_type == 'n':
+                    value = _cast_number(value)
+                    if int(cell.get('s') or 0) in date_formats:
+                        try:
+                            value = from_excel(value, epoch)
+                        except (OverflowError, ValueError):
+                            value = '#VALUE!'
+                elif data_type == 's':
+                    value = shared_strings[int(value)]
+                elif data_type == 'b':
+                    value = bool(int(value))
+                elif data_type == 'd':
+                    value = from_ISO8601(value)
+            if column > len(values):
+                values.extend([None] * (column - len(values)))
+            values[column - 1] = value
+        # Разобранные строки убираем из дерева, иначе на большом листе копятся пустые элементы
+        sheet_data.clear()
+        yield tuple(values)
+
+
+def iter_workbook(path):
+    """(название листа, строки листа) для каждого рабочего листа книги по порядку"""
+    reader = ExcelReader(path, read_only=True, data_only=True)
+    try:
+        reader.read_manifest()
+        reader.read_workbook()
+        apply_stylesheet(reader.archive, reader.wb)
+
+        shared_strings = []
+        part = reader.package.find(SHARED_STRINGS)
+        if part is not None:
+            with reader.archive.open(part.PartName[1:]) as source:
+                shared_strings = read_shared_strings(source)
+
+        date_formats = reader.wb._date_formats
+        for sheet, rel in reader.parser.find_sheets():
+            if rel.target not in reader.valid_files or 'chartsheet' in rel.Type:
+                continue
+            with reader.archive.open(rel.target) as source:
+                yield sheet.name, iter_sheet_rows(source, shared_strings, date_formats, reader.wb.epoch)
+    finally:
+        reader.archive.close()
@@ -2,12 +2,11 @@
 class PostcardMap {
     constructor() {
         this.map = null;
-        this.cities = [];
-        this.filteredCities = [];
+        this.cityCount = 0;      // Городов на маркерах видимой области
         this.markers = [];
+        this.clusterRequest = 0;
         this.connections = [];
-        this.cityConnections = {};
-        this.allLetters = [];
+        this.cityConnections = [];
         this.filters = {
             minLetters: 3,        // Минимум писем для показа города
             minConnections: 2,    // Минимум упоминаний для показа связи
@@ -18,11 +17,12 @@ class PostcardMap {
     }
 
     async init() {
-        await this.loadData();
-        this.applyFilters();
+        // Списка всех городов страница не загружает: маркеры — кластеры сервера,
+        // а связи приходят вместе с координатами своих городов
         this.initMap();
+        await this.fitToCities();
+        await this.loadClusters();
         await this.calculateConnections();
-        this.createMarkers();
         if (this.filters.showConnections) {
             this.drawConnections();
         }
@@ -35,21 +35,6 @@ class PostcardMap {
         this.updateDebugInfo();
     }
 
-    async loadData() {
-        try {
-            console.log("🔄 Загрузка данных с сервера...");
-            const response = await fetch('/api/cities');
-            this.cities = await response.json();
-            console.log(`✅ Загружено ${this.cities.length} городов`);
-            
-            // Сортируем города по количеству писем (по убыванию)
-            this.cities.sort((a, b) => (b.letter_count || 0) - (a.letter_count || 0));
-            
-        } catch (error) {
-            console.error('❌ Ошибка загрузки данных:', error);
-        }
-    }
-
     // app.js - обновите метод applyNewFilters
     async applyNewFilters() {
         console.log("🔄 Применение новых фильтров...");
@@ -63,12 +48,11 @@ class PostcardMap {
             // Обновляем фильтры из UI
             this.updateFiltersFromUI();
             
-            this.applyFilters();
+            // Маркеры — кластеры только тех городов, что проходят фильтры
+            await this.loadClusters();
             
-            // Удаляем старые маркеры и связи
-            this.markers.forEach(marker => this.map.removeLayer(marker));
+            // Удаляем старые связи
             this.connections.forEach(connection => this.map.removeLayer(connection));
-            this.markers = [];
             this.connections = [];
             
             // Пересчитываем связи если нужно
@@ -78,9 +62,6 @@ class PostcardMap {
                 this.cityConnections = [];
             }
             
-            // Создаем новые маркеры
-            this.createMarkers();
-            
             // Рисуем новые связи если нужно
             if (this.filters.showConnections && this.cityConnections.length > 0) {
                 this.drawConnections();
@@ -159,7 +140,7 @@ class PostcardMap {
         const debugFilters = document.getElementById('debugFilters');
         
         if (debugCityCount) {
-            debugCityCount.textContent = this.filteredCities.length;
+            debugCityCount.textContent = this.cityCount;
         }
         
         if (debugFilters) {
@@ -181,97 +162,101 @@ class PostcardMap {
             [82.0, 190.0]
         ]);
         
+        // Маркеры зависят от видимой области: после каждого сдвига и зума запрашиваем кластеры
+        this.map.on('moveend', () => this.loadClusters());
+
         console.log("🗺️ Карта инициализирована");
     }
 
+    cityFilterParams() {
+        // Лимит городов и минимум писем применяет сервер
+        return {
+            min_letters: this.filters.minLetters,
+            top: this.filters.topCities
+        };
+    }
+
+    async fitToCities() {
+        // Границы отфильтрованных городов — по кластерам самого мелкого зума на весь мир
+        const params = new URLSearchParams({ zoom: 0, ...this.cityFilterParams() });
+        try {
+            const response = await fetch(`/api/cities/clusters?${params}`);
+            const clusters = await response.json();
+            if (clusters.length > 0) {
+                const bounds = L.latLngBounds([]);
+                clusters.forEach(cluster => {
+                    bounds.extend([cluster.south, cluster.west]);
+                    bounds.extend([cluster.north, cluster.east]);
+                });
+                this.map.fitBounds(bounds.pad(0.1));
+            }
+        } catch (error) {
+            console.error('❌ Ошибка загрузки границ городов:', error);
+        }
+    }
+
+    async loadClusters() {
+        // Сервер группирует города видимой области по сетке текущего зума
+        const requestId = ++this.clusterRequest;
+        const params = new URLSearchParams({
+            bbox: this.map.getBounds().toBBoxString(),
+            zoom: this.map.getZoom(),
+            ...this.cityFilterParams()
+        });
+        try {
+            const response = await fetch(`/api/cities/clusters?${params}`);
+            const clusters = await response.json();
+            // Пока шел запрос, карту могли сдвинуть еще раз — устаревший ответ не рисуем
+            if (requestId !== this.clusterRequest) return;
+            this.cityCount = clusters.reduce((sum, cluster) => sum + cluster.city_count, 0);
+            this.createMarkers(clusters);
+            this.updateDebugInfo();
+        } catch (error) {
+            console.error('❌ Ошибка загрузки кластеров:', error);
+        }
+    }
+
     async calculateConnections() {
         if (!this.filters.showConnections) return;
         
-        console.log("🔗 Анализ связей между городами...");
-        this.cityConnections = {};
+        console.log("🔗 Загрузка связей между городами...");
+        this.cityConnections = [];
         
-        // Загружаем письма только для отфильтрованных городов
-        await this.loadLettersForFilteredCities();
-        
-        const citiesById = {};
-        this.filteredCities.forEach(city => {
-            citiesById[city.id] = city;
+        // Упоминания городов в письмах посчитаны на сервере при загрузке корпуса:
+        // берем самые сильные связи между крупнейшими городами — их список по тем же
+        // фильтрам сервер собирает сам и возвращает вместе с координатами
+        const params = new URLSearchParams({
+            directed: 'false',
+            min_count: this.filters.minConnections,
+            limit: 30, // Ограничиваем количество связей
+            ...this.cityFilterParams(),
+            with_cities: 'true'
         });
         
-        // Анализируем письма для поиска связей
-        this.allLetters.forEach(letter => {
-            const cityId = letter.city_id;
-            const city = citiesById[cityId];
-            
-            if (!city) return;
-            
-            // Ищем упоминания других отфильтрованных городов
-            this.filteredCities.forEach(targetCity => {
-                if (targetCity.id !== cityId && 
-                    targetCity.name && 
-                    city.name &&
-                    letter.content && 
-                    this.hasCityMention(letter.content, targetCity.name)) {
-                    
-                    const connectionKey = [cityId, targetCity.id].sort().join('-');
-                    
-                    if (!this.cityConnections[connectionKey]) {
-                        this.cityConnections[connectionKey] = {
-                            city1: city,
-                            city2: targetCity,
-                            count: 0
-                        };
-                    }
-                    
-                    this.cityConnections[connectionKey].count++;
-                }
-            });
-        });
-        
-        // Фильтруем слабые связи
-        const strongConnections = Object.values(this.cityConnections)
-            .filter(conn => conn.count >= this.filters.minConnections)
-            .sort((a, b) => b.count - a.count)
-            .slice(0, 30); // Ограничиваем количество связей
-        
-        console.log(`✅ Найдено ${strongConnections.length} значимых связей`);
-        
-        this.cityConnections = strongConnections;
-    }
-
-    async loadLettersForFilteredCities() {
         try {
-            // Загружаем письма только для отфильтрованных городов
-            const lettersPromises = this.filteredCities.map(city => 
-                fetch(`/api/cities/${city.id}`).then(r => r.json())
-            );
+            const response = await fetch(`/api/connections?${params}`);
+            const connections = await response.json();
             
-            const citiesData = await Promise.all(lettersPromises);
-            this.allLetters = citiesData.flatMap(cityData => cityData.letters || []);
+            this.cityConnections = connections
+                .filter(conn => conn.source && conn.target)
+                .map(conn => ({
+                    city1: conn.source,
+                    city2: conn.target,
+                    count: conn.count
+                }));
             
-            console.log(`✅ Загружено ${this.allLetters.length} писем для анализа связей`);
+            console.log(`✅ Найдено ${this.cityConnections.length} значимых связей`);
         } catch (error) {
-            console.error('❌ Ошибка загрузки писем:', error);
-            this.allLetters = [];
+            console.error('❌ Ошибка загрузки связей:', error);
+            this.cityConnections = [];
         }
     }
 
-    hasCityMention(content, cityName) {
-        if (!content || !cityName) return false;
-        
-        const contentLower = content.toLowerCase();
-        const cityNameLower = cityName.toLowerCase();
-        
-        // Простая проверка на вхождение названия города
-        return contentLower.includes(cityNameLower);
-    }
-
-    // app.js - замените метод createMarkers
-    createMarkers() {
+    createMarkers(clusters) {
         this.markers.forEach(marker => this.map.removeLayer(marker));
         this.markers = [];
 
-        console.log(`🔄 Создание маркеров для ${this.filteredCities.length} городов`);
+        console.log(`🔄 Создание маркеров для ${clusters.length} кластеров`);
 
         // Создаем кастомные иконки разного размера
         const createCustomIcon = (letterCount) => {
@@ -297,35 +282,65 @@ class PostcardMap {
             });
         };
 
-        this.filteredCities.forEach(city => {
-            if (!city.latitude || !city.longitude) return;
+        // Кластер из нескольких городов — кружок с их числом
+        const createClusterIcon = (cluster) => {
+            const radius = this.calculateRadius(cluster.letter_count) + 12;
+            return L.divIcon({
+                className: 'city-marker',
+                html: `<div style="
+                    width: ${radius}px; 
+                    height: ${radius}px; 
+                    line-height: ${radius}px;
+                    background: hsla(210, 90%, 45%, 0.85); 
+                    border: 2px solid white; 
+                    border-radius: 50%; 
+                    box-shadow: 0 2px 8px rgba(0,0,0,0.3);
+                    color: white;
+                    font-size: 11px;
+                    font-weight: bold;
+                    text-align: center;
+                    cursor: pointer;
+                ">${cluster.city_count}</div>`,
+                iconSize: [radius, radius],
+                iconAnchor: [radius/2, radius/2]
+            });
+        };
 
-            const lat = parseFloat(city.latitude);
-            const lng = parseFloat(city.longitude);
+        clusters.forEach(cluster => {
+            const lat = parseFloat(cluster.latitude);
+            const lng = parseFloat(cluster.longitude);
             
             if (isNaN(lat) || isNaN(lng)) return;
 
             try {
+                const single = cluster.city_count === 1;
                 const marker = L.marker([lat, lng], {
-                    icon: createCustomIcon(city.letter_count || 1),
-                    title: city.name
+                    icon: single ? createCustomIcon(cluster.letter_count || 1) : createClusterIcon(cluster),
+                    title: single ? cluster.name : `${cluster.name} и еще ${cluster.city_count - 1}`
                 }).addTo(this.map);
 
-                marker.bindPopup(`
-                    <div class="popup-content">
-                        <h3>${city.name}</h3>
-                        <p><strong>📨 Писем:</strong> ${city.letter_count || 0}</p>
-                        <button onclick="app.showCityDetail(${city.id})" 
-                                class="popup-btn">📖 Подробнее</button>
-                    </div>
-                `);
+                if (single) {
+                    marker.bindPopup(`
+                        <div class="popup-content">
+                            <h3>${cluster.name}</h3>
+                            <p><strong>📨 Писем:</strong> ${cluster.letter_count || 0}</p>
+                            <button onclick="app.showCityDetail(${cluster.city_id})" 
+                                    class="popup-btn">📖 Подробнее</button>
+                        </div>
+                    `);
+                }
 
-                marker.cityId = city.id;
+                marker.cityId = cluster.city_id;
                 
-                // Упрощаем обработчики событий
                 marker.on('click', (e) => {
                     e.originalEvent.stopPropagation();
-                    this.showCityDetail(city.id);
+                    // Кластер приближаем до его городов; города в одной точке дальше не разойдутся
+                    const samePoint = cluster.south === cluster.north && cluster.west === cluster.east;
+                    if (single || samePoint) {
+                        this.showCityDetail(cluster.city_id);
+                    } else {
+                        this.map.fitBounds([[cluster.south, cluster.west], [cluster.north, cluster.east]], { padding: [40, 40] });
+                    }
                 });
 
                 marker.on('mouseover', () => {
@@ -339,16 +354,11 @@ class PostcardMap {
                 this.markers.push(marker);
                 
             } catch (error) {
-                console.error(`❌ Ошибка создания маркера для ${city.name}:`, error);
+                console.error(`❌ Ошибка создания маркера для ${cluster.name}:`, error);
             }
         });
 
         console.log(`✅ Создано ${this.markers.length} маркеров`);
-        
-        if (this.markers.length > 0) {
-            const group = new L.featureGroup(this.markers);
-            this.map.fitBounds(group.getBounds().pad(0.1));
-        }
     }
 
     drawConnections() {
@@ -431,7 +441,8 @@ class PostcardMap {
 
     async showCityDetail(cityId) {
         try {
-            const response = await fetch(`/api/cities/${cityId}`);
+            // Панели хватает первых писем и их отрывков — весь город не загружаем
+            const response = await fetch(`/api/cities/${cityId}?limit=10&fields=id,year,theme,sentiment,excerpt`);
             const cityData = await response.json();
             
             if (!cityData) return;
@@ -586,22 +597,6 @@ class PostcardMap {
             }
         }
     }
-    applyFilters() {
-        console.log("🔄 Применение фильтров...");
-        
-        // Фильтруем города по минимальному количеству писем
-        let filtered = this.cities.filter(city => 
-            (city.letter_count || 0) >= this.filters.minLetters
-        );
-        
-        // Берем топ-N городов по количеству писем
-        filtered = filtered.slice(0, this.filters.topCities);
-        
-        console.log(`✅ После фильтрации: ${filtered.length} городов`);
-        this.filteredCities = filtered;
-    }
-
-    
 }
 
 // Инициализация приложения